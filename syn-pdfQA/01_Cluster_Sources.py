@@ -1,105 +1,147 @@
 import glob
+import json
+import os
 import pandas as pd
-import numpy as np
 import asyncio
 import sys
-from sklearn.cluster import KMeans
-from openai import AsyncOpenAI
+from concurrent.futures import ProcessPoolExecutor
+from pipeline.backends import create_backend
+from pipeline.clustering import ClusteringConfig, cluster_embeddings
+from pipeline.embedding_store import EmbeddingStore
+from pipeline.embeddings import embed_batches, plan_embedding_batches
+from pipeline.manifest import StageManifest, document_name
+from pipeline.metrics import Metrics
+from pipeline.sources import write_sources
 
 # windows or not?
 if sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-# read API key
-with open("key.txt", "r", encoding="utf-8") as f:
-    OPENAI_API_KEY = f.read().strip()
+# "openai" sends requests to the OpenAI API (key.txt), "mock" to a local server with synthetic answers (pipeline/backends.py)
+BACKEND = "openai"
+# e.g. {"latency": 0.2, "error_rate": 0.01, "rate_limit_rate": 0.05} to load-test against the mock
+BACKEND_OPTIONS = {}
+# API calls and hot functions are recorded in logs/metrics.jsonl, with a summary at the end (pipeline/metrics.py)
+METRICS = Metrics("logs/metrics.jsonl")
+# e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics (Prometheus) while the stage runs
+METRICS_PORT = None
+
+# persistent embeddings, shared with 03_Quality_Filter.py
+EMBEDDINGS = EmbeddingStore("cache/embeddings.sqlite", metrics=METRICS)
+
+# async helper (only texts that are not in the embedding store are sent to the API)
+async def async_get_embeddings(backend, texts, model):
+    async def fetch(missing):
+        return await backend.embed(missing, model)
+    return await EMBEDDINGS.embed(texts, model, fetch)
+
+# clustering backend, see pipeline/clustering.py
+# ("kmeans" + no reduction reproduces the paper; "minibatch" and/or "pca"/"matryoshka" are much faster on books)
+CLUSTERING = ClusteringConfig(backend="kmeans", reduction=None)
+# wall time of the clustering per file
+CLUSTERING_LOG = "logs/clustering.jsonl"
+
+# clustering (runs in a worker process so files can be clustered in parallel)
+async def create_clusters(embeddings, n_clusters, pool):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, cluster_embeddings, embeddings, n_clusters, CLUSTERING)
+
+def log_clustering(file_name, n_sources, n_clusters, seconds):
+    os.makedirs(os.path.dirname(CLUSTERING_LOG), exist_ok=True)
+    with open(CLUSTERING_LOG, "a", encoding="utf-8") as f:
+        f.write(json.dumps({
+            "file_name": file_name,
+            "n_sources": n_sources,
+            "n_clusters": n_clusters,
+            "seconds": round(seconds, 3),
+            **CLUSTERING.to_dict(),
+        }) + "\n")
+
+async def process_file(i, file_name, output_file, backend, model, max_concurrency, pool):
+    print(f"Processing: {i}")
+
+    df = pd.read_csv(i, index_col=0)
+
+    # Arxiv logic
+    df["text_only"] = df.apply(
+        lambda row: str(row["content"])
+        if not isinstance(row["text_only"], str)
+        else str(row["text_only"]),
+        axis=1
+    )
+
+    df["text_len"] = df["text_only"].apply(len)
+
+    df = df[df["text_len"] > 50].copy()
+    df = df[df["text_len"] < 150_000].copy()
+
+    texts = df["text_only"].astype(str).tolist()
 
-# async helper
-async def async_get_embeddings(client, texts, model):
-    response = await client.embeddings.create(
-        input=texts,
-        model=model
+    # token-packed batches; sources above the per-input limit are split into windows
+    plan = plan_embedding_batches(texts, model)
+    print(f"{len(texts)} sources -> {len(plan.batches)} embedding requests")
+
+    # batches run concurrently; failing batches are retried, then split into single texts
+    window_embeddings = await embed_batches(
+        lambda batch: async_get_embeddings(backend, batch, model),
+        plan.batches,
+        max_concurrency=max_concurrency,
     )
-    return [item.embedding for item in response.data]
+    # pool windows back into one embedding per source
+    embeddings = plan.pool(window_embeddings)
+
+    # clustering
+    n_clusters = CLUSTERING.n_clusters(len(df))
+    df["cluster"], seconds = await create_clusters(embeddings, n_clusters, pool)
+    log_clustering(file_name, len(df), n_clusters, seconds)
+    print(f"Clustered {file_name} into {n_clusters} clusters in {seconds:.1f}s")
 
-# clustering
-def create_clusters(embeddings, n_clusters):
-    embeddings_np = np.array(embeddings)
-    kmeans = KMeans(n_clusters=n_clusters, random_state=42)
-    return kmeans.fit_predict(embeddings_np)
+    # embeddings are stored as a fixed-size float32 column (see pipeline/sources.py)
+    write_sources(df, embeddings, output_file, model)
 
 async def main():
 
-    client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    # LLM/embedding backend, created here so that importing the stage needs no key
+    backend = create_backend(BACKEND, metrics=METRICS, **BACKEND_OPTIONS)
+    METRICS.start("01_Cluster_Sources", port=METRICS_PORT)
 
     file_type = "research articles"
     input_files = glob.glob(f"./01.3_Input_Files_CSV/{file_type}/*.csv")
 
     model = "text-embedding-3-small"
-
-    done_files = glob.glob(
-        f"./02_Parsed_Input_Files_to_Sources/{file_type}/*.parquet"
-    )
-    done_files = [
-        #i.split("/")[-1].split("_clustered.")[0]
-        i.split("\\")[-1].split("_clustered.")[0] # for windows
-        for i in done_files
-    ]
-
-    not_done_files = [
-        i for i in input_files
-        if i.split("\\")[-1].split(".csv")[0] not in done_files # for windows
-        #if i.split("/")[-1].split(".csv")[0] not in done_files
-    ]
-
-    for i in not_done_files:
-        print(f"Processing: {i}")
-
-        df = pd.read_csv(i, index_col=0)
-
-        # Arxiv logic
-        df["text_only"] = df.apply(
-            lambda row: str(row["content"])
-            if not isinstance(row["text_only"], str)
-            else str(row["text_only"]),
-            axis=1
-        )
-
-        df["text_len"] = df["text_only"].apply(len)
-
-        df = df[df["text_len"] > 50].copy()
-        df = df[df["text_len"] < 150_000].copy()
-
-        texts = df["text_only"].astype(str).tolist()
-
-        # chunked embedding
-        embeddings = []
-        chunk_size = 100
-        chunks = [
-            texts[i:i + chunk_size]
-            for i in range(0, len(texts), chunk_size)
-        ]
-
-        for chunk in chunks:
-            try:
-                emb = await async_get_embeddings(client, chunk, model)
-            except Exception as e:
-                print("Embedding failed, using NA fallback:", e)
-                emb = await async_get_embeddings(
-                    client, ["NA"] * len(chunk), model
-                )
-            embeddings.extend(emb)
-
-        # clustering
-        n_clusters = max(1, len(df) // 15)
-        df["cluster"] = create_clusters(embeddings, n_clusters)
-        df[f"embeddings_{model}"] = embeddings
-
-        file_name = i.split("/")[-1].replace(".csv", "").split("\\")[-1] # last condition for windows
-        df.to_parquet(
-            f"./02_Parsed_Input_Files_to_Sources/"
-            f"{file_type}/{file_name}_clustered.parquet"
-        )
+    # number of embedding requests in flight (per file)
+    max_concurrency = 8
+    # files processed at the same time, and processes clustering them
+    max_files_in_flight = 4
+    cluster_workers = 4
+
+    # finished files are skipped, and redone if their input or the model changed (see pipeline/manifest.py)
+    manifest = StageManifest("manifest.sqlite", stage="01_Cluster_Sources", model=model)
+
+    files_in_flight = asyncio.Semaphore(max_files_in_flight)
+    with ProcessPoolExecutor(max_workers=cluster_workers) as pool:
+        async def run(i):
+            file_name = document_name(i, ".csv")
+            output_file = f"./02_Parsed_Input_Files_to_Sources/{file_type}/{file_name}_clustered.parquet"
+            async with files_in_flight:
+                if not manifest.claim(file_name, i, output_file):
+                    return
+                try:
+                    await process_file(i, file_name, output_file, backend, model, max_concurrency, pool)
+                except Exception as e:
+                    # the other files carry on, the failed one is retried on the next run
+                    print(f"ERROR for {i}: {e!r}")
+                    manifest.failed(file_name, repr(e))
+                    return
+                manifest.done(file_name, output_file)
+        with METRICS.labels(category=file_type):
+            await asyncio.gather(*[run(i) for i in input_files])
+    print(EMBEDDINGS.report())
+    print(backend.report())
+    print(manifest.summary())
+    print(METRICS.summary())
+    METRICS.close()
+    await backend.close()
 
 # run
 if __name__ == "__main__":
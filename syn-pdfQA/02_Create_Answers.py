@@ -1,19 +1,42 @@
 import json
 import glob
-import pandas as pd
+import hashlib
 import numpy as np
-import random
-from openai import AsyncOpenAI
 import asyncio
 import sys
+from pipeline.backends import create_backend
+from pipeline.batch import BatchRunner
+from pipeline.checkpoint import Checkpoint
+from pipeline.completion_cache import CompletionCache
+from pipeline.errors import permanent_failures, raise_retryable
+from pipeline.manifest import StageManifest, document_name
+from pipeline.metrics import Metrics
+from pipeline.retry import run_with_retry
+from pipeline.scheduler import RequestScheduler
+from pipeline.source_index import SourceIndex, SourceSampler
+from pipeline.sources import read_sources
+from pipeline.vector_index import source_number
 
 # windows or not?
 if sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-# read API key
-with open("key.txt", "r", encoding="utf-8") as f:
-    OPENAI_API_KEY = f.read().strip()
+# "openai" sends requests to the OpenAI API (key.txt), "mock" to a local server with synthetic answers (pipeline/backends.py)
+BACKEND = "openai"
+# e.g. {"latency": 0.2, "error_rate": 0.01, "rate_limit_rate": 0.05} to load-test against the mock
+BACKEND_OPTIONS = {}
+# API calls and hot functions are recorded in logs/metrics.jsonl, with a summary at the end (pipeline/metrics.py)
+METRICS = Metrics("logs/metrics.jsonl")
+# e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics (Prometheus) while the stage runs
+METRICS_PORT = None
+
+# on-disk cache of completions, use mode="replay" to rerun strictly from the cache
+CACHE = CompletionCache("cache/completions.sqlite", mode="readwrite")
+# shared request scheduler (limits per model in pipeline/scheduler.py)
+SCHEDULER = RequestScheduler(max_in_flight=32, cache=CACHE, metrics=METRICS)
+# "online" sends requests through the scheduler, "batch" runs them through the Batch API (pipeline/batch.py)
+EXECUTION_MODE = "online"
+BATCHES = BatchRunner("batches/02_Create_Answers", poll_interval=60, cache=CACHE, metrics=METRICS)
 
 prompt_template_summary = r"""You are a domain expert in {domain} and are provided with SOURCES from a domain document. Your task is to create a QUESTION and ANSWER based on the SOURCES.
 
@@ -60,124 +83,72 @@ modules = {
     "complex": "The QUESTION is very complex and requires a lot of reasoning to answe,r given the SOURCES."
 }
 
-def create_useful_configuration(n_sources, proximity_question=True):
-  configuration = {}
-  # Randomly choose a answer type
-  configuration["answer_type"] = random.choice(["yes-no-question", "value-question", "word-answer", "one-sentence-answer", "open-ended-question-short", "open-ended-question-long"])
-  # Randomly choose replicate or reasoning
-  configuration["reasoning"] = random.choice(["replicate", "reasoning"])
-  # Choose a modality
-  if proximity_question:
-    # FOR SUST REPORTS: random.choice(["mixed-modality", "table-only"]); ELSE: random.choice(["text-only", "mixed-modality", "table-only"])
-    # GENERALLY: configuration["modality"] = random.choice(["text-only", "mixed-modality", "table-only"])
-    # FOR DEMONSTRATION, we only focus on text because it's easier
-    configuration["modality"] = random.choice(["text-only"])# TODO: include: ["text-only", "mixed-modality", "table-only"]
-  else:
-    configuration["modality"] = "clustering"
-
-  configuration["source quantity"] = random.choice(["strict multiple sources", "arbitrary sources"]) if configuration["modality"] in ["clustering", "mixed-modality", "text-only"] else "arbitrary sources"
-  # Choose a difficulty
-  configuration["difficulty"] = random.choice(["simple", "medium", "complex"]) if configuration["reasoning"] == "reasoning" else "simple"
-
-  return configuration
-
-def createGuidelines_Sources_Clustering(report_data, n_sources, configuration, modules):
+ANSWER_TYPES = ["yes-no-question", "value-question", "word-answer", "one-sentence-answer", "open-ended-question-short", "open-ended-question-long"]
+# FOR SUST REPORTS: ["mixed-modality", "table-only"]; ELSE: ["text-only", "mixed-modality", "table-only"]
+# FOR DEMONSTRATION, we only focus on text because it's easier
+PROXIMITY_MODALITIES = ["text-only"]  # TODO: include: ["text-only", "mixed-modality", "table-only"]
+
+def create_useful_configurations(proximity_questions, rng):
+  # draw every choice for all questions of the file at once
+  n = len(proximity_questions)
+  answer_types = rng.choice(ANSWER_TYPES, size=n)
+  reasonings = rng.choice(["replicate", "reasoning"], size=n)
+  modalities = rng.choice(PROXIMITY_MODALITIES, size=n)
+  quantities = rng.choice(["strict multiple sources", "arbitrary sources"], size=n)
+  difficulties = rng.choice(["simple", "medium", "complex"], size=n)
+
+  configurations = []
+  for i in range(n):
+    configuration = {}
+    # Randomly choose a answer type
+    configuration["answer_type"] = str(answer_types[i])
+    # Randomly choose replicate or reasoning
+    configuration["reasoning"] = str(reasonings[i])
+    # Choose a modality
+    configuration["modality"] = str(modalities[i]) if proximity_questions[i] else "clustering"
+    configuration["source quantity"] = str(quantities[i]) if configuration["modality"] in ["clustering", "mixed-modality", "text-only"] else "arbitrary sources"
+    # Choose a difficulty
+    configuration["difficulty"] = str(difficulties[i]) if configuration["reasoning"] == "reasoning" else "simple"
+    configurations.append(configuration)
+
+  return configurations
+
+def createGuidelines(configuration, modules):
   # Create guidelines with the configuration
   guidelines = ""
   for i, value in enumerate(configuration.values()):
     guidelines += f"{i+1}. {modules[value]}\n"
+  return guidelines
 
-  # Select random cluster
-  cluster_indexes = report_data.cluster.unique()
-  seed_cluster = random.choice(cluster_indexes)
-  report_data_cluster = report_data[report_data.cluster == seed_cluster]
-
-  # Randomly select n_sources in the cluster, or all if n_sources > len(report_data_cluster)
-  if n_sources > len(report_data_cluster):
-    n_sources = len(report_data_cluster)
-
-  report_data_cluster_used = report_data_cluster.sample(n_sources).sort_values(by="source_identifier")
-
-  # Create source indexes
-  sources = report_data_cluster_used.content.to_list()
-  source_identifiers = report_data_cluster_used.source_identifier.to_list()
-  modalities = report_data_cluster_used.type.to_list()
-
+def createSourceText(sampler, rows):
   # Go through each row of sources and create Source X (modality: text): [text]
   source_text = ""
-  for i, source in enumerate(sources):
-    source_text += f"\n-----\n{source_identifiers[i]} (modality: {modalities[i]}): {source}\n-----\n"
-
-  return guidelines, source_text, sources
-
-
-def createGuidelines_Sources_Proximity(report_data, n_sources, configuration, modules):
-  # Create guidelines with the configuration
-  guidelines = ""
-  for i, value in enumerate(configuration.values()):
-    guidelines += f"{i+1}. {modules[value]}\n"
-
-  # If modality is "text-only", just give back full-text paragraphs
-  if configuration["modality"] == "text-only":
-    # Create subset of dataset with only "full text"
-    report_data_text_only = report_data[report_data["type"] == "text"]
-    len_sources = len(report_data_text_only)
-    # Create source indexes
-    seed_x = random.randint(0, len_sources-1)
-    lower = int(np.ceil(seed_x - (n_sources / 2))) if seed_x - (n_sources / 2) > 0 else 0
-    upper = int(np.ceil(seed_x + (n_sources / 2))) if seed_x + (n_sources / 2) < len_sources else len_sources - 1
-    source_indexes = list(range(lower, upper))
-
-    # Create the sources
-    sources = report_data_text_only.iloc[source_indexes].content.to_list()
-    source_identifiers = report_data_text_only.iloc[source_indexes].source_identifier.to_list()
-
-    # Go through each row of sources and create Source X (modality: text): [text]
-    source_text = ""
-    for i, source in enumerate(sources):
-      source_text += f"\n-----\n{source_identifiers[i]} (modality: text): {source}\n-----\n"
-
-  ### if modality is table only, then only table
-  if configuration["modality"] == "table-only":
-    # Create subset of dataset with only "real_table"
-    report_data_sub = report_data[report_data["type"] == "table"]
-    len_sources = len(report_data_sub)
-    # Create source indexes
-    seed_x = random.randint(0, len_sources-1)
-    sources = report_data_sub.iloc[[seed_x]].content.to_list()
-    source_identifiers = report_data_sub.iloc[[seed_x]].source_identifier.to_list()
-    source_text = f"\n-----\n{source_identifiers[0]} (modality: table): {sources[0]}\n-----\n"
-
-  if configuration["modality"] == "mixed-modality":
-    # seed_x needs to be a table indentifier
-    report_data_sub = report_data[report_data["type"] == "table"]
-    len_sources = len(report_data_sub)
-    seed_x_temp = random.randint(0, len_sources-1)
-    index_temp = report_data_sub.iloc[[seed_x_temp]].index[0]
-    # Row number of index_temp
-    seed_x = report_data.index.get_loc(index_temp)
-    len_sources = len(report_data)
-    lower = int(np.ceil(seed_x - (n_sources / 2))) if seed_x - (n_sources / 2) > 0 else 0
-    upper = int(np.ceil(seed_x + (n_sources / 2))) if seed_x + (n_sources / 2) < len_sources else len_sources - 1
-    source_indexes = list(range(lower, upper))
-
-    sources = report_data.iloc[source_indexes].content.to_list()
-    source_identifiers = report_data.iloc[source_indexes].source_identifier.to_list()
-    modalities = report_data.iloc[source_indexes].type.to_list()
-
-    # Go through each row of sources and create Source X (modality: text): [text]
-    source_text = ""
-    for i, source in enumerate(sources):
-      source_text += f"\n-----\n{source_identifiers[i]} (modality: {modalities[i]}): {source}\n-----\n"
-
-  return guidelines, source_text, sources
-
-def create_question_answer_sources_prompt(configuration, report_data, n_sources, proximity_question, modules, domain):
+  for row in rows:
+    source_text += f"\n-----\n{sampler.source_identifiers[row]} (modality: {sampler.types[row]}): {sampler.contents[row]}\n-----\n"
+  return source_text
+
+def createGuidelines_Sources_Clustering(sampler, n_sources, configuration, modules, u, rng):
+  guidelines = createGuidelines(configuration, modules)
+  # Randomly select n_sources in a random cluster, or all if n_sources > size of the cluster
+  rows = sampler.cluster(n_sources, u, rng)
+  sources = sampler.contents[rows].tolist()
+  return guidelines, createSourceText(sampler, rows), sources
+
+
+def createGuidelines_Sources_Proximity(sampler, n_sources, configuration, modules, u):
+  guidelines = createGuidelines(configuration, modules)
+  # "text-only": neighbouring full-text paragraphs, "table-only": a single table,
+  # "mixed-modality": neighbouring sources of any modality around a table
+  rows = sampler.proximity(configuration["modality"], n_sources, u)
+  sources = sampler.contents[rows].tolist()
+  return guidelines, createSourceText(sampler, rows), sources
+
+def create_question_answer_sources_prompt(configuration, sampler, n_sources, proximity_question, modules, domain, u, rng):
   # Create guidelines and prompt
   if proximity_question:
-    guidelines, source_text, raw_sources = createGuidelines_Sources_Proximity(report_data, n_sources, configuration, modules)
+    guidelines, source_text, raw_sources = createGuidelines_Sources_Proximity(sampler, n_sources, configuration, modules, u)
   else:
-    guidelines, source_text, raw_sources = createGuidelines_Sources_Clustering(report_data, n_sources, configuration, modules)
+    guidelines, source_text, raw_sources = createGuidelines_Sources_Clustering(sampler, n_sources, configuration, modules, u, rng)
 
   filled_prompt = prompt_template_summary.format(
       domain=domain,
@@ -191,26 +162,42 @@ def create_question_answer_sources_prompt(configuration, report_data, n_sources,
 
   return filled_prompt, prompt_message, raw_sources
 
-# asynced creation of answers
-async def answer_async_OpenAI(prompts, MODEL, CLIENT):
+# asynced creation of answers, one answer or error per prompt
+async def answer_async_OpenAI(prompts, MODEL, backend, on_answer=None):
+  requests = [dict(model = MODEL, temperature = 0, seed = 23, messages = m) for m in prompts]
+
+  if EXECUTION_MODE == "batch":
+    # one batch for all files waiting at the same time; the answers are handled once it has finished
+    out = await BATCHES.run(backend.batch_client, requests, return_exceptions=True)
+    if on_answer is not None:
+      for i, answer in enumerate(out):
+        if not isinstance(answer, BaseException):
+          on_answer(i, answer)
+    return out
+
+  async def answer(i, params):
+    # the scheduler caps requests in flight and keeps us within the model's RPM/TPM budget
+    out = await SCHEDULER.submit(backend.complete, **params)
+    # handle every answer as soon as it arrives (e.g. checkpointing)
+    if on_answer is not None:
+      on_answer(i, out)
+    return out
+
   coroutines = []
-  for m in prompts:
-    #p = "What is 100 * 44554 / 24334 + 4 - 8?"
-    co = CLIENT.chat.completions.create(
-        model = MODEL,
-        temperature = 0,
-        seed = 23,
-        messages = m
-    )
+  for i, params in enumerate(requests):
+    co = answer(i, params)
     coroutines.append(co)
-  # Schedule calls *concurrently*:
-  out = await asyncio.gather(*coroutines)
+  # Schedule calls *concurrently*, a failed request does not cancel the others:
+  out = await asyncio.gather(*coroutines, return_exceptions=True)
   #print(L)
   return out
 
-async def createAnswersDef(prompts, CLIENT, MODEL):
-  # create answers
-  answers = await answer_async_OpenAI(prompts, MODEL, CLIENT)
+async def createAnswersDef(prompts, backend, MODEL, on_answer=None):
+  # create answers; only the failed requests are sent again (429, 5xx, timeouts, with jittered backoff)
+  async def attempt(items):
+    store = None if on_answer is None else (lambda i, answer: on_answer(items[i], answer))
+    return await answer_async_OpenAI([prompts[i] for i in items], MODEL, backend, store)
+  answers = await run_with_retry(attempt, len(prompts))
   #print("Answers Given")
   return answers
 
@@ -239,7 +226,8 @@ def majority_bucket(values, max_val):
     return 25
 
 
-def post_process_answer(answer, report_data, configuration, proximity_question):
+@METRICS.timed
+def post_process_answer(answer, source_index, configuration, proximity_question):
   try:
     # Load JSON string into a Python dictionary
     data = json.loads(answer.replace("```json", "").replace("```", ""))
@@ -247,9 +235,11 @@ def post_process_answer(answer, report_data, configuration, proximity_question):
     #print("JSON did not work")
     return None
 
+  # rows of the cited sources in document order (see pipeline/source_index.py)
+  cited_rows = source_index.cited_rows(data["sources"])
   # Infer the characterstics
   data["modality_configured"] = configuration["modality"]
-  data["modalities_used"] = report_data[report_data.source_identifier.isin(data["sources"])]["type"].to_list()
+  data["modalities_used"] = [source_index.types[row] for row in cited_rows]
   data["num_sources_used"] = len(data["sources"])
   # Plig in value from the configuration
   data["answer_type"] = configuration["answer_type"]
@@ -262,40 +252,44 @@ def post_process_answer(answer, report_data, configuration, proximity_question):
   data["n_sources_seen"] = configuration["n_sources_seen"]
 
   # Store obvious variables
-  data["file_name"] = report_data.file_name.iloc[0]
+  data["file_name"] = source_index.file_name
   # document word spread
-  data["file_length"] = len(" ".join(report_data.text_only.to_list()).split(" "))
-  # Create a subset of the dataset with the minimal and maximal source number used and then count the words
-  # Find the row indices for the identifiers
-  start_index = report_data[report_data['source_identifier'] == data["sources"][0]].index[0]
-  end_index = report_data[report_data['source_identifier'] == data["sources"][-1]].index[0]
-  sub_df = report_data.loc[start_index:end_index]
-  data["source_spread"] = len(" ".join(sub_df.text_only.to_list()).split(" "))
+  data["file_length"] = source_index.file_length
+  # words from the first to the last cited source
+  data["source_spread"] = source_index.words_between(data["sources"][0], data["sources"][-1])
   # Also save text of all cited sources
-  sources_used = report_data[report_data.source_identifier.isin(data["sources"])].content.to_list()
-  data["source_text"] = sources_used
+  data["source_text"] = [source_index.contents[row] for row in cited_rows]
 
   # surces bucket
-  num_max_source = int(report_data.source_identifier.iloc[-1].split("_")[-1])
-  data["sources_position"] = majority_bucket([int(source.split("_")[-1]) for source in data["sources"]], num_max_source)
+  data["sources_position"] = majority_bucket([source_number(source) for source in data["sources"]], source_index.max_source_number)
   return data
 
 
-def createRandomPrompts(report_data, questions_per_file, modules, domain, num_sources_configured="random"):
+def file_seed(file_name):
+  # stable across runs and platforms (unlike hash())
+  return int(hashlib.sha256(file_name.encode("utf-8")).hexdigest()[:8], 16)
+
+
+@METRICS.timed
+def createRandomPrompts(report_data, questions_per_file, modules, domain, num_sources_configured="random", rng=None):
+  # one generator per file makes the sampled prompts reproducible
+  rng = np.random.default_rng() if rng is None else rng
+  # index arrays per modality and cluster, built once per file (see pipeline/source_index.py)
+  sampler = SourceSampler(report_data)
+
+  # Create configurations quite randomly, all draws at once
+  low, high = (5, 15) if num_sources_configured == "random" else num_sources_configured
+  n_sources_all = rng.integers(low, high, size=questions_per_file, endpoint=True).tolist()
+  proximity_questions_all = rng.integers(0, 1, size=questions_per_file, endpoint=True).tolist() # 0 means, we create a question using clustering
+  # position of the seed source (proximity) or the cluster (clustering)
+  seeds = rng.random(questions_per_file).tolist()
+  configurations_all = create_useful_configurations(proximity_questions_all, rng)
+
   # Create randomly n questions per file
   prompts, messages, proximity_questions, configurations  = [], [], [], []
-  for i in range(questions_per_file):
-      # Create configuration quite randomly
-      if num_sources_configured == "random":
-        n_sources = random.randint(5, 15)
-      else:
-        n_sources = random.randint(num_sources_configured[0], num_sources_configured[1])
-      proximity_question = random.randint(0, 1) # false means, we create a question using clustering
-
-      # Create configuration
-      configuration = create_useful_configuration(n_sources, proximity_question)
+  for n_sources, proximity_question, u, configuration in zip(n_sources_all, proximity_questions_all, seeds, configurations_all):
       # Create prompt
-      filled_prompt, prompt_messages, raw_sources = create_question_answer_sources_prompt(configuration, report_data, n_sources, proximity_question, modules, domain)
+      filled_prompt, prompt_messages, raw_sources = create_question_answer_sources_prompt(configuration, sampler, n_sources, proximity_question, modules, domain, u, rng)
 
       # Add n_sources seen into configuration
       configuration["n_sources_seen"] = len(raw_sources)
@@ -314,14 +308,19 @@ def createRandomPrompts(report_data, questions_per_file, modules, domain, num_so
   return prompts, messages, proximity_questions, configurations
 
 async def main():
-    # openai key
-    ACLIENT = AsyncOpenAI(api_key=OPENAI_API_KEY)
+    # LLM/embedding backend, created here so that importing the stage needs no key
+    backend = create_backend(BACKEND, metrics=METRICS, **BACKEND_OPTIONS)
+    global EXECUTION_MODE
+    if EXECUTION_MODE == "batch" and backend.batch_client is None:
+        print(f"Backend {backend.name} has no Batch API, sending the requests online")
+        EXECUTION_MODE = "online"
+    METRICS.start("02_Create_Answers", port=METRICS_PORT)
     MODEL = "gpt-4.1-2025-04-14"  # "gpt-5-2025-08-07" "gpt-4o-2024-11-20" ""gpt-4.1-2025-04-14""
 
     report_type = "research articles"
 
     # take th
-    all_sources = glob.glob(f"./02_Parsed_Input_Files_to_Sources/{report_type}/*")
+    all_sources = sorted(glob.glob(f"./02_Parsed_Input_Files_to_Sources/{report_type}/*_clustered.parquet"))
     all_sources = all_sources[0:100]  # Arxiv was [0:100] and 25 questions per file
 
     # configure sources per file
@@ -334,43 +333,93 @@ async def main():
     # num sources
     num_sources_configured = [5, 15]
 
-    # not already done files
-    done_files = glob.glob(f"./03_Raw_Synthetic_Question_Answer_Data/{report_type}/*.json")
-    done_files = [i.split("\\")[-1].split("_rawQA.")[0] for i in done_files] # change to \\ for windows
-    not_done_files = [i for i in all_sources if i.split("\\")[-1].split("_clustered")[0] not in done_files]
-
-    # all_sources OR not_done_files
-    for file_path in not_done_files:
-        #try:
-            print(file_path)
-            # store results
-            outcome_dicts = []
-            report_data = pd.read_parquet(file_path)
-            # process into "table" and "text" for Arxiv
-            report_data["type"] = report_data["type"].apply(lambda x: "table" if x == "table" else "text")
-            # Go through individual files
-            prompts, messages, proximity_questions, configurations = createRandomPrompts(report_data,
-                                                                                         questions_per_file, modules,
-                                                                                         domain, num_sources_configured)
-            answers = await createAnswersDef(messages, ACLIENT, MODEL)
-            raw_answers = [answer.choices[0].message.content for answer in answers]
-
-            for i, answer in enumerate(raw_answers):
-                data_dict = post_process_answer(answer, report_data, configurations[i], proximity_questions[i])
-                # Append
-                if data_dict is not None:
-                    outcome_dicts.append(data_dict)
-
-            # store outcome dict
-            # Save to JSON file
-            # report_data_name = file_path.split("/")[-1].split("_clustered.")[0]
-            report_data_name = file_path.split("\\")[-1].split("_clustered.")[0] # for windows
-            output_file = f'03_Raw_Question_Answer_Data/{report_type}/{report_data_name}_rawQA.json'
-            with open(output_file, 'w') as f:
-                json.dump(outcome_dicts, f, indent=4)
-        #except:
-        #    print(f"ERROR for {file_path}")
-        #    continue
+    # files processed at the same time; in batch mode all of them, so their requests share one batch
+    max_files_in_flight = len(all_sources) if EXECUTION_MODE == "batch" else 4
+
+    # finished files are skipped, and redone if their input or the model changed (see pipeline/manifest.py)
+    manifest = StageManifest("manifest.sqlite", stage="02_Create_Answers", model=MODEL)
+    files_in_flight = asyncio.Semaphore(max(1, max_files_in_flight))
+
+    async def run(file_path):
+        report_data_name = document_name(file_path, "_clustered.parquet")
+        output_file = f'03_Raw_Question_Answer_Data/{report_type}/{report_data_name}_rawQA.json'
+        async with files_in_flight:
+            if not manifest.claim(report_data_name, file_path, output_file):
+                return
+            try:
+                print(file_path)
+                # every answer is appended to the checkpoint as soon as it arrives; a rerun only sends the missing slots
+                checkpoint = Checkpoint(f'03_Raw_Question_Answer_Data/{report_type}/{report_data_name}_rawQA.checkpoint.jsonl')
+
+                # text columns only, the embeddings are not needed to create questions
+                report_data = read_sources(file_path)
+                # process into "table" and "text" for Arxiv
+                report_data["type"] = report_data["type"].apply(lambda x: "table" if x == "table" else "text")
+                # lookups for the metadata of the answers, built once per file
+                source_index = SourceIndex(report_data)
+
+                # answers of another model must not be mixed into this file
+                resume = checkpoint.has_plan and checkpoint.matches(model=MODEL, domain=domain)
+                if checkpoint.has_plan and not resume:
+                    print(f"Checkpoint was written for {checkpoint.meta.get('model')}, not {MODEL}: sampling a new plan")
+
+                if not resume:
+                    # seed per file, so the sampled configurations can be reproduced
+                    seed = file_seed(report_data_name)
+                    # Go through individual files
+                    prompts, messages, proximity_questions, configurations = createRandomPrompts(report_data,
+                                                                                                 questions_per_file, modules,
+                                                                                                 domain, num_sources_configured,
+                                                                                                 np.random.default_rng(seed))
+                    checkpoint.write_plan(
+                        [{"messages": m, "configuration": c, "proximity_question": p}
+                         for m, c, p in zip(messages, configurations, proximity_questions)],
+                        seed=seed, model=MODEL, domain=domain,
+                    )
+                else:
+                    print(f"Resuming from checkpoint: {len(checkpoint.results)} of {len(checkpoint.slots)} answers done")
+
+                missing = checkpoint.missing_slots()
+
+                def store_answer(i, answer):
+                    plan = checkpoint.slots[missing[i]]
+                    try:
+                        data_dict = post_process_answer(answer.choices[0].message.content, source_index, plan["configuration"], plan["proximity_question"])
+                    except Exception as e:
+                        # e.g. cites "Source 1" or no source at all: dropped like an answer that is not JSON,
+                        # the cache would replay the same answer on every rerun
+                        print(f"Dropped the answer of slot {missing[i]}: {e!r}")
+                        data_dict = None
+                    checkpoint.append_result(missing[i], data_dict)
+
+                answers = await createAnswersDef([checkpoint.slots[slot]["messages"] for slot in missing], backend, MODEL, store_answer)
+                # slots whose request failed for good stay empty like a dropped answer, the same request would fail again
+                for i in permanent_failures(answers):
+                    checkpoint.append_result(missing[i], None)
+                # the answers that arrived are in the checkpoint, the next run only sends the failed slots
+                raise_retryable(answers)
+
+                # store outcome dict (built from the checkpoint, in slot order)
+                # Save to JSON file
+                outcome_dicts = checkpoint.completed()
+                with open(output_file, 'w') as f:
+                    json.dump(outcome_dicts, f, indent=4)
+                checkpoint.remove()
+            except Exception as e:
+                # the other files carry on, the failed one is resumed from its checkpoint on the next run
+                print(f"ERROR for {file_path}: {e!r}")
+                manifest.failed(report_data_name, repr(e))
+                return
+            manifest.done(report_data_name, output_file)
+
+    with METRICS.labels(category=report_type):
+        await asyncio.gather(*[run(file_path) for file_path in all_sources])
+    print(SCHEDULER.report())
+    print(backend.report())
+    print(manifest.summary())
+    print(METRICS.summary())
+    METRICS.close()
+    await backend.close()
 
 # run
 if __name__ == "__main__":
@@ -1,20 +1,42 @@
 import json
 import glob
-import pandas as pd
 import numpy as np
-from openai import OpenAI
-from openai import AsyncOpenAI
-from sklearn.metrics.pairwise import cosine_similarity
 import asyncio
 import sys
+from pipeline.backends import create_backend
+from pipeline.batch import BatchRunner
+from pipeline.completion_cache import CompletionCache
+from pipeline.embedding_store import EmbeddingStore
+from pipeline.embeddings import plan_embedding_batches
+from pipeline.errors import permanent_failures, raise_retryable
+from pipeline.manifest import StageManifest, document_name
+from pipeline.metrics import Metrics
+from pipeline.retry import run_with_retry
+from pipeline.scheduler import RequestScheduler
+from pipeline.vector_index import DocumentIndex
 
 # windows or not?
 if sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-# read API key
-with open("key.txt", "r", encoding="utf-8") as f:
-    OPENAI_API_KEY = f.read().strip()
+# "openai" sends requests to the OpenAI API (key.txt), "mock" to a local server with synthetic answers (pipeline/backends.py)
+BACKEND = "openai"
+# e.g. {"latency": 0.2, "error_rate": 0.01, "rate_limit_rate": 0.05} to load-test against the mock
+BACKEND_OPTIONS = {}
+# API calls and hot functions are recorded in logs/metrics.jsonl, with a summary at the end (pipeline/metrics.py)
+METRICS = Metrics("logs/metrics.jsonl")
+# e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics (Prometheus) while the stage runs
+METRICS_PORT = None
+
+# on-disk cache of completions, use mode="replay" to rerun strictly from the cache
+CACHE = CompletionCache("cache/completions.sqlite", mode="readwrite")
+# shared request scheduler (limits per model in pipeline/scheduler.py)
+SCHEDULER = RequestScheduler(max_in_flight=32, cache=CACHE, metrics=METRICS)
+# "online" sends requests through the scheduler, "batch" runs them through the Batch API (pipeline/batch.py)
+EXECUTION_MODE = "online"
+BATCHES = BatchRunner("batches/03_Quality_Filter", poll_interval=60, cache=CACHE, metrics=METRICS)
+# persistent embeddings, shared with 01_Cluster_Sources.py
+EMBEDDINGS = EmbeddingStore("cache/embeddings.sqlite", metrics=METRICS)
 
 
 g_eval_prompt = """You will be given a set of sources, a question and an answer.
@@ -96,6 +118,7 @@ Your answer:
 """
 
 # prompts
+@METRICS.timed
 def get_prompts(data_json, prompt_template, source_column="source_text", source_identifier_column="sources"):
   prompts = []
   # go through every row of the dataset
@@ -126,6 +149,7 @@ def get_prompts(data_json, prompt_template, source_column="source_text", source_
   # return
   return parsed_prompts, prompts
 
+@METRICS.timed
 def get_prompts_formal_checks(data_json, prompt_template, guidelines):
   prompts = []
   # go through every row of the dataset
@@ -154,28 +178,29 @@ def get_prompts_formal_checks(data_json, prompt_template, guidelines):
   return parsed_prompts, prompts
 
 
-# asynced creation of answers
-async def answer_async_OpenAI(prompts, MODEL, CLIENT):
+# asynced creation of answers, one answer or error per prompt
+async def answer_async_OpenAI(prompts, MODEL, backend):
+  requests = [
+    dict(model = MODEL, temperature = 0.0, seed = 23, messages = m, logprobs = True, top_logprobs=5)
+    for m in prompts
+  ]
+  if EXECUTION_MODE == "batch":
+    # one batch for all files waiting at the same time
+    return await BATCHES.run(backend.batch_client, requests, return_exceptions=True)
+
   coroutines = []
-  for m in prompts:
-    #p = "What is 100 * 44554 / 24334 + 4 - 8?"
-    co = CLIENT.chat.completions.create(
-        model = MODEL,
-        temperature = 0.0,
-        seed = 23,
-        messages = m,
-        logprobs = True,
-        top_logprobs=5,
-    )
+  for params in requests:
+    # the scheduler caps requests in flight and keeps us within the model's RPM/TPM budget
+    co = SCHEDULER.submit(backend.complete, **params)
     coroutines.append(co)
-  # Schedule calls *concurrently*:
-  out = await asyncio.gather(*coroutines)
+  # Schedule calls *concurrently*, a failed request does not cancel the others:
+  out = await asyncio.gather(*coroutines, return_exceptions=True)
   #print(L)
   return out
 
-async def createAnswersDef(prompts, CLIENT, MODEL):
-  # create answers
-  answers = await answer_async_OpenAI(prompts, MODEL, CLIENT)
+async def createAnswersDef(prompts, backend, MODEL):
+  # create answers; only the failed requests are sent again (429, 5xx, timeouts, with jittered backoff)
+  answers = await run_with_retry(lambda items: answer_async_OpenAI([prompts[i] for i in items], MODEL, backend), len(prompts))
   #print("Answers Given")
   return answers
 
@@ -184,8 +209,9 @@ def createColumns(answers):
   # top-5 token-level representations
   raw_answers, tokens, all_logprobs, logprob_first = [], [], [], []
   for answ in answers:
-    answer_local = answ.choices[0].message.content
-    raw_answers.append(answ.choices[0].message.content)
+    # a request that failed for good is kept as an invalid grade
+    answer_local = "Invalid answer" if isinstance(answ, BaseException) else answ.choices[0].message.content
+    raw_answers.append(answer_local)
     if len(answer_local) > 1:
       logprob_first.append("Invalid answer")
       all_logprobs.append("Invalid answer")
@@ -210,122 +236,148 @@ def createColumns(answers):
 
   return raw_answers, scores
 
-# Function to find top k similar entries
-def find_top_k_similar(df, question, client, model, top_k=5, column_name="embeddings_text-embedding-3-small"):
-    df = df.copy()
-    # Embed the question
-    response = client.embeddings.create(model=model, input=question)
-    question_embedding = np.array(response.data[0].embedding)
+# Embed all questions of a file in a few token-packed requests (stored embeddings are reused)
+async def embed_questions(questions, backend, model):
+  async def fetch(missing):
+    plan = plan_embedding_batches(missing, model)
+    responses = await asyncio.gather(*[
+        SCHEDULER.submit(backend.embed, model=model, input=batch) for batch in plan.batches
+    ])
+    return plan.pool([embedding for response in responses for embedding in response])
+  return await EMBEDDINGS.embed(questions, model, fetch)
+
+# Function to find top k similar entries (one matrix multiply for all questions)
+def find_top_k_similar(index, question_embeddings, exclude, top_k=5):
+    return index.top_k(question_embeddings, top_k, exclude)
 
-    # Calculate cosine similarity
-    embeddings = np.vstack(df[column_name])
-    similarities = cosine_similarity([question_embedding], embeddings).flatten()
+@METRICS.timed
+async def extend_data(data, index, backend, model, top_k=5):
+  # embed all questions at once, retrieval below is local
+  question_embeddings = await embed_questions([d["question"] for d in data], backend, model)
 
-    # Add similarities to DataFrame and sort by similarity
-    df['similarity'] = similarities
-    top_k_df = df.sort_values(by='similarity', ascending=False).head(top_k)
-    return top_k_df[['similarity'] + [col for col in df.columns if col != column_name]]
+  # search for top-k similar to question, without exisiting source identifiers
+  top_k_sources = find_top_k_similar(index, question_embeddings, [d["sources"] for d in data], top_k)
 
-def extend_data(data, df, client, model, top_k=5, column_name="embeddings_text-embedding-3-small"):
   # extend sources and source identifiers with top k entries
   for count in np.arange(0, len(data)):
     data_sub = data[count]
-    question = data_sub["question"]
-
-    # use df without exisiting source identifier
-    exisisting_si = data_sub["sources"]
-    df_sub = df.loc[~df["source_identifier"].isin(exisisting_si)]
-
-    # search for top-k similar to question
-    top_k_df = find_top_k_similar(df_sub, question, client, model, top_k, column_name)
 
     # extended lists
-    #sources_extended = data_sub["source_text"] + top_k_df["content"].tolist()
-    source_identifiers_extended = data_sub["sources"] + top_k_df["source_identifier"].tolist()
+    source_identifiers_extended = data_sub["sources"] + top_k_sources[count]
 
     # also use the surrounding sources (alternative: uses only surrounding context of raw sources)
-    source_identifiers_extended_v2 = []
-    for si in source_identifiers_extended:
-      number = int(si.split("_")[1])
-      source_identifiers_extended_v2.append(si)
-      source_identifiers_extended_v2.append(f"Source_{number+1}")
-      source_identifiers_extended_v2.append(f"Source_{number-1}")
+    rows = index.with_neighbours(source_identifiers_extended)
 
     # get all sources that have the source identifier
-    sources_extended_df = df[df["source_identifier"].isin(source_identifiers_extended_v2)].copy()
-    sources_sorted = sources_extended_df["content"].tolist()
-    source_identifiers_sorted = sources_extended_df["source_identifier"].tolist()
-
-    data_sub["source_text_extended"] = sources_sorted
-    data_sub["sources_extended"] = source_identifiers_sorted
+    data_sub["source_text_extended"] = index.contents[rows].tolist()
+    data_sub["sources_extended"] = index.source_identifiers[rows].tolist()
   return data
 
 
+async def inner_validity(data, backend, MODEL):
+    ### INNER VALIDITY: Does the question and answer make sense with respect to the sources?
+    parsed_prompts, prompts = get_prompts(data, g_eval_prompt)
+    answers = await createAnswersDef(parsed_prompts, backend, MODEL)
+    raise_retryable(answers)
+    permanent_failures(answers)
+    return createColumns(answers)
+
+async def outer_validity(data, index, backend, MODEL, embedding_model):
+    ### OUTER VALIDITY: same grading, but with the sources extended by retrieval
+    data = await extend_data(data, index, backend, embedding_model, 5)
+    parsed_prompts, prompts = get_prompts(data, g_eval_prompt, "source_text_extended", "sources_extended")
+    answers = await createAnswersDef(parsed_prompts, backend, MODEL)
+    raise_retryable(answers)
+    permanent_failures(answers)
+    return createColumns(answers)
+
+async def formality_checks(data, backend, MODEL):
+    ### FORMALITY CHECKS
+    parsed_prompts, prompts = get_prompts_formal_checks(data, formal_checks_prompt, guidelines)
+    answers = await createAnswersDef(parsed_prompts, backend, MODEL)
+    raise_retryable(answers)
+    failed = permanent_failures(answers)
+    return ["Invalid answer" if i in failed else answ.choices[0].message.content for i, answ in enumerate(answers)]
+
+async def process_file(file_path, file_name, output_file, report_type, backend, MODEL, embedding_model):
+    print(file_path)
+    data = json.load(open(file_path))
+
+    # normalized float32 matrix of the document, built once per file
+    index = DocumentIndex.from_parquet(f"./02_Parsed_Input_Files_to_Sources/{report_type}/{file_name}_clustered.parquet", "embeddings_text-embedding-3-small")
+
+    # the three checks are independent: all their prompts go into the shared scheduler at once
+    checks = await asyncio.gather(
+        inner_validity(data, backend, MODEL),
+        outer_validity(data, index, backend, MODEL, embedding_model),
+        formality_checks(data, backend, MODEL),
+        return_exceptions=True,
+    )
+    # a failed check fails the file once the others are done; their answers are in the completion cache for the rerun
+    for check in checks:
+      if isinstance(check, BaseException):
+        raise check
+    (raw_iv, scores_iv), (raw_ov, scores_ov), raw_formal = checks
+
+    # map scores to data
+    for i, d in enumerate(data):
+      d["raw_g-eval_score_IV"] = raw_iv[i]
+      d["g-eval_score_IV"] = scores_iv[i]
+      d["raw_g-eval_score_OV"] = raw_ov[i]
+      d["g-eval_score_OV"] = scores_ov[i]
+      d["formal_checks"] = raw_formal[i]
+
+    # store outcome dict
+    # Save to JSON file
+    with open(output_file, 'w') as f:
+        json.dump(data, f, indent=4)
+
+
 async def main():
-    # openai key
-    ACLIENT = AsyncOpenAI(api_key = OPENAI_API_KEY)
-    CLIENT = OpenAI(api_key= OPENAI_API_KEY)
+    # LLM/embedding backend, created here so that importing the stage needs no key
+    backend = create_backend(BACKEND, metrics=METRICS, **BACKEND_OPTIONS)
+    global EXECUTION_MODE
+    if EXECUTION_MODE == "batch" and backend.batch_client is None:
+        print(f"Backend {backend.name} has no Batch API, sending the requests online")
+        EXECUTION_MODE = "online"
+    METRICS.start("03_Quality_Filter", port=METRICS_PORT)
     MODEL = "gpt-4.1-mini-2025-04-14" # "gpt-4o-2024-08-06" # "gpt-4.1-2025-04-14"
     embedding_model = "text-embedding-3-small"
+    # files processed at the same time (requests in flight are capped by the scheduler)
+    max_files_in_flight = 8
+
+    # finished files are skipped, and redone if their input or the model changed (see pipeline/manifest.py)
+    manifest = StageManifest("manifest.sqlite", stage="03_Quality_Filter", model=MODEL)
+
+    async def run(file_path, report_type, files_in_flight):
+      file_name = document_name(file_path, "_rawQA.json")
+      output_file = f'04_Quality_Filtered_Question_Answer_Data/{report_type}/{file_name}_vfQA.json'
+      async with files_in_flight:
+        if not manifest.claim(file_name, file_path, output_file):
+          return
+        try:
+          await process_file(file_path, file_name, output_file, report_type, backend, MODEL, embedding_model)
+        except Exception as e:
+          # the other files carry on, the failed one is retried on the next run
+          print(f"ERROR for {file_path}: {e!r}")
+          manifest.failed(file_name, repr(e))
+          return
+        manifest.done(file_name, output_file)
 
     for report_type in ["research articles"]:
-      all_data = glob.glob(f"03_Raw_Question_Answer_Data/{report_type}/*.json")
-
-      # exclude those that were already done
-      # change / to \\ for windows
-      done = [x.split("\\")[-1].split("_vfQA")[0] for x in glob.glob(f"04_Quality_Filtered_Question_Answer_Data/{report_type}/*.json")]
-      not_done_all_data = [x for x in all_data if x.split("\\")[-1].split("_rawQA")[0] not in done]
-
-      # not_done_all_data or all_data
-      for file_path in not_done_all_data:
-        print(file_path)
-        data = json.load(open(file_path))
-
-        ### INNER VALIDITY: Does the question and answer make sense with respect to the sources?
-        # create prompts
-        parsed_prompts, prompts = get_prompts(data, g_eval_prompt)
-
-        # create answers
-        answers = await createAnswersDef(parsed_prompts, ACLIENT, MODEL)
-        raw_answers, scores = createColumns(answers)
-
-        # map scores to data
-        for i, d in enumerate(data):
-          d["raw_g-eval_score_IV"] = raw_answers[i]
-          d["g-eval_score_IV"] = scores[i]
-
-
-        ### OUTER VALIDITY
-        file_name = file_path.split("\\")[-1].split("_rawQA")[0] # change / to \\ for windows
-        report_data = pd.read_parquet(f"./02_Parsed_Input_Files_to_Sources/{report_type}/{file_name}_clustered.parquet")
-        # extend data
-        data = extend_data(data, report_data, CLIENT, embedding_model, 5, "embeddings_text-embedding-3-small")
-
-        # create prompts
-        parsed_prompts, prompts = get_prompts(data, g_eval_prompt, "source_text_extended", "sources_extended")
-
-        # create answers
-        answers = await createAnswersDef(parsed_prompts, ACLIENT, MODEL)
-        raw_answers, scores = createColumns(answers)
-
-        # map scores to data
-        for i, d in enumerate(data):
-          d["raw_g-eval_score_OV"] = raw_answers[i]
-          d["g-eval_score_OV"] = scores[i]
-
-        ### FORMALITY CHECKS
-        parsed_prompts, prompts = get_prompts_formal_checks(data, formal_checks_prompt, guidelines)
-        answers = await createAnswersDef(parsed_prompts, ACLIENT, MODEL)
-        raw_answers = [answ.choices[0].message.content for answ in answers]
-        for i, d in enumerate(data):
-          d["formal_checks"] = raw_answers[i]
-
-        # store outcome dict
-        # Save to JSON file
-        report_data_name = file_path.split("\\")[-1].split("_rawQA.")[0] # change / to \\ for windows
-        output_file = f'04_Quality_Filtered_Question_Answer_Data/{report_type}/{report_data_name}_vfQA.json'
-        with open(output_file, 'w') as f:
-            json.dump(data, f, indent=4)
+      all_data = sorted(glob.glob(f"03_Raw_Question_Answer_Data/{report_type}/*_rawQA.json"))
+      # in batch mode all files are in flight, so their requests share one batch
+      files_in_flight = asyncio.Semaphore(max(1, len(all_data) if EXECUTION_MODE == "batch" else max_files_in_flight))
+      with METRICS.labels(category=report_type):
+        await asyncio.gather(*[run(file_path, report_type, files_in_flight) for file_path in all_data])
+
+    print(SCHEDULER.report())
+    print(backend.report())
+    print(EMBEDDINGS.report())
+    print(manifest.summary())
+    print(METRICS.summary())
+    METRICS.close()
+    await backend.close()
 
 # run
 if __name__ == "__main__":
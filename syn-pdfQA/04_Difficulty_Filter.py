@@ -1,28 +1,57 @@
 import json
 import glob
-import pandas as pd
+import os
 import numpy as np
-from openai import AsyncOpenAI
 import asyncio
-from bs4 import BeautifulSoup
 import sys
+from pipeline.backends import create_backend
+from pipeline.batch import BatchRunner
+from pipeline.completion_cache import CompletionCache
+from pipeline.errors import CONTEXT_OVERFLOW, classify, failures, overflow_tokens, permanent_failures, raise_retryable
+from pipeline.extraction import SOURCE_SEPARATOR, TextStore
+from pipeline.grading import INVALID, g_eval_prompt, g_eval_score
+from pipeline.manifest import StageManifest, document_name
+from pipeline.metrics import Metrics
+from pipeline.retry import run_with_retry
+from pipeline.scheduler import RequestScheduler
+from pipeline.sources import read_sources
+from pipeline.tokens import context_window, count_tokens, truncate
 
 # windows or not?
 if sys.platform.startswith("win"):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
-# read API key
-with open("key.txt", "r", encoding="utf-8") as f:
-    OPENAI_API_KEY = f.read().strip()
+# "openai" sends requests to the OpenAI API (key.txt), "mock" to a local server with synthetic answers (pipeline/backends.py)
+BACKEND = "openai"
+# e.g. {"latency": 0.2, "error_rate": 0.01, "rate_limit_rate": 0.05} to load-test against the mock
+BACKEND_OPTIONS = {}
+# API calls and hot functions are recorded in logs/metrics.jsonl, with a summary at the end (pipeline/metrics.py)
+METRICS = Metrics("logs/metrics.jsonl")
+# e.g. 9100 to serve the metrics at http://127.0.0.1:9100/metrics (Prometheus) while the stage runs
+METRICS_PORT = None
+
+# on-disk cache of completions, use mode="replay" to rerun strictly from the cache
+CACHE = CompletionCache("cache/completions.sqlite", mode="readwrite")
+# shared request scheduler (limits per model in pipeline/scheduler.py)
+SCHEDULER = RequestScheduler(max_in_flight=32, cache=CACHE, metrics=METRICS)
+# "online" sends requests through the scheduler, "batch" runs them through the Batch API (pipeline/batch.py)
+EXECUTION_MODE = "online"
+BATCHES = BatchRunner("batches/04_Difficulty_Filter", poll_interval=60, cache=CACHE, metrics=METRICS)
+# extracted raw text of the input documents
+TEXTS = TextStore("cache/raw_text.sqlite")
 
 # Prompt adapted from LlamaIndex
+# The document comes first and is the same for all questions of a file, so the prompts share a
+# byte-identical prefix and provider-side prompt caching applies; the question part is appended.
 prompt_template_answering = """Your task is to answer the QUESTION with the given CONTEXT INFORMATION.
 
 CONTEXT INFORMATION:
 ---------------------
 {context_str}
 ---------------------
+"""
 
+prompt_template_question = """
 QUESTION: {query_str}
 
 Given the CONTEXT INFORMATION and not prior knowledge, answer the QUESTION.
@@ -31,6 +60,45 @@ Follow the following guideline when answering the QUESTION:
 {guideline}
 """
 
+# several questions per request (questions_per_request > 1), answered with structured output
+prompt_template_questions = """
+QUESTIONS:
+{questions}
+
+Given the CONTEXT INFORMATION and not prior knowledge, answer every QUESTION on its own.
+
+Follow the guideline given with a QUESTION when answering it, and return one answer per QUESTION id.
+"""
+
+# tokens kept free for the answer when fitting the document into the context window
+OUTPUT_RESERVE_TOKENS = 4096
+# attempts with a smaller budget when the provider still reports a context overflow
+MAX_FIT_ATTEMPTS = 3
+
+answers_format = {
+    "type": "json_schema",
+    "json_schema": {
+        "name": "answers",
+        "strict": True,
+        "schema": {
+            "type": "object",
+            "properties": {
+                "answers": {
+                    "type": "array",
+                    "items": {
+                        "type": "object",
+                        "properties": {"id": {"type": "integer"}, "answer": {"type": "string"}},
+                        "required": ["id", "answer"],
+                        "additionalProperties": False,
+                    },
+                },
+            },
+            "required": ["answers"],
+            "additionalProperties": False,
+        },
+    },
+}
+
 # guideline is derive from the question type in modules in the generation process
 guidelines = {
     "yes-no-question": "The QUESTION must be answered by stricly only a 'Yes' or 'No'.",
@@ -41,103 +109,99 @@ guidelines = {
     "open-ended-question-long": "The QUESTION must be answered by a long open-ended answer.",
 }
 
-g_eval_prompt = """You will be given a question, a proposed answer, and a ground truth answer.
-
-Your task is to rate the correctness of the proposed answer. Please make sure you read and understand these instructions carefully.
-
-Evaluation Criteria:
-Correctness (1-5) - This evaluates whether the proposed answer is factually correct based on the ground truth. Your task is to determine if the proposed answer is aligned with and entailed by the ground truth answer.
-
 
-Evaluation Steps:
-1. Read the question and ground truth answer: Understand the key facts and details provided in the ground truth answer that are relevant to the question.
-2. Compare the proposed answer to the ground truth answer: Check if the proposed answer is factually accurate, consistent, and aligned with the ground truth answer.
-3. Assign a correctness score (1-5):
-   - 1: The proposed answer is factually incorrect or contradicts the ground truth.
-   - 2: The proposed answer contains multiple factual errors or significant inaccuracies.
-   - 3: The proposed answer is partially correct but includes some factual errors or omissions.
-   - 4: The proposed answer is mostly correct with minor factual deviations.
-   - 5: The proposed answer is fully correct and strictly aligns with the ground truth.
-
-
-Question:
------
-{Question}
------
-
-Ground Truth Answer:
------
-{Ground_Truth_Answer}
------
-
-Proposed Answer:
------
-{Proposed_Answer}
------
-
-Evaluation Form (output ONLY a single score - nothing else):
-- Correctness:
-"""
-
-
-def open_raw_file(file_path, report_type, reduce_file_by=0):
-  file_name = file_path.split("/")[-1].split("_vfQA.")[0] # change to \\ from / for windows
+def raw_file_path(file_path, report_type):
+  file_name = document_name(file_path, "_vfQA.json")
   # for 10K
   if report_type == "10K":
-    report_type_file_ending = ".htm"
-    raw_file = f"01.1_Input_Files_Non_PDF/{report_type}/{file_name}{report_type_file_ending}"
-    with open(raw_file, "r", encoding="utf-8") as f:
-      html_string = f.read()
-
-    soup = BeautifulSoup(html_string, "html.parser")
-    plain_text = soup.get_text(separator=" ", strip=True)
-    return plain_text
-  # for Arxiv
-  if report_type == "Arxiv":
-    report_type_file_ending = ".tex"
-    raw_file = f"01.1_Input_Files_Non_PDF/{report_type}/{file_name}{report_type_file_ending}"
-
-    with open(raw_file, "r", encoding="utf-8") as f:
-      string = f.read()
-    return string
-
+    return f"01.1_Input_Files_Non_PDF/{report_type}/{file_name}.htm"
+  # for Arxiv (stored under "research articles")
+  if report_type == "Arxiv" or report_type == "research articles":
+    return f"01.1_Input_Files_Non_PDF/{report_type}/{file_name}.tex"
   # for Sust_reports, books
-  # since these files are so long, integrate options of reducing the file randomly if it is too long for long-context QA
   if report_type == "Sust_reports" or report_type == "books":
-    report_type_file_ending = ".parquet"
-    raw_file = f"02_Parsed_Input_Files_to_Sources/{report_type}/{file_name}_clustered{report_type_file_ending}"
-    df = pd.read_parquet(raw_file)
-    # reduce the file by 1-reduce_file_by% of entry
-    if reduce_file_by > 0:
-      df = df.sample(frac=1-reduce_file_by, random_state=42)
-      # order by source_identifier
-      df = df.sort_values(by="source_identifier")
-    string = "\n\n\n".join([str(x) for x in df.content.to_list()])
-    return string
+    return f"02_Parsed_Input_Files_to_Sources/{report_type}/{file_name}_clustered.parquet"
+  raise ValueError(f"unknown report type {report_type!r}")
+
+
+def open_raw_sources(file_path, report_type):
+  """Sources of Sust_reports and books as DataFrame (source_identifier, content); None for the raw-text formats."""
+  if report_type == "Sust_reports" or report_type == "books":
+    return read_sources(raw_file_path(file_path, report_type), columns=["source_identifier", "content"])
+  return None
+
+
+@METRICS.timed
+def open_raw_file(file_path, report_type):
+  # extracted once per document and cached on disk (see pipeline/extraction.py)
+  return TEXTS.extract(raw_file_path(file_path, report_type))
+
+
+@METRICS.timed
+def fit_document(file_path, report_type, new_data, budget, model):
+  """Document text with at most `budget` tokens of `model`.
+
+  Long Sust_reports and books are reduced to a subset of their sources: the sources cited by the
+  questions are kept first, the remaining budget is filled with randomly chosen sources (in document
+  order). The raw-text formats are truncated.
+  """
+  text = open_raw_file(file_path, report_type)
+  if count_tokens(text, model) <= budget:
+    return text
+  df = open_raw_sources(file_path, report_type)
+  if df is None:
+    print(f"Document truncated to {budget} tokens")
+    return truncate(text, budget, model)
+
+  contents = [str(x) for x in df.content.to_list()]
+  separator_tokens = count_tokens(SOURCE_SEPARATOR, model)
+  counts = np.array([count_tokens(c, model) + separator_tokens for c in contents])
+
+  cited = {s for d in new_data for s in d["sources"]}
+  is_cited = df.source_identifier.isin(cited).to_numpy()
+  rest = np.flatnonzero(~is_cited)
+  order = np.concatenate([np.flatnonzero(is_cited), np.random.default_rng(42).permutation(rest)])
+  keep = np.zeros(len(contents), dtype=bool)
+  used = 0
+  for i in order:
+    if used + counts[i] <= budget:
+      keep[i] = True
+      used += counts[i]
+  print(
+    f"Document fitted to {used} of {counts.sum()} tokens: {keep.sum()} of {len(contents)} sources, "
+    f"{(keep & is_cited).sum()} of {is_cited.sum()} cited sources"
+  )
+  return SOURCE_SEPARATOR.join([c for c, k in zip(contents, keep) if k])
 
 
 # prompts and filter
-def get_prompts_create(data_json, full_document_raw, prompt_template, answer_guidelines):
-  prompts = []
+@METRICS.timed
+def get_prompts_create(data_json, full_document_raw, prompt_template, answer_guidelines, questions_per_request=1):
   new_data = []
   # go through every row of the dataset
   for count in np.arange(0, len(data_json)):
     data_sub = data_json[count]
 
     ### ATTENTION: IMPORTANT FILTERING STEP: filter all data points that are not passing inner and outer validity filters
-    if (data_sub["raw_g-eval_score_OV"] != "5") or (data_sub["raw_g-eval_score_IV"] != "5") or (data_sub["formal_checks"] == "no"):
+    # (a check whose request failed for good in 03_Quality_Filter.py is "Invalid answer")
+    if (data_sub["raw_g-eval_score_OV"] != "5") or (data_sub["raw_g-eval_score_IV"] != "5") or (data_sub["formal_checks"] in ("no", INVALID)):
       continue
     else:
       new_data.append(data_sub)
 
-    # questions
-    question = data_sub["question"]
-    # get guideline
-    guideline = answer_guidelines[data_sub["answer_type"]]
-
-    # fill into prompt template
-    prompt = prompt_template.format(context_str=full_document_raw, query_str=question, guideline=guideline)
-    prompts.append(prompt)
+  # shared document prefix, followed by one question or a group of numbered questions
+  prefix = prompt_template.format(context_str=full_document_raw)
+  prompts = []
+  if questions_per_request == 1:
+    for data_sub in new_data:
+      prompts.append(prefix + question_prompt(data_sub, answer_guidelines))
+  else:
+    for start in range(0, len(new_data), questions_per_request):
+      group = new_data[start:start + questions_per_request]
+      questions = "\n\n".join(
+        f"[{i + 1}] {d['question']}\nGuideline: {answer_guidelines[d['answer_type']]}" for i, d in enumerate(group)
+      )
+      prompts.append(prefix + prompt_template_questions.format(questions=questions))
 
   parsed_prompts = []
   for p in prompts:
@@ -150,8 +214,53 @@ def get_prompts_create(data_json, full_document_raw, prompt_template, answer_gui
   return new_data, parsed_prompts, prompts
 
 
+def question_prompt(data_sub, answer_guidelines):
+  # guideline is derived from the answer type
+  guideline = answer_guidelines[data_sub["answer_type"]]
+  return prompt_template_question.format(query_str=data_sub["question"], guideline=guideline)
+
+
+def unpack_answers(answers, n_questions, questions_per_request):
+  """Answers per question; None for questions missing from a malformed structured answer or a failed request."""
+  if questions_per_request == 1:
+    return [None if isinstance(a, BaseException) else a.choices[0].message.content for a in answers]
+  raw_answers = [None] * n_questions
+  for g, answ in enumerate(answers):
+    start = g * questions_per_request
+    group_size = min(questions_per_request, n_questions - start)
+    if isinstance(answ, BaseException):
+      continue
+    try:
+      parsed = json.loads(answ.choices[0].message.content)["answers"]
+    except (TypeError, ValueError, KeyError):
+      continue
+    for a in parsed:
+      if isinstance(a, dict) and isinstance(a.get("id"), int) and 1 <= a["id"] <= group_size:
+        raw_answers[start + a["id"] - 1] = a.get("answer")
+  return raw_answers
+
+
+def prompt_token_report(new_data, prefix, prompts, answers, answer_guidelines, model):
+  # input tokens of the one-question-per-request layout vs. what is sent
+  prefix_tokens = count_tokens(prefix, model)
+  single = sum(prefix_tokens + count_tokens(question_prompt(d, answer_guidelines), model) for d in new_data)
+  sent = sum(prefix_tokens + count_tokens(p[len(prefix):], model) for p in prompts)
+  # prefix tokens after the first request can be served from the prompt cache; usage says how many were
+  cacheable = prefix_tokens * max(0, len(prompts) - 1)
+  cached = 0
+  for a in answers:
+    if isinstance(a, BaseException):
+      continue
+    details = getattr(a.usage, "prompt_tokens_details", None) if a.usage is not None else None
+    cached += (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+  return (
+    f"{model}: {len(new_data)} questions in {len(prompts)} requests, {sent} input tokens "
+    f"({single - sent} saved by packing), {cacheable} shared-prefix tokens cacheable, {cached} served from cache"
+  )
+
 
 # prompts and filter
+@METRICS.timed
 def get_prompts_eval(data_json, raw_ans, prompt_template):
   prompts = []
   # go through every row of the dataset
@@ -178,115 +287,177 @@ def get_prompts_eval(data_json, raw_ans, prompt_template):
   return parsed_prompts, prompts
 
 
-# asynced creation of answers
-async def answer_async_OpenAI(prompts, MODEL, CLIENT):
+# asynced creation of answers, one answer or error per prompt
+async def answer_async_OpenAI(prompts, MODEL, backend, response_format=None):
+  requests = [
+    dict(model = MODEL, temperature = 0.0, seed = 23, messages = m, logprobs = True, top_logprobs=5)
+    for m in prompts
+  ]
+  if response_format is not None:
+    for params in requests:
+      params["response_format"] = response_format
+  if EXECUTION_MODE == "batch":
+    # one batch for all files waiting at the same time
+    return await BATCHES.run(backend.batch_client, requests, return_exceptions=True)
+
   coroutines = []
-  for m in prompts:
-    #p = "What is 100 * 44554 / 24334 + 4 - 8?"
-    co = CLIENT.chat.completions.create(
-        model = MODEL,
-        temperature = 0.0,
-        seed = 23,
-        messages = m,
-        logprobs = True,
-        top_logprobs=5,
-    )
+  for params in requests:
+    # the scheduler caps requests in flight and keeps us within the model's RPM/TPM budget
+    co = SCHEDULER.submit(backend.complete, **params)
     coroutines.append(co)
-  # Schedule calls *concurrently*:
-  out = await asyncio.gather(*coroutines)
+  # Schedule calls *concurrently*, a failed request does not cancel the others:
+  out = await asyncio.gather(*coroutines, return_exceptions=True)
   #print(L)
   return out
 
-async def createAnswersDef(prompts, CLIENT, MODEL):
-  # create answers
-  answers = await answer_async_OpenAI(prompts, MODEL, CLIENT)
+async def createAnswersDef(prompts, backend, MODEL, response_format=None):
+  # create answers; only the failed requests are sent again (429, 5xx, timeouts, with jittered backoff)
+  answers = await run_with_retry(lambda items: answer_async_OpenAI([prompts[i] for i in items], MODEL, backend, response_format), len(prompts))
   #print("Answers Given")
   return answers
 
 # ANSWERING
 def createColumns(answers):
-  # top-5 token-level representations
-  raw_answers, tokens, all_logprobs, logprob_first = [], [], [], []
+  # rating and its probability-weighted score (pipeline/grading.py)
+  raw_answers, scores = [], []
   for answ in answers:
-    answer_local = answ.choices[0].message.content
-    raw_answers.append(answ.choices[0].message.content)
-    if len(answer_local) > 1:
-      logprob_first.append("Invalid answer")
-      all_logprobs.append("Invalid answer")
-      tokens.append("Invalid answer")
-      continue
+    # a grading request that failed for good is kept as an invalid grade
+    raw_answer, score = (INVALID, INVALID) if isinstance(answ, BaseException) else g_eval_score(answ)
+    raw_answers.append(raw_answer)
+    scores.append(score)
 
-    # get token-level probability
-    token_score = answ.choices[0].logprobs.content[0].token
-    all_probs_score = answ.choices[0].logprobs.content[0].top_logprobs
-    list_scores= [[x.token, np.round(np.exp(x.logprob)*100,2)] for x in all_probs_score]
-    tokens.append(all_probs_score)
-    logprob_first.append(list_scores[0][1])
-    all_logprobs.append(str(list_scores))
+  return raw_answers, scores
 
-  scores = []
-  for i, a in enumerate(raw_answers):
-    try:
-      score = float(a) * (logprob_first[i]/100)
-      scores.append(score)
-    except:
-      scores.append("Invalid answer")
 
-  return raw_answers, scores
+async def process_file(file_path, output_file, report_type, backend, MODEL_create_answer, MODEL_eval_answer, questions_per_request=1):
+    print(file_path)
+    data = json.load(open(file_path))
+
+    #### CREATE ANSWERS
+    # token budget of the document: context window minus the longest question part and the answer
+    new_data, _, question_prompts = get_prompts_create(data, "", prompt_template_answering, guidelines, questions_per_request)
+    overhead = max((count_tokens(p, MODEL_create_answer) for p in question_prompts), default=0)
+    budget = context_window(MODEL_create_answer) - OUTPUT_RESERVE_TOKENS - overhead
+    response_format = answers_format if questions_per_request > 1 else None
+
+    # answer the question
+    for attempt in range(MAX_FIT_ATTEMPTS):
+      raw_full_document = fit_document(file_path, report_type, new_data, budget, MODEL_create_answer)
+      new_data, parsed_prompts, prompts = get_prompts_create(data, raw_full_document, prompt_template_answering, guidelines, questions_per_request)
+      answers = await createAnswersDef(parsed_prompts, backend, MODEL_create_answer, response_format)
+      # only a prompt that is too long is fitted again; other failed requests fail the file below
+      overflow = {i: e for i, e in failures(answers).items() if classify(e) == CONTEXT_OVERFLOW}
+      if not overflow or attempt == MAX_FIT_ATTEMPTS - 1:
+        break
+      # the local count differs from the provider's: fit again, smaller than the document that was sent
+      # (fit_document returns it unchanged while it is within the budget) by the excess the provider
+      # reports, in local tokens
+      print(f"Context too long: {next(iter(overflow.values()))!r}")
+      sent = min(budget, count_tokens(raw_full_document, MODEL_create_answer))
+      excess = 0
+      for i, e in overflow.items():
+        reported = overflow_tokens(e)
+        if reported:
+          limit, tokens = reported
+          excess = max(excess, (tokens - limit) * count_tokens(prompts[i], MODEL_create_answer) / tokens)
+      budget = max(int(min(sent - excess, sent * 0.9)), 0)
+    # answers that arrived are in the completion cache, the rerun of the file only sends the failed ones
+    raise_retryable(answers)
+    # questions of requests that failed for good (the same request fails on every rerun) are not asked again
+    unanswered = {q for g in permanent_failures(answers)
+                  for q in range(g * questions_per_request, min((g + 1) * questions_per_request, len(new_data)))}
+    raw_answers = unpack_answers(answers, len(new_data), questions_per_request)
+
+    prefix = prompt_template_answering.format(context_str=raw_full_document)
+    print(prompt_token_report(new_data, prefix, prompts, answers, guidelines, MODEL_create_answer))
+
+    # questions missing from a malformed structured answer are asked one by one
+    missing = [i for i, a in enumerate(raw_answers) if a is None and i not in unanswered]
+    if missing:
+      single_prompts = [[{"role": "user", "content": prefix + question_prompt(new_data[i], guidelines)}] for i in missing]
+      single_answers = await createAnswersDef(single_prompts, backend, MODEL_create_answer)
+      raise_retryable(single_answers)
+      unanswered.update(missing[i] for i in permanent_failures(single_answers))
+      for i, a in zip(missing, single_answers):
+        if not isinstance(a, BaseException):
+          raw_answers[i] = a.choices[0].message.content
+
+    # questions without an answer are dropped: an invalid grade would count them as hard questions in 05_Build_Dataset.py
+    if unanswered:
+      print(f"Dropped {len(unanswered)} of {len(new_data)} questions without an answer")
+      new_data = [d for i, d in enumerate(new_data) if i not in unanswered]
+      raw_answers = [a for i, a in enumerate(raw_answers) if i not in unanswered]
+
+    ### EVALUATE ANSWERS
+    parsed_prompts_eval, prompts_eval = get_prompts_eval(new_data, raw_answers, g_eval_prompt)
+    answers_eval = await createAnswersDef(parsed_prompts_eval, backend, MODEL_eval_answer)
+    raise_retryable(answers_eval)
+    permanent_failures(answers_eval)
+    raw_answers_eval, scores = createColumns(answers_eval)
+
+    # map scores to data
+    for i, d in enumerate(new_data):
+      d[f"answer_C_{MODEL_create_answer}"] = raw_answers[i]
+      d[f"raw_g-eval_score_C_{MODEL_create_answer}"] = raw_answers_eval[i]
+      d[f"g-eval_score_C_{MODEL_create_answer}"] = scores[i]
+
+    # store outcome dict
+    # Save to JSON file
+    with open(output_file, 'w') as f:
+        json.dump(new_data, f, indent=4)
 
 
 async def main():
-    # openai key
-    ACLIENT = AsyncOpenAI(api_key = OPENAI_API_KEY)
+    # LLM/embedding backend, created here so that importing the stage needs no key
+    backend = create_backend(BACKEND, metrics=METRICS, **BACKEND_OPTIONS)
+    global EXECUTION_MODE
+    if EXECUTION_MODE == "batch" and backend.batch_client is None:
+        print(f"Backend {backend.name} has no Batch API, sending the requests online")
+        EXECUTION_MODE = "online"
+    METRICS.start("04_Difficulty_Filter", port=METRICS_PORT)
     MODEL_create_answer = "gpt-4o-mini-2024-07-18" # "gpt-4.1-mini-2025-04-14" # "gpt-4o-2024-11-20" # "gpt-4.1-2025-04-14"
     MODEL_eval_answer = "gpt-4.1-mini-2025-04-14"
+    # questions answered per request; > 1 packs them into one request with structured output
+    questions_per_request = 1
+    # processes extracting the raw text of the documents
+    extraction_workers = 8
+
+    # finished files are skipped, and redone if their input or the models changed (see pipeline/manifest.py)
+    manifest = StageManifest("manifest.sqlite", stage="04_Difficulty_Filter", model=f"{MODEL_create_answer}+{MODEL_eval_answer}")
+
+    async def run(file_path, report_type, files_in_flight):
+      report_data_name = document_name(file_path, "_vfQA.json")
+      output_file = f'05_Difficulty_Filtered_Question_Answer_Data/{report_type}/{report_data_name}_cfQA_{MODEL_create_answer}.json'
+      async with files_in_flight:
+        if not manifest.claim(report_data_name, file_path, output_file):
+          return
+        try:
+          await process_file(file_path, output_file, report_type, backend, MODEL_create_answer, MODEL_eval_answer, questions_per_request)
+        except Exception as e:
+          # the other files carry on, the failed one is retried on the next run
+          print(f"ERROR for {file_path}: {e!r}")
+          manifest.failed(report_data_name, repr(e))
+          return
+        manifest.done(report_data_name, output_file)
 
     for report_type in ["research articles"]:
-      all_data = glob.glob(f"04_Quality_Filtered_Question_Answer_Data/{report_type}/*.json")
-
-      for file_path in all_data:
-        print(file_path)
-        data = json.load(open(file_path))
-
-        #### CREATE ANSWERS
-        raw_full_document = open_raw_file(file_path, report_type)
-
-        # get prompts and new data
-        new_data, parsed_prompts, prompts = get_prompts_create(data, raw_full_document, prompt_template_answering, guidelines)
-
-        # answer the question
-        not_answered = True
-        # if document is too long, then we reduce the answer space randomly => applies to books
-        reduce_by = 0.1 # reduce long file by 10% as long as it works
-        while not_answered:
-          try:
-            answers = await createAnswersDef(parsed_prompts, ACLIENT, MODEL_create_answer)
-            raw_answers = [a.choices[0].message.content for a in answers]
-            not_answered = False
-          except:
-            print("Context too long.")
-            raw_full_document = open_raw_file(file_path, report_type, reduce_by)
-            new_data, parsed_prompts, prompts = get_prompts_create(data, raw_full_document, prompt_template_answering, guidelines)
-            reduce_by += 0.1
-
-
-        ### EVALUATE ANSWERS
-        parsed_prompts_eval, prompts_eval = get_prompts_eval(new_data, raw_answers, g_eval_prompt)
-        answers_eval = await createAnswersDef(parsed_prompts_eval, ACLIENT, MODEL_eval_answer)
-        raw_answers_eval, scores = createColumns(answers_eval)
-
-        # map scores to data
-        for i, d in enumerate(new_data):
-          d[f"answer_C_{MODEL_create_answer}"] = raw_answers[i]
-          d[f"raw_g-eval_score_C_{MODEL_create_answer}"] = raw_answers_eval[i]
-          d[f"g-eval_score_C_{MODEL_create_answer}"] = scores[i]
-
-        # store outcome dict
-        # Save to JSON file
-        report_data_name = file_path.split("\\")[-1].split("_vfQA.")[0] # change to \\ from / for windows
-        output_file = f'05_Difficulty_Filtered_Question_Answer_Data/{report_type}/{report_data_name}_cfQA_{MODEL_create_answer}.json'
-        with open(output_file, 'w') as f:
-            json.dump(new_data, f, indent=4)
+      all_data = sorted(glob.glob(f"04_Quality_Filtered_Question_Answer_Data/{report_type}/*_vfQA.json"))
+      # extract the raw documents in parallel before answering (cached from earlier runs)
+      raw_files = [raw_file_path(file_path, report_type) for file_path in all_data]
+      TEXTS.extract_many([f for f in raw_files if os.path.exists(f)], max_workers=extraction_workers)
+      # one file at a time online (every prompt carries the full document); in batch mode all files share one batch
+      max_files_in_flight = len(all_data) if EXECUTION_MODE == "batch" else 1
+      files_in_flight = asyncio.Semaphore(max(1, max_files_in_flight))
+      with METRICS.labels(category=report_type):
+        await asyncio.gather(*[run(file_path, report_type, files_in_flight) for file_path in all_data])
+
+    print(SCHEDULER.report())
+    print(backend.report())
+    print(TEXTS.report())
+    print(manifest.summary())
+    print(METRICS.summary())
+    METRICS.close()
+    await backend.close()
 
 # run
 if __name__ == "__main__":
@@ -0,0 +1,53 @@
+import glob
+from pipeline.dataset import DatasetBuilder
+from pipeline.manifest import StageManifest, document_name
+
+
+def keep_question(item, MODEL_create_answer, max_score):
+  # questions the model answers with at least max_score are too easy
+  if max_score is None:
+    return True
+  score = item.get(f"g-eval_score_C_{MODEL_create_answer}")
+  return not isinstance(score, (int, float)) or score < max_score
+
+
+def main():
+    # model whose answers were graded in 04_Difficulty_Filter.py
+    MODEL_create_answer = "gpt-4o-mini-2024-07-18"
+    # difficulty threshold on the g-eval score of the model's answer, None keeps every question
+    max_score = None
+
+    # partitioned dataset (file_type / answer_type), documents are added incrementally
+    builder = DatasetBuilder("06_Dataset/partitions")
+    output_file = "06_Dataset/syn-pdfQA.parquet"
+
+    # documents are added again when their stage 04 output, the model or the threshold changed
+    manifest = StageManifest("manifest.sqlite", stage="05_Build_Dataset", model=f"{MODEL_create_answer};max_score={max_score}")
+
+    for report_type in ["research articles"]:
+      all_data = sorted(glob.glob(f"05_Difficulty_Filtered_Question_Answer_Data/{report_type}/*_cfQA_{MODEL_create_answer}.json"))
+
+      for file_path in all_data:
+        report_data_name = document_name(file_path, f"_cfQA_{MODEL_create_answer}.json")
+        # the same document name can occur in several report types
+        document = f"{report_type}/{report_data_name}"
+        if not manifest.claim(document, file_path):
+          continue
+        try:
+          n_rows = builder.add_document(file_path, report_type, report_data_name,
+                                        keep=lambda item: keep_question(item, MODEL_create_answer, max_score))
+        except Exception as e:
+          print(f"ERROR for {file_path}: {e!r}")
+          manifest.failed(document, repr(e))
+          continue
+        manifest.done(document, builder.root)
+        print(f"{file_path}: {n_rows} QA pairs")
+
+    # single-file release format, streamed from the partitions
+    n_rows = builder.consolidate(output_file)
+    print(f"{n_rows} QA pairs written to {output_file}")
+    print(manifest.summary())
+
+# run
+if __name__ == "__main__":
+    main()
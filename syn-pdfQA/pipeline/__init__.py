@@ -0,0 +1,6 @@
+"""Shared helpers for the syn-pdfQA generation and filtering stages.
+
+The numbered stage scripts (01_Cluster_Sources.py ... 04_Difficulty_Filter.py)
+are run from the syn-pdfQA folder and import the modules of this package
+directly, e.g. ``from pipeline.scheduler import RequestScheduler``.
+"""
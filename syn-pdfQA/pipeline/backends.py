@@ -0,0 +1,149 @@
+"""LLM and embedding backends of the stages.
+
+The stages call a backend instead of an ``AsyncOpenAI`` client they build at
+import time from ``key.txt``:
+
+    complete(**params)      chat completion (the keyword arguments of ``chat.completions.create``)
+    embed(input, model)     one embedding per input text
+    batch_client            client with the Files and Batches endpoints, for pipeline/batch.py
+                            (None if the backend has no Batch API: the stages then run online)
+
+``OpenAIBackend`` talks to the OpenAI API (or any server that speaks it, via
+``base_url``); the key is read from ``key.txt`` only when the backend is
+created. ``MockBackend`` is an ``OpenAIBackend`` against an in-process
+``MockServer`` (pipeline/mock_server.py), so requests still go through the
+OpenAI client, its retries and HTTP, but nothing leaves the machine. Batches
+run through ``LocalBatchClient`` there.
+
+With ``metrics`` (pipeline/metrics.py) every call is recorded with its tokens,
+latency and the retries of the OpenAI client.
+
+Usage:
+    BACKEND = "openai"  # or "mock"
+    backend = create_backend(BACKEND)
+    response = await SCHEDULER.submit(backend.complete, model=MODEL, messages=m)
+"""
+from __future__ import annotations
+
+import os
+import time
+from abc import ABC, abstractmethod
+from typing import TYPE_CHECKING, Any, List, Optional
+
+from openai import APIConnectionError, AsyncOpenAI, InternalServerError, RateLimitError
+from openai.types.chat import ChatCompletion
+
+from pipeline.batch import LocalBatchClient
+from pipeline.mock_server import MockServer
+
+if TYPE_CHECKING:
+    from pipeline.metrics import Metrics
+
+# errors the OpenAI client retries by itself (max_retries)
+CLIENT_RETRIED = (APIConnectionError, RateLimitError, InternalServerError)
+
+
+def read_api_key(path: str = "key.txt") -> str:
+    with open(path, "r", encoding="utf-8") as f:
+        return f.read().strip()
+
+
+class Backend(ABC):
+    """Interface of the LLM and embedding calls of the stages."""
+
+    name = "backend"
+
+    @abstractmethod
+    async def complete(self, **params: Any) -> ChatCompletion:
+        ...
+
+    @abstractmethod
+    async def embed(self, input: List[str], model: str, **params: Any) -> List[List[float]]:
+        ...
+
+    @property
+    def batch_client(self) -> Any:
+        """Client for pipeline/batch.py, None without a Batch API."""
+        return None
+
+    def report(self) -> str:
+        return f"backend: {self.name}"
+
+    async def close(self) -> None:
+        pass
+
+
+class OpenAIBackend(Backend):
+    name = "openai"
+
+    def __init__(self, api_key: Optional[str] = None, base_url: Optional[str] = None, key_path: str = "key.txt",
+                 max_retries: int = 2, timeout: Optional[float] = None, client: Optional[AsyncOpenAI] = None,
+                 metrics: Optional[Metrics] = None) -> None:
+        if client is None:
+            options = {} if timeout is None else {"timeout": timeout}
+            client = AsyncOpenAI(api_key=api_key or read_api_key(key_path), base_url=base_url,
+                                 max_retries=max_retries, **options)
+        self.client = client
+        self.metrics = metrics
+
+    async def _call(self, kind: str, create: Any, **params: Any) -> Any:
+        # the raw response tells how often the client retried
+        start = time.perf_counter()
+        try:
+            raw = await create(**params)
+        except Exception as e:
+            if self.metrics is not None:
+                # errors the client retries have used up all retries when they get here
+                retries = self.client.max_retries if isinstance(e, CLIENT_RETRIED) else 0
+                self.metrics.call(kind, params["model"], seconds=time.perf_counter() - start, retries=retries, error=repr(e))
+            raise
+        response = raw.parse()
+        if self.metrics is not None:
+            self.metrics.call(kind, params["model"], response.usage, time.perf_counter() - start, raw.retries_taken)
+        return response
+
+    async def complete(self, **params: Any) -> ChatCompletion:
+        return await self._call("chat", self.client.chat.completions.with_raw_response.create, **params)
+
+    async def embed(self, input: List[str], model: str, **params: Any) -> List[List[float]]:
+        response = await self._call("embedding", self.client.embeddings.with_raw_response.create, input=input, model=model, **params)
+        return [item.embedding for item in response.data]
+
+    @property
+    def batch_client(self) -> Any:
+        return self.client
+
+    async def close(self) -> None:
+        await self.client.close()
+
+
+class MockBackend(OpenAIBackend):
+    name = "mock"
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, rate_limit_rate: float = 0.0, seed: int = 0,
+                 max_retries: int = 2, batch_dir: str = os.path.join("batches", "mock"), metrics: Optional[Metrics] = None) -> None:
+        self.server = MockServer(latency=latency, error_rate=error_rate, rate_limit_rate=rate_limit_rate, seed=seed)
+        super().__init__(api_key="mock", base_url=self.server.start(), max_retries=max_retries, metrics=metrics)
+        # batched requests are recorded by the BatchRunner, not as online calls
+        self._batch_client = LocalBatchClient(batch_dir, lambda body: self.client.chat.completions.create(**body))
+
+    @property
+    def batch_client(self) -> Any:
+        return self._batch_client
+
+    def report(self) -> str:
+        return f"backend: {self.name} at {self.server.base_url}, {self.server.report()}"
+
+    async def close(self) -> None:
+        await super().close()
+        self.server.stop()
+
+
+BACKENDS = {"openai": OpenAIBackend, "mock": MockBackend}
+
+
+def create_backend(name: str = "openai", **options: Any) -> Backend:
+    """Backend by name; ``options`` go to its constructor (e.g. ``latency`` and ``error_rate`` of the mock)."""
+    if name not in BACKENDS:
+        raise ValueError(f"unknown backend {name!r}, choose from {sorted(BACKENDS)}")
+    return BACKENDS[name](**options)
@@ -0,0 +1,299 @@
+"""Offline execution of chat completions through the OpenAI Batch API.
+
+Benchmark generation is throughput-bound, not latency-sensitive, so a stage
+can run its requests at batch-tier cost instead of holding connections open.
+``BatchRunner.run`` has the same contract as gathering ``SCHEDULER.submit``
+calls: it returns the ``ChatCompletion`` objects in input order, so
+``post_process_answer``, ``createColumns`` and the rest of a stage work
+unchanged.
+
+Requests of all files that call ``run`` within ``collect_seconds`` of each
+other go into one JSONL batch file (a whole category when the stage runs its
+files concurrently), which is uploaded, submitted and polled until it
+finishes. Every request carries its cache key as ``custom_id``. The submitted
+batches and their keys are kept in ``workdir/batches.json`` (one workdir per
+stage): a stage that is restarted while batches are running waits for those
+instead of submitting the requests again. Finished responses go to the
+completion cache as soon as their batch is collected.
+
+``LocalBatchClient`` is a file-based stand-in for the Files and Batches
+endpoints of ``AsyncOpenAI``. It answers every request with an async
+``respond(body)`` callable, e.g. a mock client.
+"""
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import time
+import types
+import uuid
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional
+
+from openai.types.chat import ChatCompletion
+
+from pipeline.completion_cache import CompletionCache, request_key
+
+if TYPE_CHECKING:
+    from pipeline.metrics import Metrics
+
+ENDPOINT = "/v1/chat/completions"
+FINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+class BatchError(RuntimeError):
+    """Raised for requests that a finished batch returned no response for.
+
+    ``status_code`` and ``code`` are those of the request's error response, like on
+    the errors of online requests; both are None when the batch expired or failed
+    before it got to the request.
+    """
+
+    def __init__(self, message: str, status_code: Optional[int] = None, code: Optional[str] = None) -> None:
+        super().__init__(message)
+        self.status_code = status_code
+        self.code = code
+
+
+class BatchRunner:
+    def __init__(self, workdir: str = "batches", poll_interval: float = 60.0, collect_seconds: float = 5.0,
+                 cache: Optional[CompletionCache] = None, metrics: Optional[Metrics] = None) -> None:
+        self.workdir = workdir
+        self.poll_interval = poll_interval
+        self.collect_seconds = collect_seconds
+        self.cache = cache
+        self.metrics = metrics
+        self.state_path = os.path.join(workdir, "batches.json")
+        os.makedirs(workdir, exist_ok=True)
+        # batch id -> {"status", "submitted", "keys": [...]}
+        self.state: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(self.state_path):
+            with open(self.state_path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+        # request key -> future of its response, kept after success so late callers find it
+        self._futures: Dict[str, asyncio.Future] = {}
+        self._pending: Dict[str, Dict[str, Any]] = {}
+        self._flush: Optional[asyncio.Task] = None
+        self._polls: Dict[str, asyncio.Task] = {}
+
+    def _save_state(self) -> None:
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _future(self, key: str) -> asyncio.Future:
+        if key not in self._futures:
+            self._futures[key] = asyncio.get_running_loop().create_future()
+        return self._futures[key]
+
+    async def run(self, client: Any, requests: List[Dict[str, Any]], return_exceptions: bool = False) -> List[Any]:
+        """Run chat completion requests (dicts of keyword arguments) through the Batch API.
+
+        With ``return_exceptions`` the errors of failed requests are returned in their
+        place (like ``asyncio.gather``) instead of raising the first one.
+        """
+        start = time.perf_counter()
+        # batches submitted by an earlier run are polled again
+        for batch_id, batch in self.state.items():
+            if batch_id not in self._polls:
+                for key in batch["keys"]:
+                    self._future(key)
+                self._polls[batch_id] = asyncio.create_task(self._poll(client, batch_id))
+
+        waiting = []
+        for params in requests:
+            cached = self.cache.get(params) if self.cache is not None else None
+            if cached is not None:
+                waiting.append(cached)
+                continue
+            key = request_key(params)
+            if key not in self._futures:
+                self._pending[key] = params
+            waiting.append(self._future(key))
+        if self._pending and self._flush is None:
+            self._flush = asyncio.create_task(self._submit(client))
+
+        results = await asyncio.gather(
+            *[w for w in waiting if isinstance(w, asyncio.Future)], return_exceptions=True
+        )
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors and not return_exceptions:
+            raise errors[0]
+        results = iter(results)
+        answers = []
+        seconds = time.perf_counter() - start
+        for params, w in zip(requests, waiting):
+            fresh = isinstance(w, asyncio.Future)
+            if fresh:
+                # the response went to the cache when its batch finished
+                w = next(results)
+                if isinstance(w, BaseException):
+                    answers.append(w)
+                    continue
+            if self.metrics is not None:
+                # latency of a batched request is the turnaround of its batch
+                self.metrics.call("chat", params["model"], w.usage, seconds if fresh else 0.0, cached=not fresh, batch=fresh)
+            answers.append(w)
+        return answers
+
+    async def _submit(self, client: Any) -> None:
+        # wait until no further requests arrive, then send them as one batch
+        n = -1
+        while n != len(self._pending):
+            n = len(self._pending)
+            await asyncio.sleep(self.collect_seconds)
+        pending, self._pending, self._flush = self._pending, {}, None
+
+        input_path = os.path.join(self.workdir, f"input-{int(time.time())}-{uuid.uuid4().hex[:8]}.jsonl")
+        with open(input_path, "w", encoding="utf-8") as f:
+            for key, params in pending.items():
+                f.write(json.dumps({"custom_id": key, "method": "POST", "url": ENDPOINT, "body": params}) + "\n")
+        try:
+            with open(input_path, "rb") as f:
+                uploaded = await client.files.create(file=f, purpose="batch")
+            batch = await client.batches.create(input_file_id=uploaded.id, endpoint=ENDPOINT, completion_window="24h")
+        except Exception as e:
+            for key in pending:
+                self._futures.pop(key).set_exception(e)
+            return
+        self.state[batch.id] = {"status": batch.status, "submitted": time.time(), "keys": list(pending)}
+        self._save_state()
+        print(f"Submitted batch {batch.id} with {len(pending)} requests")
+        self._polls[batch.id] = asyncio.create_task(self._poll(client, batch.id))
+
+    async def _poll(self, client: Any, batch_id: str) -> None:
+        keys = self.state[batch_id]["keys"]
+        try:
+            while True:
+                batch = await client.batches.retrieve(batch_id)
+                if batch.status != self.state[batch_id]["status"]:
+                    self.state[batch_id]["status"] = batch.status
+                    self._save_state()
+                if batch.status in FINAL_STATUSES:
+                    break
+                await asyncio.sleep(self.poll_interval)
+
+            responses, errors = {}, {}
+            for file_id in (batch.output_file_id, getattr(batch, "error_file_id", None)):
+                if not file_id:
+                    continue
+                content = await client.files.content(file_id)
+                for line in content.text.splitlines():
+                    if not line.strip():
+                        continue
+                    record = json.loads(line)
+                    response = record.get("response") or {}
+                    if response.get("status_code") == 200:
+                        responses[record["custom_id"]] = ChatCompletion.model_validate(response["body"])
+                    else:
+                        body = response.get("body") or {}
+                        errors[record["custom_id"]] = (response.get("status_code"), record.get("error") or body.get("error") or body)
+        except Exception as e:
+            # the batch stays in the state and is polled again by the next run
+            del self._polls[batch_id]
+            for key in keys:
+                future = self._futures.pop(key, None)
+                if future is not None and not future.done():
+                    future.set_exception(e)
+            return
+
+        for key in keys:
+            # the custom_id is the cache key, so the responses of batches that an earlier
+            # run submitted are kept even if no caller is waiting for them anymore
+            if key in responses and self.cache is not None:
+                self.cache.store(key, responses[key].model, responses[key])
+            future = self._futures[key]
+            if future.done():
+                continue
+            if key in responses:
+                future.set_result(responses[key])
+            else:
+                # failed requests are submitted again when they are requested again
+                del self._futures[key]
+                status_code, error = errors.get(key, (None, None))
+                code = error.get("code") if isinstance(error, dict) else None
+                future.set_exception(BatchError(
+                    f"batch {batch_id} ({batch.status}) returned no response for request {key[:12]}: {error}",
+                    status_code, code,
+                ))
+        del self.state[batch_id]
+        self._save_state()
+
+
+class LocalBatchClient:
+    """File-based stand-in for ``client.files`` and ``client.batches`` of AsyncOpenAI.
+
+    A batch is processed on its second ``retrieve`` (the first one reports it as
+    in progress); ``respond`` receives the request body and returns a chat
+    completion, either as an object with ``model_dump`` or as a dict.
+    """
+
+    def __init__(self, root: str, respond: Callable[[Dict[str, Any]], Awaitable[Any]]) -> None:
+        self.root = root
+        self.respond = respond
+        os.makedirs(root, exist_ok=True)
+        self.files = types.SimpleNamespace(create=self._create_file, content=self._file_content)
+        self.batches = types.SimpleNamespace(create=self._create_batch, retrieve=self._retrieve_batch)
+
+    def _path(self, object_id: str) -> str:
+        return os.path.join(self.root, object_id)
+
+    def _write_batch(self, batch: types.SimpleNamespace) -> None:
+        with open(self._path(batch.id), "w", encoding="utf-8") as f:
+            json.dump(vars(batch), f)
+
+    async def _create_file(self, file: Any, purpose: str) -> types.SimpleNamespace:
+        file_id = f"file-{uuid.uuid4().hex}"
+        with open(self._path(file_id), "wb") as f:
+            f.write(file.read())
+        return types.SimpleNamespace(id=file_id, purpose=purpose)
+
+    async def _file_content(self, file_id: str) -> types.SimpleNamespace:
+        with open(self._path(file_id), "r", encoding="utf-8") as f:
+            return types.SimpleNamespace(text=f.read())
+
+    async def _create_batch(self, input_file_id: str, endpoint: str, completion_window: str) -> types.SimpleNamespace:
+        batch = types.SimpleNamespace(
+            id=f"batch-{uuid.uuid4().hex}", status="validating", input_file_id=input_file_id,
+            endpoint=endpoint, output_file_id=None, error_file_id=None,
+        )
+        self._write_batch(batch)
+        return batch
+
+    async def _retrieve_batch(self, batch_id: str) -> types.SimpleNamespace:
+        with open(self._path(batch_id), "r", encoding="utf-8") as f:
+            batch = types.SimpleNamespace(**json.load(f))
+        if batch.status == "validating":
+            batch.status = "in_progress"
+            self._write_batch(batch)
+        elif batch.status == "in_progress":
+            await self._process(batch)
+        return batch
+
+    async def _process(self, batch: types.SimpleNamespace) -> None:
+        content = await self._file_content(batch.input_file_id)
+        output, errors = [], []
+        for line in content.text.splitlines():
+            request = json.loads(line)
+            try:
+                response = await self.respond(request["body"])
+                body = response.model_dump() if hasattr(response, "model_dump") else response
+                output.append({"custom_id": request["custom_id"], "response": {"status_code": 200, "body": body}, "error": None})
+            except Exception as e:
+                # errors with a status code are error responses of the API, the rest failed before it
+                status_code = getattr(e, "status_code", None)
+                error = {"message": repr(e), "code": getattr(e, "code", None)}
+                if status_code is None:
+                    errors.append({"custom_id": request["custom_id"], "response": None, "error": error})
+                else:
+                    response = {"status_code": status_code, "body": {"error": error}}
+                    errors.append({"custom_id": request["custom_id"], "response": response, "error": None})
+        for name, lines in (("output_file_id", output), ("error_file_id", errors)):
+            if lines:
+                file_id = f"file-{uuid.uuid4().hex}"
+                with open(self._path(file_id), "w", encoding="utf-8") as f:
+                    f.write("".join(json.dumps(line) + "\n" for line in lines))
+                setattr(batch, name, file_id)
+        batch.status = "completed"
+        self._write_batch(batch)
@@ -0,0 +1,304 @@
+"""Offline benchmark harness: run a RAG system over real-pdfQA or syn-pdfQA and grade its answers.
+
+A system is an async callable ``system(question, sources) -> answer``. ``question``
+is the row of the QA file (question, file_type, file_name, ...) and ``sources``
+the parsed sources of the matching document in ``02_Parsed_Input_Files_to_Sources``
+(``None`` if the document is not on disk). Questions are streamed from the
+parquet file in record batches and answered by ``concurrency`` workers. Each
+document is read once and shared by the questions in flight. Answers are
+graded with the G-Eval correctness prompt of stage 04 (pipeline/grading.py).
+
+The report gives the accuracy (rating >= ``correct_rating``) and the mean
+score by answer type, difficulty and modality, plus QPS and the p50/p95
+latency of the system. real-pdfQA has no answer type, difficulty or modality
+columns; they are reported as "n/a".
+
+``LocalJudge`` and ``lexical_system`` are local stand-ins for the grader model
+and a RAG system, so the harness runs without any API:
+
+    harness = BenchmarkHarness("../syn-pdfQA.parquet", "02_Parsed_Input_Files_to_Sources", LocalJudge(), "local-judge")
+    report = await harness.run(lexical_system)
+    print(report.summary())
+"""
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import time
+import types
+from collections import Counter, OrderedDict
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, Iterator, List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from openai.types.chat import ChatCompletion
+
+from pipeline.dataset import FILE_TYPES
+from pipeline.grading import INVALID, g_eval_messages, g_eval_request, g_eval_score
+from pipeline.sources import read_sources
+
+if TYPE_CHECKING:
+    from pipeline.scheduler import RequestScheduler
+
+# real-pdfQA names the file type "dataset"
+QUESTION_COLUMNS = ("file_type", "dataset", "file_name", "question", "answer", "answer_type", "question_difficulty", "modalities")
+GROUPS = ("answer_type", "question_difficulty", "modalities")
+MISSING = "n/a"
+
+System = Callable[[Dict[str, Any], Optional[pd.DataFrame]], Awaitable[str]]
+
+
+def iter_questions(path: str, batch_size: int = 256, limit: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Rows of a QA parquet file, read batch by batch with only the columns the harness needs."""
+    parquet = pq.ParquetFile(path)
+    columns = [c for c in QUESTION_COLUMNS if c in parquet.schema_arrow.names]
+    n = 0
+    for batch in parquet.iter_batches(batch_size=batch_size, columns=columns):
+        for row in batch.to_pylist():
+            if "dataset" in row:
+                row["file_type"] = row.pop("dataset")
+            yield row
+            n += 1
+            if limit is not None and n >= limit:
+                return
+
+
+def source_folders(file_type: str) -> List[str]:
+    # folders of the stages that map to a release file type, e.g. "financial reports" -> "10K"
+    return [file_type] + [folder for folder, release in FILE_TYPES.items() if release == file_type and folder != file_type]
+
+
+class DocumentStore:
+    """Parsed sources of the benchmark documents, read in a thread and kept for the last ``max_documents``."""
+
+    def __init__(self, root: str, max_documents: int = 32) -> None:
+        self.root = root
+        self.max_documents = max_documents
+        self._documents: "OrderedDict[tuple, asyncio.Future]" = OrderedDict()
+
+    def path(self, file_type: str, file_name: str) -> Optional[str]:
+        for folder in source_folders(file_type):
+            path = os.path.join(self.root, folder, f"{file_name}_clustered.parquet")
+            if os.path.exists(path):
+                return path
+        return None
+
+    def _read(self, file_type: str, file_name: str) -> Optional[pd.DataFrame]:
+        path = self.path(file_type, file_name)
+        return None if path is None else read_sources(path)
+
+    async def get(self, file_type: str, file_name: str) -> Optional[pd.DataFrame]:
+        key = (file_type, file_name)
+        if key in self._documents:
+            self._documents.move_to_end(key)
+        else:
+            # questions of the same document wait for the same read
+            self._documents[key] = asyncio.ensure_future(asyncio.to_thread(self._read, file_type, file_name))
+            while len(self._documents) > self.max_documents:
+                self._documents.popitem(last=False)
+        return await self._documents[key]
+
+
+class BenchmarkReport:
+    def __init__(self, results: List[Dict[str, Any]], seconds: float, correct_rating: int = 4) -> None:
+        self.results = results
+        self.seconds = seconds
+        self.correct_rating = correct_rating
+
+    def correct(self, result: Dict[str, Any]) -> bool:
+        rating = result.get("rating")
+        return isinstance(rating, str) and rating.isdigit() and int(rating) >= self.correct_rating
+
+    @property
+    def qps(self) -> float:
+        return len(self.results) / self.seconds if self.seconds else 0.0
+
+    def latency(self, percentile: float) -> float:
+        latencies = [r["latency"] for r in self.results if r.get("latency") is not None]
+        return float(np.percentile(latencies, percentile)) if latencies else 0.0
+
+    def _line(self, name: str, results: List[Dict[str, Any]]) -> str:
+        scores = [r["score"] for r in results if isinstance(r.get("score"), float)]
+        accuracy = sum(self.correct(r) for r in results) / len(results)
+        mean_score = f"{np.mean(scores):.2f}" if scores else MISSING
+        return f"  {name:<28} {len(results):>6} {accuracy:>9.1%} {mean_score:>10}"
+
+    def breakdown(self, column: str) -> List[str]:
+        groups: Dict[str, List[Dict[str, Any]]] = {}
+        for r in self.results:
+            groups.setdefault(r.get(column) or MISSING, []).append(r)
+        return [self._line(name, groups[name]) for name in sorted(groups)]
+
+    def summary(self) -> str:
+        if not self.results:
+            return "no questions answered"
+        errors = Counter(r["error"].split("(")[0] for r in self.results if r.get("error"))
+        invalid = sum(r.get("score") == INVALID for r in self.results)
+        lines = [
+            f"{len(self.results)} questions in {self.seconds:.1f}s ({self.qps:.2f} QPS), "
+            f"system latency p50 {self.latency(50):.3f}s / p95 {self.latency(95):.3f}s",
+            f"accuracy = share of G-Eval ratings >= {self.correct_rating}; "
+            f"{invalid} invalid ratings, {sum(errors.values())} errors {dict(errors) if errors else ''}".rstrip(),
+            f"  {'':<28} {'n':>6} {'accuracy':>9} {'mean score':>10}",
+            self._line("all", self.results),
+        ]
+        for column in GROUPS:
+            lines.append(f"{column}:")
+            lines.extend(self.breakdown(column))
+        return "\n".join(lines)
+
+
+class BenchmarkHarness:
+    def __init__(
+        self,
+        qa_path: str,
+        sources_root: str,
+        grader: Any,
+        grader_model: str,
+        concurrency: int = 16,
+        scheduler: Optional[RequestScheduler] = None,
+        batch_size: int = 256,
+        limit: Optional[int] = None,
+        correct_rating: int = 4,
+        max_documents: int = 32,
+    ) -> None:
+        self.qa_path = qa_path
+        self.documents = DocumentStore(sources_root, max_documents)
+        self.grader = grader
+        self.grader_model = grader_model
+        self.concurrency = concurrency
+        self.scheduler = scheduler
+        self.batch_size = batch_size
+        self.limit = limit
+        self.correct_rating = correct_rating
+
+    async def grade(self, question: Dict[str, Any], proposed: str) -> Dict[str, Any]:
+        params = g_eval_request(g_eval_messages(question["question"], question["answer"], proposed), self.grader_model)
+        if self.scheduler is not None:
+            completion = await self.scheduler.submit(self.grader.chat.completions.create, **params)
+        else:
+            completion = await self.grader.chat.completions.create(**params)
+        rating, score = g_eval_score(completion)
+        return {"rating": rating, "score": score}
+
+    async def answer(self, system: System, question: Dict[str, Any]) -> Dict[str, Any]:
+        result = {key: question.get(key) for key in ("file_type", "file_name", "question", "answer") + GROUPS}
+        result.update(proposed=None, rating=None, score=None, latency=None, error=None)
+        try:
+            sources = await self.documents.get(question["file_type"], question["file_name"])
+            start = time.perf_counter()
+            result["proposed"] = await system(question, sources)
+            result["latency"] = time.perf_counter() - start
+            result.update(await self.grade(question, result["proposed"]))
+        except Exception as e:
+            # a failed question counts as wrong, the run carries on
+            result["error"] = repr(e)
+        return result
+
+    async def run(self, system: System, output_path: Optional[str] = None) -> BenchmarkReport:
+        """Answer and grade all questions; per-question results are written as JSONL to ``output_path``."""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=2 * self.concurrency)
+        results: List[Dict[str, Any]] = []
+        output = None
+        if output_path is not None:
+            os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+            output = open(output_path, "w", encoding="utf-8")
+
+        async def worker() -> None:
+            while True:
+                question = await queue.get()
+                if question is None:
+                    return
+                result = await self.answer(system, question)
+                results.append(result)
+                if output is not None:
+                    output.write(json.dumps(result) + "\n")
+
+        start = time.perf_counter()
+        workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+        try:
+            # the bounded queue keeps only a few batches of questions in memory
+            for question in iter_questions(self.qa_path, self.batch_size, self.limit):
+                await queue.put(question)
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
+            if output is not None:
+                output.close()
+        return BenchmarkReport(results, time.perf_counter() - start, self.correct_rating)
+
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"\w+", str(text).lower())
+
+
+def _section(prompt: str, title: str) -> str:
+    # text between "<title>:\n-----\n" and the next "\n-----" of the G-Eval prompt
+    match = re.search(re.escape(title) + r":\n-----\n(.*?)\n-----", prompt, re.S)
+    return match.group(1) if match else ""
+
+
+class LocalJudge:
+    """Stand-in for the grader model: rates the token-F1 overlap of proposed and ground truth answer.
+
+    Has the ``chat.completions.create`` interface of ``AsyncOpenAI`` and returns a
+    ``ChatCompletion`` with a single-token rating and its logprobs, so it goes
+    through the same ``g_eval_score`` as the answers of the real grader.
+    """
+
+    def __init__(self, latency: float = 0.0) -> None:
+        self.latency = latency
+        self.chat = types.SimpleNamespace(completions=types.SimpleNamespace(create=self.create))
+
+    @staticmethod
+    def f1(proposed: str, ground_truth: str) -> float:
+        proposed_words, truth_words = Counter(_words(proposed)), Counter(_words(ground_truth))
+        overlap = sum((proposed_words & truth_words).values())
+        if not overlap:
+            return 0.0
+        precision = overlap / sum(proposed_words.values())
+        recall = overlap / sum(truth_words.values())
+        return 2 * precision * recall / (precision + recall)
+
+    async def create(self, model: str, messages: List[Dict[str, str]], **params: Any) -> ChatCompletion:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        prompt = messages[-1]["content"]
+        grade = 4 * self.f1(_section(prompt, "Proposed Answer"), _section(prompt, "Ground Truth Answer"))
+        rating = str(1 + round(grade))
+        # less certain between two ratings
+        logprob = math.log(1 - abs(grade - round(grade)))
+        token = {"token": rating, "logprob": logprob, "bytes": list(rating.encode()), "top_logprobs": [
+            {"token": rating, "logprob": logprob, "bytes": list(rating.encode())}
+        ]}
+        return ChatCompletion.model_validate({
+            "id": f"local-{hashlib.sha256(prompt.encode()).hexdigest()[:16]}",
+            "object": "chat.completion",
+            "created": 0,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "finish_reason": "stop",
+                "message": {"role": "assistant", "content": rating},
+                "logprobs": {"content": [token]},
+            }],
+            "usage": {"prompt_tokens": len(prompt) // 4, "completion_tokens": 1, "total_tokens": len(prompt) // 4 + 1},
+        })
+
+
+async def lexical_system(question: Dict[str, Any], sources: Optional[pd.DataFrame], max_words: int = 50) -> str:
+    """Stand-in RAG system: answers with the start of the source sharing the most words with the question."""
+    if sources is None or sources.empty:
+        return ""
+    words = set(_words(question["question"]))
+    texts = sources.text_only.astype(str).to_list() if "text_only" in sources else sources.content.astype(str).to_list()
+    best = max(range(len(texts)), key=lambda i: len(words.intersection(_words(texts[i]))))
+    return " ".join(texts[best].split()[:max_words])
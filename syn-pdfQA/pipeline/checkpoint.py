@@ -0,0 +1,87 @@
+"""Crash-safe JSONL checkpoints for per-file generation.
+
+A checkpoint holds the sampled plan of a file (one line per slot: its
+configuration and prompt) followed by one line per finished slot. The plan is
+written atomically before any request is sent. Results are appended and
+fsynced as soon as their completion arrives, so a crash or Ctrl-C loses at
+most the requests that were still in flight. On restart only the slots
+without a result are sent again, with the prompts sampled in the first run;
+a plan written for another model is sampled again instead of resumed.
+
+Line format:
+    {"kind": "meta", ...}                    # seed, model, ... of the run
+    {"kind": "slot", "slot": 3, ...}         # plan of slot 3
+    {"kind": "result", "slot": 3, "data": {...} or null}
+"""
+from __future__ import annotations
+
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+
+class Checkpoint:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.meta: Dict[str, Any] = {}
+        self.slots: Dict[int, Dict[str, Any]] = {}
+        self.results: Dict[int, Optional[Dict[str, Any]]] = {}
+        if os.path.exists(path):
+            self._load()
+
+    def _load(self) -> None:
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # torn last line of a crashed run
+                    continue
+                kind = record.pop("kind")
+                if kind == "meta":
+                    self.meta = record
+                elif kind == "slot":
+                    self.slots[record["slot"]] = record
+                elif kind == "result":
+                    self.results[record["slot"]] = record["data"]
+
+    @property
+    def has_plan(self) -> bool:
+        return bool(self.slots)
+
+    def write_plan(self, slots: List[Dict[str, Any]], **meta: Any) -> None:
+        """Atomically replace the checkpoint with a new plan (slot numbers are the list positions)."""
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(json.dumps({"kind": "meta", **meta}) + "\n")
+            for slot, plan in enumerate(slots):
+                f.write(json.dumps({"kind": "slot", "slot": slot, **plan}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.meta = meta
+        self.slots = {slot: {"slot": slot, **plan} for slot, plan in enumerate(slots)}
+        self.results = {}
+
+    def matches(self, **meta: Any) -> bool:
+        """True if the plan was written with these meta values (e.g. the same model)."""
+        return all(self.meta.get(key) == value for key, value in meta.items())
+
+    def missing_slots(self) -> List[int]:
+        return [slot for slot in sorted(self.slots) if slot not in self.results]
+
+    def append_result(self, slot: int, data: Optional[Dict[str, Any]]) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"kind": "result", "slot": slot, "data": data}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        self.results[slot] = data
+
+    def completed(self) -> List[Dict[str, Any]]:
+        """Successfully post-processed results in slot order."""
+        return [self.results[slot] for slot in sorted(self.results) if self.results[slot] is not None]
+
+    def remove(self) -> None:
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,75 @@
+"""Clustering backends for the sources of a document (stage 01).
+
+Full KMeans on raw 1536-d embeddings takes minutes per book. The backend
+and an optional dimension reduction can be chosen per run:
+
+    backend:   "kmeans"     full KMeans (used for the paper)
+               "minibatch"  MiniBatchKMeans
+    reduction: None         raw embeddings
+               "pca"        PCA to ``n_components`` dimensions
+               "matryoshka" keep the first ``n_components`` dimensions and re-normalize
+                            (text-embedding-3-* embeddings are trained for this)
+
+``cluster_embeddings`` is a plain top-level function so it can be sent to a
+process pool and files can be clustered in parallel. It returns the labels
+together with the wall time, which is logged per file.
+"""
+from __future__ import annotations
+
+import time
+from dataclasses import asdict, dataclass
+from typing import Optional, Tuple
+
+import numpy as np
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import PCA
+
+BACKENDS = ("kmeans", "minibatch")
+REDUCTIONS = (None, "pca", "matryoshka")
+
+
+@dataclass(frozen=True)
+class ClusteringConfig:
+    backend: str = "kmeans"
+    reduction: Optional[str] = None
+    n_components: int = 256
+    sources_per_cluster: int = 15
+    batch_size: int = 1024
+    random_state: int = 42
+
+    def __post_init__(self) -> None:
+        if self.backend not in BACKENDS:
+            raise ValueError(f"backend must be one of {BACKENDS}, got {self.backend!r}")
+        if self.reduction not in REDUCTIONS:
+            raise ValueError(f"reduction must be one of {REDUCTIONS}, got {self.reduction!r}")
+
+    def n_clusters(self, n_sources: int) -> int:
+        return max(1, n_sources // self.sources_per_cluster)
+
+    def to_dict(self) -> dict:
+        return asdict(self)
+
+
+def reduce_dimensions(embeddings: np.ndarray, config: ClusteringConfig) -> np.ndarray:
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    if config.reduction is None or config.n_components >= embeddings.shape[1]:
+        return embeddings
+    if config.reduction == "matryoshka":
+        truncated = embeddings[:, :config.n_components]
+        norms = np.linalg.norm(truncated, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return truncated / norms
+    n_components = min(config.n_components, *embeddings.shape)
+    return PCA(n_components=n_components, random_state=config.random_state).fit_transform(embeddings)
+
+
+def cluster_embeddings(embeddings: np.ndarray, n_clusters: int, config: ClusteringConfig) -> Tuple[np.ndarray, float]:
+    """Cluster the embeddings; returns the labels and the wall time in seconds."""
+    start = time.perf_counter()
+    features = reduce_dimensions(embeddings, config)
+    if config.backend == "minibatch":
+        model = MiniBatchKMeans(n_clusters=n_clusters, batch_size=config.batch_size, random_state=config.random_state)
+    else:
+        model = KMeans(n_clusters=n_clusters, random_state=config.random_state)
+    labels = model.fit_predict(features)
+    return labels, time.perf_counter() - start
@@ -0,0 +1,122 @@
+"""Persistent, content-addressed cache of chat completions.
+
+Our requests are deterministic (``temperature=0``, ``seed=23``), so a rerun of a
+stage after a crash or a small code change should not pay again for identical
+prompts. Responses are stored in SQLite under a hash of all request
+parameters (model, messages, sampling parameters, logprob settings). The full
+response is kept, so cached answers still carry ``top_logprobs`` for
+``createColumns``.
+
+Modes:
+    "readwrite": serve hits, call the API on misses and store the result (default)
+    "replay":    read-only, serve hits and raise CacheMiss on misses
+"""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Any, Dict, Optional
+
+from openai.types.chat import ChatCompletion
+
+MODES = ("readwrite", "replay")
+
+
+class CacheMiss(KeyError):
+    """Raised in replay mode for requests that are not in the cache."""
+
+
+def request_key(params: Dict[str, Any]) -> str:
+    """Stable hash of the keyword arguments of a chat completion request."""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    def __init__(self, path: str, max_bytes: int = 2 * 1024**3, mode: str = "readwrite") -> None:
+        if mode not in MODES:
+            raise ValueError(f"mode must be one of {MODES}, got {mode!r}")
+        self.path = path
+        self.max_bytes = max_bytes
+        self.mode = mode
+        self.hits = 0
+        self.misses = 0
+
+        if mode == "replay":
+            self.conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+        else:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.conn = sqlite3.connect(path)
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS completions ("
+                "key TEXT PRIMARY KEY, model TEXT, response TEXT, size INTEGER, created REAL, last_access REAL)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS completions_last_access ON completions (last_access)")
+            self.conn.commit()
+        self.size = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM completions").fetchone()[0]
+
+    @staticmethod
+    def cacheable(params: Dict[str, Any]) -> bool:
+        # only chat completions are cached here, embeddings have their own store
+        return "messages" in params
+
+    def get(self, params: Dict[str, Any]) -> Optional[ChatCompletion]:
+        key = request_key(params)
+        row = self.conn.execute("SELECT response FROM completions WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            if self.mode == "replay":
+                raise CacheMiss(f"no cached completion for {params.get('model')} request {key[:12]}")
+            return None
+        self.hits += 1
+        if self.mode == "readwrite":
+            self.conn.execute("UPDATE completions SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+        return ChatCompletion.model_validate_json(row[0])
+
+    def put(self, params: Dict[str, Any], response: ChatCompletion) -> None:
+        self.store(request_key(params), params.get("model"), response)
+
+    def store(self, key: str, model: Optional[str], response: ChatCompletion) -> None:
+        """Like ``put`` for a request that is only known by its key (the custom_id of a batch request)."""
+        if self.mode != "readwrite":
+            return
+        payload = response.model_dump_json()
+        size = len(payload.encode("utf-8"))
+        now = time.time()
+        previous = self.conn.execute("SELECT size FROM completions WHERE key = ?", (key,)).fetchone()
+        self.conn.execute(
+            "INSERT OR REPLACE INTO completions VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, payload, size, now, now),
+        )
+        self.conn.commit()
+        self.size += size - (previous[0] if previous else 0)
+        if self.size > self.max_bytes:
+            self.evict()
+
+    def evict(self, target_fraction: float = 0.9) -> None:
+        """Drop least recently used entries until the cache is below target_fraction * max_bytes."""
+        target = self.max_bytes * target_fraction
+        freed, keys = 0, []
+        for key, size in self.conn.execute("SELECT key, size FROM completions ORDER BY last_access"):
+            if self.size - freed <= target:
+                break
+            keys.append((key,))
+            freed += size
+        self.conn.executemany("DELETE FROM completions WHERE key = ?", keys)
+        self.conn.commit()
+        self.size -= freed
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return (
+            f"completion cache: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate), "
+            f"{self.size / 1024**2:.1f} MB"
+        )
+
+    def close(self) -> None:
+        self.conn.close()
@@ -0,0 +1,186 @@
+"""Incremental parquet dataset of the finished QA pairs and its consolidation into syn-pdfQA.parquet.
+
+Stage 04 writes one ``indent=4`` JSON file per document. ``DatasetBuilder``
+converts such a file into the columns of the released ``syn-pdfQA.parquet``
+and stores them in a hive-partitioned dataset:
+
+    <root>/file_type=<file type>/answer_type=<answer type>/<document>.parquet
+
+Every document has its own files, so adding a document only writes its
+files, and re-adding a changed document replaces just those. The files carry
+an extra ``item`` column with the position in the stage output, which keeps
+the order reproducible.
+
+``consolidate`` streams the dataset into the single-file release format,
+ordered by file type, document and item. It holds one document plus one
+output row group in memory at a time.
+"""
+from __future__ import annotations
+
+import ast
+import glob
+import json
+import os
+from typing import Any, Dict, Iterator, List, Optional
+from urllib.parse import quote, unquote
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# stage folders -> file_type of the release
+FILE_TYPES = {
+    "10K": "financial reports",
+    "Sust_reports": "sustainability disclosures",
+    "Arxiv": "research articles",
+    "research articles": "research articles",
+    "books": "books",
+}
+
+RELEASE_SCHEMA = pa.schema([
+    ("file_type", pa.string()),
+    ("file_name", pa.string()),
+    ("question", pa.string()),
+    ("answer", pa.string()),
+    ("sources", pa.list_(pa.string())),
+    ("source_text", pa.list_(pa.string())),
+    ("answer_type", pa.string()),
+    ("answer_length", pa.int64()),
+    ("reasoning", pa.string()),
+    ("question_difficulty", pa.string()),
+    ("modalities", pa.string()),
+    ("num_sources", pa.int64()),
+    ("file_length", pa.int64()),
+    ("sources_position", pa.int64()),
+    ("source_spread", pa.int64()),
+])
+
+# partition columns are encoded in the folder names, "item" keeps the order of the stage output
+PARTITION_COLUMNS = ("file_type", "answer_type")
+PARTITION_SCHEMA = pa.schema(
+    [field for field in RELEASE_SCHEMA if field.name not in PARTITION_COLUMNS] + [pa.field("item", pa.int64())]
+)
+
+
+def _as_list(value: Any) -> List[str]:
+    # stage 03 stores some source lists as their string representation
+    if isinstance(value, str):
+        value = ast.literal_eval(value)
+    return [str(v) for v in value]
+
+
+def modalities(modalities_used: List[str]) -> Optional[str]:
+    used = set(modalities_used)
+    if len(used) > 1:
+        return "multimodal"
+    return used.pop() if used else None
+
+
+def release_row(item: Dict[str, Any], file_type: str) -> Dict[str, Any]:
+    """Columns of the release for one QA item of a stage 04 output."""
+    sources = _as_list(item["sources"])
+    return {
+        "file_type": file_type,
+        "file_name": item["file_name"],
+        "question": item["question"],
+        "answer": item["answer"],
+        "sources": sources,
+        "source_text": _as_list(item["source_text"]),
+        "answer_type": item["answer_type"],
+        "answer_length": len(item["answer"]),
+        "reasoning": item["reasoning"],
+        "question_difficulty": item["difficulty"],
+        "modalities": modalities(item["modalities_used"]),
+        "num_sources": len(sources),
+        "file_length": item["file_length"],
+        "sources_position": item["sources_position"],
+        "source_spread": item["source_spread"],
+    }
+
+
+def _type_dir(root: str, file_type: str) -> str:
+    return os.path.join(root, f"file_type={quote(file_type, safe='')}")
+
+
+def _partition_dir(root: str, file_type: str, answer_type: str) -> str:
+    return os.path.join(_type_dir(root, file_type), f"answer_type={quote(answer_type, safe='')}")
+
+
+def _value(folder: str) -> str:
+    # "answer_type=word-answer" -> "word-answer"
+    return unquote(os.path.basename(folder).split("=", 1)[1])
+
+
+class DatasetBuilder:
+    def __init__(self, root: str) -> None:
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def _document_files(self, file_type: str, document: str) -> List[str]:
+        file_name = glob.escape(f"{quote(document, safe='')}.parquet")
+        return glob.glob(os.path.join(glob.escape(_type_dir(self.root, file_type)), "answer_type=*", file_name))
+
+    def add_document(self, path: str, report_type: str, document: str, keep=None) -> int:
+        """Write the QA items of a stage 04 output; ``keep(item)`` can drop items. Returns the rows written."""
+        file_type = FILE_TYPES.get(report_type, report_type)
+        with open(path, "r", encoding="utf-8") as f:
+            items = json.load(f)
+
+        partitions: Dict[str, List[Dict[str, Any]]] = {}
+        for i, item in enumerate(items):
+            if keep is not None and not keep(item):
+                continue
+            row = release_row(item, file_type)
+            row["item"] = i
+            partitions.setdefault(row["answer_type"], []).append(row)
+
+        old_files = set(self._document_files(file_type, document))
+        for answer_type, rows in partitions.items():
+            folder = _partition_dir(self.root, file_type, answer_type)
+            os.makedirs(folder, exist_ok=True)
+            file_path = os.path.join(folder, f"{quote(document, safe='')}.parquet")
+            table = pa.Table.from_pylist(rows, schema=PARTITION_SCHEMA)
+            tmp_path = f"{file_path}.tmp"
+            pq.write_table(table, tmp_path)
+            os.replace(tmp_path, file_path)
+            old_files.discard(file_path)
+        # answer types the document no longer has
+        for file_path in old_files:
+            os.remove(file_path)
+        return sum(len(rows) for rows in partitions.values())
+
+    def _document_tables(self) -> Iterator[pa.Table]:
+        """One table per document in the release schema, ordered by file type, document and item."""
+        files: Dict[tuple, List[tuple]] = {}
+        for file_path in glob.glob(os.path.join(glob.escape(self.root), "file_type=*", "answer_type=*", "*.parquet")):
+            answer_dir = os.path.dirname(file_path)
+            document = unquote(os.path.basename(file_path)[: -len(".parquet")])
+            files.setdefault((_value(os.path.dirname(answer_dir)), document), []).append((_value(answer_dir), file_path))
+
+        for (file_type, document) in sorted(files):
+            parts = []
+            for answer_type, file_path in files[(file_type, document)]:
+                table = pq.read_table(file_path, schema=PARTITION_SCHEMA)
+                table = table.append_column("file_type", pa.array([file_type] * table.num_rows, pa.string()))
+                table = table.append_column("answer_type", pa.array([answer_type] * table.num_rows, pa.string()))
+                parts.append(table)
+            table = pa.concat_tables(parts).sort_by("item")
+            yield table.select(RELEASE_SCHEMA.names).cast(RELEASE_SCHEMA)
+
+    def consolidate(self, output_path: str, row_group_size: int = 100_000) -> int:
+        """Stream the dataset into one parquet file in the release schema; returns the number of rows."""
+        tmp_path = f"{output_path}.tmp"
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        rows = 0
+        buffer = pa.Table.from_pylist([], schema=RELEASE_SCHEMA)
+        with pq.ParquetWriter(tmp_path, RELEASE_SCHEMA) as writer:
+            for table in self._document_tables():
+                buffer = pa.concat_tables([buffer, table])
+                # full row groups are written, the rest waits for the next documents
+                while buffer.num_rows >= row_group_size:
+                    writer.write_table(buffer.slice(0, row_group_size))
+                    buffer = buffer.slice(row_group_size)
+                rows += table.num_rows
+            if buffer.num_rows:
+                writer.write_table(buffer)
+        os.replace(tmp_path, output_path)
+        return rows
@@ -0,0 +1,109 @@
+"""Persistent embedding store shared by clustering (stage 01) and retrieval (stage 03).
+
+Embeddings are keyed by (model, dimensions, sha256 of the text) and stored as
+float32 blobs in SQLite. Re-processing a corpus after a parser tweak therefore
+only embeds the sources whose text changed, and questions embedded once in
+stage 03 are reused across reruns.
+
+Usage:
+    EMBEDDINGS = EmbeddingStore("cache/embeddings.sqlite")
+    vectors = await EMBEDDINGS.embed(texts, model, fetch)  # fetch(missing_texts) -> list of vectors
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import sqlite3
+from typing import TYPE_CHECKING, Awaitable, Callable, List, Optional, Sequence
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from pipeline.metrics import Metrics
+
+# SQLite limits the number of host parameters per statement
+_LOOKUP_BATCH = 500
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    def __init__(self, path: str, metrics: Optional[Metrics] = None) -> None:
+        self.path = path
+        self.metrics = metrics
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "model TEXT, dimensions INTEGER, text_hash TEXT, vector BLOB, "
+            "PRIMARY KEY (model, dimensions, text_hash))"
+        )
+        self.conn.commit()
+
+    def get_many(self, model: str, texts: Sequence[str], dimensions: Optional[int] = None) -> List[Optional[np.ndarray]]:
+        """Bulk lookup; returns a float32 vector per text, or None where the text is not stored."""
+        dims = dimensions or 0  # 0 = model default
+        hashes = [text_hash(t) for t in texts]
+        found = {}
+        unique = list(dict.fromkeys(hashes))
+        for start in range(0, len(unique), _LOOKUP_BATCH):
+            batch = unique[start:start + _LOOKUP_BATCH]
+            rows = self.conn.execute(
+                f"SELECT text_hash, vector FROM embeddings WHERE model = ? AND dimensions = ? "
+                f"AND text_hash IN ({','.join('?' * len(batch))})",
+                (model, dims, *batch),
+            )
+            for h, blob in rows:
+                found[h] = np.frombuffer(blob, dtype=np.float32)
+        out = [found.get(h) for h in hashes]
+        hits = sum(v is not None for v in out)
+        self.hits += hits
+        self.misses += len(out) - hits
+        return out
+
+    def get(self, model: str, text: str, dimensions: Optional[int] = None) -> Optional[np.ndarray]:
+        return self.get_many(model, [text], dimensions)[0]
+
+    def put_many(self, model: str, texts: Sequence[str], vectors: Sequence[Sequence[float]], dimensions: Optional[int] = None) -> None:
+        dims = dimensions or 0
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)",
+            [
+                (model, dims, text_hash(t), np.asarray(v, dtype=np.float32).tobytes())
+                for t, v in zip(texts, vectors)
+            ],
+        )
+        self.conn.commit()
+
+    async def embed(
+        self,
+        texts: Sequence[str],
+        model: str,
+        fetch: Callable[[List[str]], Awaitable[List[Sequence[float]]]],
+        dimensions: Optional[int] = None,
+    ) -> List[np.ndarray]:
+        """Return embeddings for all texts, calling ``fetch`` only for the ones not stored yet."""
+        vectors = self.get_many(model, texts, dimensions)
+        missing = list(dict.fromkeys(t for t, v in zip(texts, vectors) if v is None))
+        hits = sum(v is not None for v in vectors)
+        if self.metrics is not None and hits:
+            # one record for all texts of the call that were stored already
+            self.metrics.call("embedding", model, cached=True, n=hits)
+        if missing:
+            fetched = await fetch(missing)
+            self.put_many(model, missing, fetched, dimensions)
+            new = dict(zip(missing, (np.asarray(v, dtype=np.float32) for v in fetched)))
+            vectors = [new[t] if v is None else v for t, v in zip(texts, vectors)]
+        return vectors
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total if total else 0.0
+        return f"embedding store: {self.hits} hits, {self.misses} misses ({rate:.0%} hit rate)"
+
+    def close(self) -> None:
+        self.conn.close()
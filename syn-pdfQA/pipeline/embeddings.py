@@ -0,0 +1,131 @@
+"""Concurrent, retrying embedding of text batches.
+
+Batches are sent concurrently under a configurable limit. A failing batch is
+retried with exponential backoff; if it still fails, it is split and every
+text is retried on its own, so a single bad text cannot poison the
+embeddings of its whole batch.
+
+``plan_embedding_batches`` packs texts into requests by their local token
+count instead of a fixed number of texts per request.
+
+Usage:
+    plan = plan_embedding_batches(texts, model)
+    embeddings = await embed_batches(lambda texts: async_get_embeddings(client, texts, model), plan.batches)
+    embeddings = plan.pool(embeddings)  # one vector per text
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List, Sequence
+
+import numpy as np
+
+from pipeline.tokens import encoding_for
+
+EmbedFn = Callable[[List[str]], Awaitable[Sequence[Sequence[float]]]]
+
+
+async def with_retry(embed: EmbedFn, texts: List[str], max_retries: int = 4, base_delay: float = 1.0) -> Sequence[Sequence[float]]:
+    """Call ``embed(texts)``, retrying with jittered exponential backoff."""
+    for attempt in range(max_retries + 1):
+        try:
+            return await embed(texts)
+        except Exception:
+            if attempt == max_retries:
+                raise
+            await asyncio.sleep(base_delay * 2**attempt * (1 + random.random()))
+
+
+async def embed_batches(
+    embed: EmbedFn,
+    batches: Sequence[List[str]],
+    max_concurrency: int = 8,
+    max_retries: int = 4,
+    base_delay: float = 1.0,
+) -> List[Sequence[float]]:
+    """Embed all batches concurrently and return the embeddings flattened in input order."""
+    slots = asyncio.Semaphore(max_concurrency)
+
+    async def embed_batch(batch: List[str]) -> List[Sequence[float]]:
+        try:
+            async with slots:
+                return list(await with_retry(embed, batch, max_retries, base_delay))
+        except Exception as e:
+            if len(batch) == 1:
+                raise
+            print(f"Embedding a batch of {len(batch)} texts failed ({e}), retrying text by text")
+            # the slot is released before splitting, the single texts queue up like any other batch
+            singles = await asyncio.gather(*[embed_batch([text]) for text in batch])
+            return [s[0] for s in singles]
+
+    results = await asyncio.gather(*[embed_batch(list(batch)) for batch in batches])
+    return [e for batch_embeddings in results for e in batch_embeddings]
+
+
+# limits of the OpenAI embeddings endpoint (text-embedding-3-*)
+MAX_INPUT_TOKENS = 8000  # per input; the hard limit is 8191, keep a margin for re-tokenization of windows
+MAX_REQUEST_TOKENS = 300_000
+MAX_REQUEST_ITEMS = 2048
+
+
+@dataclass
+class EmbeddingPlan:
+    """Token-packed request batches for a list of texts.
+
+    Texts longer than ``max_input_tokens`` are split into windows. ``owners`` maps
+    every input (in batch order) to the text it came from and ``weights`` holds
+    its token count, so window embeddings can be pooled back into one per text.
+    """
+
+    batches: List[List[str]]
+    owners: List[int]
+    weights: List[int]
+    n_texts: int
+
+    def pool(self, embeddings: Sequence[Sequence[float]]) -> np.ndarray:
+        """Token-weighted mean of the window embeddings of every text, re-normalized."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        pooled = np.zeros((self.n_texts, embeddings.shape[1]), dtype=np.float32)
+        np.add.at(pooled, self.owners, embeddings * np.asarray(self.weights, dtype=np.float32)[:, None])
+        norms = np.linalg.norm(pooled, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return pooled / norms
+
+
+def plan_embedding_batches(
+    texts: Sequence[str],
+    model: str,
+    max_input_tokens: int = MAX_INPUT_TOKENS,
+    max_request_tokens: int = MAX_REQUEST_TOKENS,
+    max_request_items: int = MAX_REQUEST_ITEMS,
+) -> EmbeddingPlan:
+    """Pack texts (or windows of oversized texts) into as few requests as the limits allow."""
+    encoding = encoding_for(model)
+    batches: List[List[str]] = []
+    owners: List[int] = []
+    weights: List[int] = []
+    batch: List[str] = []
+    batch_tokens = 0
+
+    for owner, text in enumerate(texts):
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) <= max_input_tokens:
+            windows = [(text, max(len(tokens), 1))]
+        else:
+            windows = [
+                (encoding.decode(tokens[start:start + max_input_tokens]), len(tokens[start:start + max_input_tokens]))
+                for start in range(0, len(tokens), max_input_tokens)
+            ]
+        for window, n_tokens in windows:
+            if batch and (batch_tokens + n_tokens > max_request_tokens or len(batch) >= max_request_items):
+                batches.append(batch)
+                batch, batch_tokens = [], 0
+            batch.append(window)
+            batch_tokens += n_tokens
+            owners.append(owner)
+            weights.append(n_tokens)
+    if batch:
+        batches.append(batch)
+    return EmbeddingPlan(batches, owners, weights, len(texts))
@@ -0,0 +1,94 @@
+"""Classification of errors returned for API requests.
+
+    retryable         rate limits (429), server errors (5xx), timeouts and dropped connections,
+                      requests an expired or failed batch did not get to; sent again with backoff
+    context_overflow  the prompt does not fit into the model's context window; the caller
+                      has to shorten it (stage 04 fits the document again)
+    fatal             everything else (invalid request, authentication, bugs); not retried
+"""
+from __future__ import annotations
+
+import asyncio
+import re
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+from openai import APIConnectionError
+
+from pipeline.batch import BatchError
+
+RETRYABLE = "retryable"
+CONTEXT_OVERFLOW = "context_overflow"
+FATAL = "fatal"
+
+# error codes of requests whose prompt does not fit into the model's context window
+CONTEXT_OVERFLOW_CODES = ("context_length_exceeded", "string_above_max_length")
+
+# "This model's maximum context length is 128000 tokens. However, your messages resulted in 131072 tokens."
+OVERFLOW_TOKENS = re.compile(r"maximum context length is (\d+) tokens.*?resulted in (\d+) tokens", re.DOTALL)
+# request timeout, conflict, rate limit and server errors (the OpenAI client retries the same ones)
+RETRYABLE_STATUS_CODES = (408, 409, 429, 500, 502, 503, 504)
+
+
+def is_context_overflow(error: BaseException) -> bool:
+    """True for errors caused by a prompt that is too long for the model (online or in a batch)."""
+    if getattr(error, "code", None) in CONTEXT_OVERFLOW_CODES:
+        return True
+    message = str(error)
+    return any(code in message for code in CONTEXT_OVERFLOW_CODES) or "maximum context length" in message
+
+
+def overflow_tokens(error: BaseException) -> Optional[Tuple[int, int]]:
+    """Context window and prompt tokens reported by a context overflow error, None if its message has no counts."""
+    match = OVERFLOW_TOKENS.search(str(error))
+    return (int(match.group(1)), int(match.group(2))) if match else None
+
+
+def classify(error: BaseException) -> str:
+    """RETRYABLE, CONTEXT_OVERFLOW or FATAL."""
+    if is_context_overflow(error):
+        return CONTEXT_OVERFLOW
+    if isinstance(error, (APIConnectionError, asyncio.TimeoutError, TimeoutError, ConnectionError)):
+        return RETRYABLE
+    # a batch that expired or failed before the request; error responses in a batch are classified like online ones
+    if isinstance(error, BatchError) and error.status_code is None:
+        return RETRYABLE
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES:
+        return RETRYABLE
+    return FATAL
+
+
+def failures(results: Sequence[Any]) -> Dict[int, BaseException]:
+    """Positions and errors of the failed items of per-item results."""
+    return {i: r for i, r in enumerate(results) if isinstance(r, BaseException)}
+
+
+class PartialFailure(RuntimeError):
+    """Some requests of a file still failed after their retries; the successful ones are kept (checkpoint or cache)."""
+
+    def __init__(self, errors: Dict[int, BaseException], total: int) -> None:
+        self.errors = errors
+        self.total = total
+        kinds: Dict[str, int] = {}
+        for error in errors.values():
+            kinds[classify(error)] = kinds.get(classify(error), 0) + 1
+        first = next(iter(errors.values()))
+        super().__init__(f"{len(errors)} of {total} requests failed ({kinds}), first: {first!r}")
+
+
+def permanent_failures(results: Sequence[Any]) -> Dict[int, BaseException]:
+    """Positions and errors of the items that failed for good (fatal or context overflow), logged.
+
+    A rerun of the file sends the same requests and gets the same errors, so the
+    caller drops or marks these items and lets the file finish.
+    """
+    errors = {i: e for i, e in failures(results).items() if classify(e) != RETRYABLE}
+    for i, error in errors.items():
+        print(f"Request {i + 1} of {len(results)} failed for good ({classify(error)}): {error!r}")
+    return errors
+
+
+def raise_retryable(results: Sequence[Any]) -> None:
+    """PartialFailure if items still fail with retryable errors; the rerun of the file sends them again."""
+    errors = {i: e for i, e in failures(results).items() if classify(e) == RETRYABLE}
+    if errors:
+        raise PartialFailure(errors, len(results))
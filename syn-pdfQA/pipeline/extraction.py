@@ -0,0 +1,173 @@
+"""Cached extraction of the raw text of input documents (stage 04 answers on full documents).
+
+Parsing a large 10-K filing with BeautifulSoup's ``html.parser`` takes seconds,
+and the text of Sust_reports and books was rebuilt from the parquet sources
+on every call. The text is now extracted once per document:
+
+    .htm / .html  lxml on the bytes of the file (in their declared encoding), with the
+                  text nodes joined like ``BeautifulSoup(...).get_text(separator=" ", strip=True)``
+    .tex          read as is
+    .parquet      the ``content`` of the sources joined with SOURCE_SEPARATOR
+
+Results are kept in SQLite keyed by the file hash and EXTRACTOR_VERSION, so a
+changed input or extractor invalidates them. ``TextStore.extract_many``
+extracts the missing documents in a process pool before the async LLM loop
+starts.
+
+Usage:
+    TEXTS = TextStore("cache/raw_text.sqlite")
+    TEXTS.extract_many(paths, max_workers=8)
+    text = TEXTS.extract(path)
+"""
+from __future__ import annotations
+
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Optional, Tuple, Union
+
+from pipeline.manifest import file_hash
+from pipeline.sources import read_sources
+
+# bump whenever the extracted text of a format changes
+EXTRACTOR_VERSION = 1
+
+# sources of Sust_reports and books are joined into one document
+SOURCE_SEPARATOR = "\n\n\n"
+
+# text of these elements is not part of the document (BeautifulSoup's get_text skips them as well)
+SKIPPED_TAGS = {"script", "style", "template"}
+
+# encoding of an XML declaration (iXBRL filings start with one) or of a meta charset
+DECLARED_ENCODING = re.compile(rb"""(?:<\?xml[^>]*?encoding|<meta[^>]*?charset)\s*=\s*["']?([\w.:-]+)""", re.I)
+
+
+def declared_encoding(html: bytes) -> str:
+    """Encoding declared at the start of an HTML/XHTML document, utf-8 if there is none."""
+    match = DECLARED_ENCODING.search(html[:4096])
+    return match.group(1).decode("ascii") if match else "utf-8"
+
+
+def html_to_text(html: Union[str, bytes]) -> str:
+    """Text of an HTML document; pass the bytes of the file, lxml rejects a str with an encoding declaration."""
+    try:
+        import lxml.html
+    except ImportError:
+        from bs4 import BeautifulSoup
+
+        return BeautifulSoup(html, "html.parser").get_text(separator=" ", strip=True)
+
+    if isinstance(html, bytes):
+        parser = lxml.html.HTMLParser(encoding=declared_encoding(html))
+        root = lxml.html.document_fromstring(html, parser=parser)
+    else:
+        root = lxml.html.document_fromstring(html)
+    parts = []
+    for element in root.iter():
+        # comments and processing instructions have no string tag, only their tail is text
+        if isinstance(element.tag, str) and element.tag not in SKIPPED_TAGS and element.text:
+            parts.append(element.text)
+        if element.tail:
+            parts.append(element.tail)
+    return " ".join(stripped for stripped in (p.strip() for p in parts) if stripped)
+
+
+def extract_text(path: str) -> Tuple[str, float]:
+    """Raw text of a document and the seconds it took (top-level, so it can run in a process pool)."""
+    start = time.perf_counter()
+    suffix = os.path.splitext(path)[1].lower()
+    if suffix in (".htm", ".html"):
+        with open(path, "rb") as f:
+            text = html_to_text(f.read())
+    elif suffix == ".parquet":
+        df = read_sources(path, columns=["content"])
+        text = SOURCE_SEPARATOR.join([str(x) for x in df.content.to_list()])
+    else:
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+    return text, time.perf_counter() - start
+
+
+class TextStore:
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.seconds = 0.0
+        # path -> error of documents whose extraction failed in extract_many
+        self.failed: Dict[str, BaseException] = {}
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS texts ("
+            "hash TEXT, version INTEGER, path TEXT, text TEXT, seconds REAL, created REAL, PRIMARY KEY (hash, version))"
+        )
+        self.conn.commit()
+
+    def get(self, path: str, digest: Optional[str] = None) -> Optional[str]:
+        row = self.conn.execute(
+            "SELECT text FROM texts WHERE hash = ? AND version = ?", (digest or file_hash(path), EXTRACTOR_VERSION)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, path: str, text: str, seconds: float, digest: Optional[str] = None) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO texts VALUES (?, ?, ?, ?, ?, ?)",
+            (digest or file_hash(path), EXTRACTOR_VERSION, path, text, seconds, time.time()),
+        )
+        self.conn.commit()
+        self.seconds += seconds
+
+    def extract(self, path: str) -> str:
+        if path in self.failed:
+            # not extracted a second time in the same run; the caller fails the file
+            raise self.failed[path]
+        digest = file_hash(path)
+        text = self.get(path, digest)
+        if text is not None:
+            self.hits += 1
+            return text
+        self.misses += 1
+        text, seconds = extract_text(path)
+        self.put(path, text, seconds, digest)
+        return text
+
+    def extract_many(self, paths: Iterable[str], max_workers: int = 8) -> Dict[str, str]:
+        """Extract all documents that are not cached yet, in parallel; returns the text per path.
+
+        A document that cannot be extracted is left out and recorded in ``failed``;
+        ``extract`` raises its error, so only the file that needs it fails.
+        """
+        texts, todo = {}, {}
+        for path in dict.fromkeys(paths):
+            digest = file_hash(path)
+            text = self.get(path, digest)
+            if text is None:
+                todo[path] = digest
+            else:
+                self.hits += 1
+                texts[path] = text
+        if not todo:
+            return texts
+        with ProcessPoolExecutor(max_workers=max(1, min(max_workers, len(todo)))) as pool:
+            futures = {path: pool.submit(extract_text, path) for path in todo}
+            for path, future in futures.items():
+                try:
+                    text, seconds = future.result()
+                except Exception as e:
+                    print(f"ERROR extracting {path}: {e!r}")
+                    self.failed[path] = e
+                    continue
+                self.misses += 1
+                self.put(path, text, seconds, todo[path])
+                texts[path] = text
+        return texts
+
+    def report(self) -> str:
+        return (f"raw text store: {self.hits} hits, {self.misses} extracted, {len(self.failed)} failed "
+                f"({self.seconds:.1f}s extraction)")
+
+    def close(self) -> None:
+        self.conn.close()
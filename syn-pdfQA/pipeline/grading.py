@@ -0,0 +1,76 @@
+"""G-Eval correctness grading of answers against the ground truth (stage 04 and the benchmark).
+
+The grader model rates a proposed answer from 1 to 5 with a single token.
+The score is that rating weighted by the probability of the token, so an
+unsure "5" counts less than a certain one. Ratings that are not a single
+number are kept as "Invalid answer".
+"""
+from __future__ import annotations
+
+from typing import Any, Dict, List, Tuple, Union
+
+import numpy as np
+
+INVALID = "Invalid answer"
+
+g_eval_prompt = """You will be given a question, a proposed answer, and a ground truth answer.
+
+Your task is to rate the correctness of the proposed answer. Please make sure you read and understand these instructions carefully.
+
+Evaluation Criteria:
+Correctness (1-5) - This evaluates whether the proposed answer is factually correct based on the ground truth. Your task is to determine if the proposed answer is aligned with and entailed by the ground truth answer.
+
+
+Evaluation Steps:
+1. Read the question and ground truth answer: Understand the key facts and details provided in the ground truth answer that are relevant to the question.
+2. Compare the proposed answer to the ground truth answer: Check if the proposed answer is factually accurate, consistent, and aligned with the ground truth answer.
+3. Assign a correctness score (1-5):
+   - 1: The proposed answer is factually incorrect or contradicts the ground truth.
+   - 2: The proposed answer contains multiple factual errors or significant inaccuracies.
+   - 3: The proposed answer is partially correct but includes some factual errors or omissions.
+   - 4: The proposed answer is mostly correct with minor factual deviations.
+   - 5: The proposed answer is fully correct and strictly aligns with the ground truth.
+
+
+Question:
+-----
+{Question}
+-----
+
+Ground Truth Answer:
+-----
+{Ground_Truth_Answer}
+-----
+
+Proposed Answer:
+-----
+{Proposed_Answer}
+-----
+
+Evaluation Form (output ONLY a single score - nothing else):
+- Correctness:
+"""
+
+
+def g_eval_messages(question: str, ground_truth: str, proposed: str) -> List[Dict[str, str]]:
+    prompt = g_eval_prompt.format(Question=question, Ground_Truth_Answer=ground_truth, Proposed_Answer=proposed)
+    return [{"role": "user", "content": prompt}]
+
+
+def g_eval_request(messages: List[Dict[str, str]], model: str) -> Dict[str, Any]:
+    """Keyword arguments of the grading call (deterministic, with the top-5 logprobs of the rating)."""
+    return dict(model=model, temperature=0.0, seed=23, messages=messages, logprobs=True, top_logprobs=5)
+
+
+def g_eval_score(completion: Any) -> Tuple[str, Union[float, str]]:
+    """Raw rating of a grading completion and its probability-weighted score."""
+    rating = completion.choices[0].message.content
+    if len(rating) > 1:
+        return rating, INVALID
+    # probability of the rating token
+    top_logprobs = completion.choices[0].logprobs.content[0].top_logprobs
+    probability = np.round(np.exp(top_logprobs[0].logprob) * 100, 2)
+    try:
+        return rating, float(rating) * (probability / 100)
+    except ValueError:
+        return rating, INVALID
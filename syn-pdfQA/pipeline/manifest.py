@@ -0,0 +1,148 @@
+"""Per-stage manifest of processed documents.
+
+Replaces globbing the output folder and splitting paths on "\\" (which never
+matched on Linux, so every run redid every file). For every (stage, document)
+the manifest records the input hash, output path, status, model and timings in
+SQLite, which makes the skip check a primary-key lookup. A document is
+processed again when its input or the model changes. Several workers can run
+the same stage: ``claim`` marks a document as running inside an immediate
+transaction, so only one of them gets it.
+
+Outputs without a manifest row (e.g. from before the manifest existed) were
+produced by an unknown model, so they are redone. A migration that knows they
+were made with the current model passes ``adopt_existing=True`` to mark them
+as done instead.
+
+Usage:
+    MANIFEST = StageManifest("manifest.sqlite", stage="02_Create_Answers", model=MODEL)
+    if MANIFEST.claim(document, input_path, output_path):
+        ...
+        MANIFEST.done(document, output_path)
+"""
+from __future__ import annotations
+
+import hashlib
+import os
+import socket
+import sqlite3
+import time
+from typing import Optional
+
+# "running" claims older than this are considered abandoned (crashed worker)
+CLAIM_TIMEOUT_SECONDS = 6 * 3600
+
+
+def file_hash(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def document_name(path: str, suffix: str) -> str:
+    """File name without folder and suffix, e.g. (".../x_clustered.parquet", "_clustered.parquet") -> "x"."""
+    name = os.path.basename(path)
+    return name[: -len(suffix)] if suffix and name.endswith(suffix) else name
+
+
+class StageManifest:
+    def __init__(self, path: str, stage: str, model: str = "", claim_timeout: float = CLAIM_TIMEOUT_SECONDS,
+                 adopt_existing: bool = False) -> None:
+        self.path = path
+        self.stage = stage
+        self.model = model
+        self.claim_timeout = claim_timeout
+        self.adopt_existing = adopt_existing
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        # autocommit mode, transactions are opened explicitly where needed
+        self.conn = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS documents ("
+            "stage TEXT, document TEXT, input_path TEXT, input_size INTEGER, input_mtime INTEGER, input_hash TEXT, "
+            "output_path TEXT, status TEXT, model TEXT, worker TEXT, started REAL, finished REAL, seconds REAL, error TEXT, "
+            "PRIMARY KEY (stage, document))"
+        )
+
+    def _input_hash(self, input_path: str, row: Optional[sqlite3.Row]) -> str:
+        # re-hash only when size or mtime changed since the hash was recorded
+        stat = os.stat(input_path)
+        if row is not None and row["input_size"] == stat.st_size and row["input_mtime"] == stat.st_mtime_ns:
+            return row["input_hash"]
+        return file_hash(input_path)
+
+    def _row(self, document: str) -> Optional[sqlite3.Row]:
+        return self.conn.execute(
+            "SELECT * FROM documents WHERE stage = ? AND document = ?", (self.stage, document)
+        ).fetchone()
+
+    def claim(self, document: str, input_path: str, output_path: Optional[str] = None,
+              adopt_existing: Optional[bool] = None) -> bool:
+        """Reserve a document for this worker; False if it is done (and still valid) or claimed by another worker.
+
+        An existing output without a manifest row is adopted as done only with
+        ``adopt_existing`` (default: the manifest's); otherwise it is redone.
+        """
+        adopt_existing = self.adopt_existing if adopt_existing is None else adopt_existing
+        stat = os.stat(input_path)
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = self._row(document)
+            input_hash = self._input_hash(input_path, row)
+            if row is None and output_path is not None and os.path.exists(output_path):
+                if adopt_existing:
+                    self._upsert(document, input_path, stat, input_hash, output_path, "done", now, now)
+                    self.conn.execute("COMMIT")
+                    return False
+                # which model produced it is unknown: it must not pass as an output of self.model
+                print(f"{output_path} has no manifest record (model unknown), redoing it")
+            if row is not None:
+                valid = row["input_hash"] == input_hash and row["model"] == self.model
+                if row["status"] == "done" and valid:
+                    self.conn.execute("COMMIT")
+                    return False
+                if row["status"] == "running" and valid and row["worker"] != self.worker and now - row["started"] < self.claim_timeout:
+                    self.conn.execute("COMMIT")
+                    return False
+            self._upsert(document, input_path, stat, input_hash, output_path, "running", now, None)
+            self.conn.execute("COMMIT")
+            return True
+        except BaseException:
+            self.conn.execute("ROLLBACK")
+            raise
+
+    def _upsert(self, document, input_path, stat, input_hash, output_path, status, started, finished) -> None:
+        self.conn.execute(
+            "INSERT OR REPLACE INTO documents VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (
+                self.stage, document, input_path, stat.st_size, stat.st_mtime_ns, input_hash,
+                output_path, status, self.model, self.worker, started, finished,
+                None if finished is None else finished - started, None,
+            ),
+        )
+
+    def done(self, document: str, output_path: str) -> None:
+        now = time.time()
+        self.conn.execute(
+            "UPDATE documents SET status = 'done', output_path = ?, finished = ?, seconds = ? - started, error = NULL "
+            "WHERE stage = ? AND document = ?",
+            (output_path, now, now, self.stage, document),
+        )
+
+    def failed(self, document: str, error: str) -> None:
+        now = time.time()
+        self.conn.execute(
+            "UPDATE documents SET status = 'failed', finished = ?, seconds = ? - started, error = ? "
+            "WHERE stage = ? AND document = ?",
+            (now, now, error, self.stage, document),
+        )
+
+    def summary(self) -> str:
+        rows = self.conn.execute(
+            "SELECT status, COUNT(*), COALESCE(SUM(seconds), 0) FROM documents WHERE stage = ? GROUP BY status",
+            (self.stage,),
+        ).fetchall()
+        return f"{self.stage}: " + ", ".join(f"{n} {status} ({seconds:.0f}s)" for status, n, seconds in rows)
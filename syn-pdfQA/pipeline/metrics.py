@@ -0,0 +1,289 @@
+"""Structured metrics of the stages: API calls, cache hits, estimated cost and time spent in hot functions.
+
+Every LLM and embedding call is recorded with its model, prompt and completion
+tokens, latency, retries, whether it was served from a cache or a batch, and
+its estimated cost (PRICES, per million tokens). ``timed`` records the wall and
+CPU time of a function. The records go
+
+    - as JSON lines to ``path``: one per call, and per function at the end of the run
+    - to a Prometheus text endpoint (GET /metrics) while the stage runs, if a port is given
+    - into ``summary()``, a table per stage, category and model, and per function
+
+Calls are labelled with the stage (``start``) and with the labels of the
+running task (``labels``, e.g. the category), so the bottleneck stage per
+category can be found across runs.
+
+Usage:
+    METRICS = Metrics("logs/metrics.jsonl")
+    SCHEDULER = RequestScheduler(max_in_flight=32, cache=CACHE, metrics=METRICS)
+
+    @METRICS.timed
+    def post_process_answer(...): ...
+
+    METRICS.start("02_Create_Answers", port=9100)
+    with METRICS.labels(category=report_type):
+        ...
+    print(METRICS.summary())
+    METRICS.close()
+"""
+from __future__ import annotations
+
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterator, Optional, Tuple
+
+
+@dataclass(frozen=True)
+class Price:
+    input: float  # USD per million prompt tokens
+    cached_input: float  # USD per million prompt tokens served from the provider's prompt cache
+    output: float = 0.0  # USD per million completion tokens
+
+
+# list prices, see platform.openai.com/docs/pricing
+PRICES: Dict[str, Price] = {
+    "gpt-4.1-2025-04-14": Price(2.00, 0.50, 8.00),
+    "gpt-4.1-mini-2025-04-14": Price(0.40, 0.10, 1.60),
+    "gpt-4o-2024-11-20": Price(2.50, 1.25, 10.00),
+    "gpt-4o-2024-08-06": Price(2.50, 1.25, 10.00),
+    "gpt-4o-mini-2024-07-18": Price(0.15, 0.075, 0.60),
+    "text-embedding-3-small": Price(0.02, 0.02),
+    "text-embedding-3-large": Price(0.13, 0.13),
+}
+
+# the Batch API costs half of the online price
+BATCH_DISCOUNT = 0.5
+
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int, cached_tokens: int = 0, batch: bool = False) -> float:
+    """Estimated USD of a call (0 for models without a price)."""
+    price = PRICES.get(model)
+    if price is None:
+        return 0.0
+    usd = ((prompt_tokens - cached_tokens) * price.input + cached_tokens * price.cached_input
+           + completion_tokens * price.output) / 1e6
+    return usd * BATCH_DISCOUNT if batch else usd
+
+
+def usage_tokens(usage: Any) -> Tuple[int, int, int]:
+    """Prompt, completion and provider-cached prompt tokens of a response's ``usage``."""
+    if usage is None:
+        return 0, 0, 0
+    details = getattr(usage, "prompt_tokens_details", None)
+    return (getattr(usage, "prompt_tokens", 0) or 0, getattr(usage, "completion_tokens", 0) or 0,
+            getattr(details, "cached_tokens", 0) or 0)
+
+
+@dataclass
+class CallStats:
+    calls: int = 0
+    cached: int = 0
+    batched: int = 0
+    errors: int = 0
+    retries: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    seconds: float = 0.0
+    cost: float = 0.0
+
+
+@dataclass
+class TimingStats:
+    calls: int = 0
+    seconds: float = 0.0
+    cpu_seconds: float = 0.0
+
+
+class Metrics:
+    def __init__(self, path: Optional[str] = "logs/metrics.jsonl") -> None:
+        self.path = path
+        self.stage = ""
+        self._labels: contextvars.ContextVar[Dict[str, str]] = contextvars.ContextVar("metrics_labels", default={})
+        # (stage, category, kind, model) -> stats
+        self.calls: Dict[Tuple[str, str, str, str], CallStats] = {}
+        # (stage, function) -> stats
+        self.timings: Dict[Tuple[str, str], TimingStats] = {}
+        self._lock = threading.Lock()
+        self._file = None
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def start(self, stage: str, port: Optional[int] = None) -> None:
+        """Label the following records with ``stage``; serves /metrics on ``port`` if given."""
+        self.stage = stage
+        if self.path is not None and self._file is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        if port is not None and self._server is None:
+            self.serve(port)
+
+    @contextmanager
+    def labels(self, **labels: str) -> Iterator[None]:
+        """Labels of the records made in this block (and in the tasks it starts)."""
+        token = self._labels.set({**self._labels.get(), **labels})
+        try:
+            yield
+        finally:
+            self._labels.reset(token)
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        if self._file is not None:
+            self._file.write(json.dumps(record) + "\n")
+            self._file.flush()
+
+    def call(self, kind: str, model: str, usage: Any = None, seconds: float = 0.0, retries: int = 0,
+             cached: bool = False, batch: bool = False, error: Optional[str] = None, n: int = 1) -> None:
+        """Record ``n`` API calls of ``kind`` ("chat" or "embedding"); cached calls cost nothing."""
+        prompt_tokens, completion_tokens, cached_tokens = usage_tokens(usage)
+        cost = 0.0 if cached or error else estimate_cost(model, prompt_tokens, completion_tokens, cached_tokens, batch)
+        labels = self._labels.get()
+        with self._lock:
+            stats = self.calls.setdefault((self.stage, labels.get("category", ""), kind, model), CallStats())
+            stats.calls += n
+            stats.cached += n if cached else 0
+            stats.batched += n if batch else 0
+            stats.errors += 1 if error else 0
+            stats.retries += retries
+            stats.prompt_tokens += prompt_tokens
+            stats.completion_tokens += completion_tokens
+            stats.seconds += seconds
+            stats.cost += cost
+            self._write({
+                "time": time.time(), "event": "call", "stage": self.stage, **labels, "kind": kind, "model": model,
+                "n": n, "prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "cached_prompt_tokens": cached_tokens, "seconds": round(seconds, 4), "retries": retries,
+                "cached": cached, "batch": batch, "cost": cost, "error": error,
+            })
+
+    def _time(self, name: str, seconds: float, cpu_seconds: float) -> None:
+        with self._lock:
+            stats = self.timings.setdefault((self.stage, name), TimingStats())
+            stats.calls += 1
+            stats.seconds += seconds
+            stats.cpu_seconds += cpu_seconds
+
+    def timed(self, func: Callable) -> Callable:
+        """Decorator recording the wall and CPU time of every call of ``func``.
+
+        For coroutine functions the wall time includes the awaited requests and the CPU time
+        that of the other tasks running meanwhile.
+        """
+        name = func.__name__
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def timed_async(*args: Any, **kwargs: Any) -> Any:
+                start, cpu_start = time.perf_counter(), time.process_time()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self._time(name, time.perf_counter() - start, time.process_time() - cpu_start)
+            return timed_async
+
+        @functools.wraps(func)
+        def timed_sync(*args: Any, **kwargs: Any) -> Any:
+            start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._time(name, time.perf_counter() - start, time.thread_time() - cpu_start)
+        return timed_sync
+
+    def prometheus(self) -> str:
+        """Counters in the Prometheus text exposition format."""
+        def line(metric: str, labels: Dict[str, str], value: float) -> str:
+            text = ",".join(f'{k}="{v}"' for k, v in labels.items())
+            return f"{metric}{{{text}}} {value}"
+
+        counters = {
+            "pdfqa_api_calls_total": ("API calls", lambda s: s.calls),
+            "pdfqa_api_cached_calls_total": ("API calls served from a cache", lambda s: s.cached),
+            "pdfqa_api_batched_calls_total": ("API calls run through the Batch API", lambda s: s.batched),
+            "pdfqa_api_errors_total": ("API calls that failed", lambda s: s.errors),
+            "pdfqa_api_retries_total": ("retries of the API client", lambda s: s.retries),
+            "pdfqa_api_prompt_tokens_total": ("prompt tokens", lambda s: s.prompt_tokens),
+            "pdfqa_api_completion_tokens_total": ("completion tokens", lambda s: s.completion_tokens),
+            "pdfqa_api_seconds_total": ("seconds waited for API calls", lambda s: s.seconds),
+            "pdfqa_api_cost_usd_total": ("estimated cost in USD", lambda s: s.cost),
+        }
+        timings = {
+            "pdfqa_function_calls_total": ("calls of timed functions", lambda s: s.calls),
+            "pdfqa_function_seconds_total": ("wall seconds in timed functions", lambda s: s.seconds),
+            "pdfqa_function_cpu_seconds_total": ("CPU seconds in timed functions", lambda s: s.cpu_seconds),
+        }
+        lines = []
+        with self._lock:
+            for metric, (help_text, value) in counters.items():
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+                for (stage, category, kind, model), stats in self.calls.items():
+                    lines.append(line(metric, {"stage": stage, "category": category, "kind": kind, "model": model}, value(stats)))
+            for metric, (help_text, value) in timings.items():
+                lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+                for (stage, function), stats in self.timings.items():
+                    lines.append(line(metric, {"stage": stage, "function": function}, value(stats)))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> str:
+        """Serve ``prometheus()`` at http://host:port/metrics in a background thread."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                data = metrics.prometheus().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self._server = ThreadingHTTPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def summary(self) -> str:
+        """Per-run table of the API calls per stage, category and model, and of the timed functions."""
+        lines = [
+            f"{'stage':<22} {'category':<20} {'kind':<9} {'model':<26} {'calls':>7} {'cached':>7} {'errors':>7} {'retries':>7} "
+            f"{'prompt tok':>11} {'compl tok':>10} {'api s':>8} {'USD':>9}"
+        ]
+        with self._lock:
+            for (stage, category, kind, model), s in sorted(self.calls.items()):
+                lines.append(
+                    f"{stage:<22} {category:<20} {kind:<9} {model:<26} {s.calls:>7} {s.cached:>7} {s.errors:>7} {s.retries:>7} "
+                    f"{s.prompt_tokens:>11} {s.completion_tokens:>10} {s.seconds:>8.1f} {s.cost:>9.4f}"
+                )
+            if self.timings:
+                lines.append(f"{'stage':<22} {'function':<30} {'calls':>7} {'wall s':>9} {'cpu s':>9} {'ms/call':>9}")
+                for (stage, function), t in sorted(self.timings.items(), key=lambda item: -item[1].seconds):
+                    lines.append(
+                        f"{stage:<22} {function:<30} {t.calls:>7} {t.seconds:>9.2f} {t.cpu_seconds:>9.2f} "
+                        f"{1000 * t.seconds / t.calls:>9.2f}"
+                    )
+        return "\n".join(lines)
+
+    def close(self) -> None:
+        """Write the function timings of the run and stop the endpoint."""
+        with self._lock:
+            for (stage, function), stats in self.timings.items():
+                self._write({"time": time.time(), "event": "function", "stage": stage, "function": function, **asdict(stats)})
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
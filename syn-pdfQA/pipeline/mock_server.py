@@ -0,0 +1,264 @@
+"""Local server that speaks the chat completions and embeddings endpoints of the OpenAI HTTP API.
+
+Lets the stages run, and be load-tested, without network access or an API
+key: point the OpenAI client at it (``MockBackend`` in pipeline/backends.py
+starts one in-process) or run it on its own
+
+    python -m pipeline.mock_server --port 8765 --latency 0.2 --error-rate 0.01 --rate-limit-rate 0.05
+
+Responses are deterministic, derived from a hash of the request:
+
+    completions  JSON objects for ``response_format`` json schemas and for prompts that ask for
+                 JSON with named keys (``"sources"`` cites identifiers of the prompt), a rating
+                 1-5 for prompts that ask for a single score, otherwise a short sentence;
+                 synthetic per-token logprobs and ``top_logprobs`` when requested
+    embeddings   unit vectors seeded by the hash of each input (``dimensions`` is honoured),
+                 as floats or base64 like the API
+
+Failures are injected at random (with ``seed``): ``error_rate`` answers with a
+500, ``rate_limit_rate`` with a 429 and a ``retry-after`` header. Prompts
+longer than the model's context window get the API's ``context_length_exceeded``
+400. ``latency`` (seconds, +-50% jitter) is added to every request.
+"""
+from __future__ import annotations
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Optional, Tuple
+
+import numpy as np
+
+from pipeline.scheduler import estimate_prompt_tokens
+from pipeline.tokens import context_window
+
+DEFAULT_DIMENSIONS = {"text-embedding-3-small": 1536, "text-embedding-3-large": 3072}
+
+# identifiers of the sources listed in the prompts of the stages, e.g. "Source_12 (modality: text): ..."
+SOURCE_PATTERN = re.compile(r"^(Source_\d+)\b", re.M)
+# 'the keys "question", "answer", and "sources"'
+KEYS_PATTERN = re.compile(r'keys? ((?:"\w+"(?:,? and |, )?)+)')
+
+WORDS = ("revenue", "growth", "table", "method", "results", "increase", "policy", "model", "emissions", "data")
+
+
+def _seed(*parts: Any) -> int:
+    digest = hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def _sentence(rng: random.Random, n_words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(n_words)).capitalize() + "."
+
+
+def _from_schema(schema: Dict[str, Any], rng: random.Random) -> Any:
+    kind = schema.get("type")
+    if kind == "object":
+        return {name: _from_schema(sub, rng) for name, sub in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_from_schema(schema.get("items", {}), rng) for _ in range(rng.randint(1, 3))]
+    if kind == "integer":
+        return rng.randint(0, 100)
+    if kind == "number":
+        return round(rng.uniform(0, 100), 2)
+    if kind == "boolean":
+        return rng.random() < 0.5
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    return _sentence(rng, rng.randint(3, 12))
+
+
+def completion_content(params: Dict[str, Any], rng: random.Random) -> str:
+    prompt = "\n".join(str(m.get("content", "")) for m in params.get("messages", []))
+    response_format = params.get("response_format") or {}
+    if response_format.get("type") == "json_schema":
+        return json.dumps(_from_schema(response_format["json_schema"].get("schema", {}), rng))
+    keys = KEYS_PATTERN.search(prompt) if "JSON" in prompt else None
+    if keys:
+        answer = {}
+        for key in re.findall(r'"(\w+)"', keys.group(1)):
+            if key == "sources":
+                sources = list(dict.fromkeys(SOURCE_PATTERN.findall(prompt)))
+                answer[key] = rng.sample(sources, min(len(sources), rng.randint(1, 3)))
+            else:
+                answer[key] = _sentence(rng, rng.randint(4, 16))
+        return json.dumps(answer)
+    if "single score" in prompt:
+        return str(rng.randint(1, 5))
+    return _sentence(rng, rng.randint(3, 24))
+
+
+def logprobs(content: str, top_logprobs: int, rng: random.Random) -> Dict[str, Any]:
+    tokens = re.findall(r"\S+|\s+", content) or [content]
+    entries = []
+    for token in tokens:
+        chosen = -rng.uniform(0.0, 1.5)
+        # alternatives are less likely than the chosen token
+        alternatives = [str(d) for d in range(1, 6) if str(d) != token] if token.isdigit() else list(WORDS)
+        top = [{"token": token, "logprob": chosen, "bytes": list(token.encode())}]
+        for alternative in rng.sample(alternatives, min(max(top_logprobs - 1, 0), len(alternatives))):
+            top.append({"token": alternative, "logprob": chosen - rng.uniform(0.5, 5.0), "bytes": list(alternative.encode())})
+        entries.append({"token": token, "logprob": chosen, "bytes": list(token.encode()), "top_logprobs": top})
+    return {"content": entries}
+
+
+def chat_completion(params: Dict[str, Any]) -> Dict[str, Any]:
+    rng = random.Random(_seed(params.get("model"), params.get("messages"), params.get("response_format"), params.get("seed")))
+    content = completion_content(params, rng)
+    choice: Dict[str, Any] = {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": content}}
+    if params.get("logprobs"):
+        choice["logprobs"] = logprobs(content, params.get("top_logprobs") or 0, rng)
+    prompt_tokens = estimate_prompt_tokens(params)
+    completion_tokens = max(1, len(content) // 4)
+    return {
+        "id": f"chatcmpl-mock-{rng.getrandbits(64):016x}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": params.get("model"),
+        "choices": [choice],
+        "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                  "total_tokens": prompt_tokens + completion_tokens},
+    }
+
+
+def embedding_vector(text: str, model: str, dimensions: int) -> np.ndarray:
+    vector = np.random.default_rng(_seed(model, text)).standard_normal(dimensions).astype(np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def embeddings(params: Dict[str, Any]) -> Dict[str, Any]:
+    texts = params["input"]
+    texts = [texts] if isinstance(texts, str) else texts
+    model = params.get("model")
+    dimensions = params.get("dimensions") or DEFAULT_DIMENSIONS.get(model, 1536)
+    data = []
+    for i, text in enumerate(texts):
+        vector = embedding_vector(str(text), model, dimensions)
+        if params.get("encoding_format") == "base64":
+            embedding: Any = base64.b64encode(vector.tobytes()).decode()
+        else:
+            embedding = vector.tolist()
+        data.append({"object": "embedding", "index": i, "embedding": embedding})
+    tokens = estimate_prompt_tokens({"input": texts})
+    return {"object": "list", "data": data, "model": model, "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+
+
+def _error(message: str, kind: str, code: Optional[str] = None) -> Dict[str, Any]:
+    return {"error": {"message": message, "type": kind, "param": None, "code": code}}
+
+
+class MockServer:
+    ROUTES = {"/v1/chat/completions": chat_completion, "/v1/embeddings": embeddings}
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 0.05, seed: int = 0) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "ok": 0, "errors": 0, "rate_limited": 0, "context_overflow": 0}
+        self._thread: Optional[threading.Thread] = None
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_POST(self) -> None:
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                status, payload, headers = server.handle(self.path, body)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                try:
+                    self.wfile.write(data)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on the request (timeout or cancelled task)
+                    pass
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def handle(self, path: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, Any], Dict[str, str]]:
+        with self._lock:
+            self.stats["requests"] += 1
+            draw, jitter = self._rng.random(), self._rng.uniform(0.5, 1.5)
+        if self.latency:
+            time.sleep(self.latency * jitter)
+        route = self.ROUTES.get(path.split("?")[0])
+        if route is None:
+            return 404, _error(f"unknown endpoint {path}", "invalid_request_error"), {}
+        if draw < self.rate_limit_rate:
+            self._count("rate_limited")
+            headers = {"retry-after-ms": str(int(self.retry_after * 1000)), "retry-after": str(self.retry_after)}
+            return 429, _error("Rate limit reached (mock)", "requests", "rate_limit_exceeded"), headers
+        if draw < self.rate_limit_rate + self.error_rate:
+            self._count("errors")
+            return 500, _error("Internal server error (mock)", "server_error"), {}
+        if "messages" in body:
+            tokens, limit = estimate_prompt_tokens(body), context_window(body.get("model", ""))
+            if tokens > limit:
+                self._count("context_overflow")
+                message = f"This model's maximum context length is {limit} tokens. However, your messages resulted in {tokens} tokens."
+                return 400, _error(message, "invalid_request_error", "context_length_exceeded"), {}
+        self._count("ok")
+        return 200, route(body), {}
+
+    def start(self) -> str:
+        """Serve in a background thread; returns the base URL for the OpenAI client."""
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def report(self) -> str:
+        return "mock server: " + ", ".join(f"{value} {name}" for name, value in self.stats.items())
+
+
+def main() -> None:
+    ap = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--latency", type=float, default=0.0, help="Mean seconds added to every request.")
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Share of requests answered with a 500.")
+    ap.add_argument("--rate-limit-rate", type=float, default=0.0, help="Share of requests answered with a 429.")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+    server = MockServer(args.host, args.port, args.latency, args.error_rate, args.rate_limit_rate, seed=args.seed)
+    print(f"Serving the mock OpenAI API on {server.base_url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(server.report())
+
+
+if __name__ == "__main__":
+    main()
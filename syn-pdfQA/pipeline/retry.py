@@ -0,0 +1,55 @@
+"""Per-item execution of a stage's requests with retries of the failed items.
+
+Gathering all requests of a file without ``return_exceptions`` loses the whole
+file to a single transient error. ``run_with_retry`` runs the items, keeps the
+ones that succeeded and sends only the failed items again, as long as their
+errors are retryable (pipeline/errors.py). Between rounds it waits with
+exponential backoff and full jitter, so files that hit a rate limit together
+do not come back together. The OpenAI client retries single requests a few
+times itself (``max_retries``); this covers what is left when it gives up,
+and errors of batched requests.
+
+    answers = await run_with_retry(lambda items: answer([prompts[i] for i in items]), len(prompts))
+    failed = failures(answers)   # position -> error, context overflow and fatal errors included
+"""
+from __future__ import annotations
+
+import asyncio
+import random
+from typing import Any, Awaitable, Callable, List, Optional, Sequence
+
+from pipeline.errors import RETRYABLE, classify
+
+# results (or errors) of the items at the given positions, in their order
+RunItems = Callable[[List[int]], Awaitable[Sequence[Any]]]
+
+
+def backoff_delay(attempt: int, base_delay: float, max_delay: float, rng: Optional[random.Random] = None) -> float:
+    """Full jitter: uniform between 0 and the exponential delay of the attempt (0-based)."""
+    return (rng or random).uniform(0.0, min(max_delay, base_delay * 2 ** attempt))
+
+
+async def run_with_retry(run: RunItems, n: int, attempts: int = 4, base_delay: float = 1.0, max_delay: float = 30.0,
+                         rng: Optional[random.Random] = None) -> List[Any]:
+    """Results of ``n`` items in order, with the final error in place of each item that failed.
+
+    ``run`` gets the positions of the items to run and returns one result or
+    exception per position (e.g. ``asyncio.gather(..., return_exceptions=True)``).
+    Items with retryable errors run again, up to ``attempts`` times in total.
+    """
+    results: List[Any] = [None] * n
+    pending = list(range(n))
+    for attempt in range(attempts):
+        outcomes = await run(pending)
+        retry = []
+        for i, outcome in zip(pending, outcomes):
+            results[i] = outcome
+            if isinstance(outcome, BaseException) and classify(outcome) == RETRYABLE:
+                retry.append(i)
+        if not retry or attempt == attempts - 1:
+            break
+        delay = backoff_delay(attempt, base_delay, max_delay, rng)
+        print(f"Retrying {len(retry)} of {n} requests in {delay:.1f}s: {results[retry[0]]!r}")
+        await asyncio.sleep(delay)
+        pending = retry
+    return results
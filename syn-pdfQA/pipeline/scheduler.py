@@ -0,0 +1,190 @@
+"""Rate-limit-aware scheduling of OpenAI requests.
+
+All stages used to turn every prompt of a file into a coroutine and fire them
+at once with ``asyncio.gather``. On long documents this produces bursts that
+run into 429s. The scheduler below admits requests in arrival order, keeps at
+most ``max_in_flight`` of them open and budgets requests and (estimated) prompt
+tokens per minute for every model.
+
+Usage:
+    SCHEDULER = RequestScheduler(max_in_flight=32)
+    response = await SCHEDULER.submit(CLIENT.chat.completions.create, model=MODEL, messages=m)
+    print(SCHEDULER.report())
+"""
+from __future__ import annotations
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Any, Awaitable, Callable, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from pipeline.completion_cache import CompletionCache
+    from pipeline.metrics import Metrics
+
+# rough estimate of tokens per character for English prose (OpenAI rule of thumb)
+CHARS_PER_TOKEN = 4
+# role/formatting tokens added by the chat format for each message
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+@dataclass(frozen=True)
+class RateLimit:
+    rpm: int  # requests per minute
+    tpm: int  # tokens per minute
+
+
+# fallback for models without an entry in RATE_LIMITS
+DEFAULT_RATE_LIMIT = RateLimit(rpm=500, tpm=200_000)
+
+# adjust to the limits of your organisation (see platform.openai.com/settings/organization/limits)
+RATE_LIMITS: Dict[str, RateLimit] = {
+    "gpt-4.1-2025-04-14": RateLimit(rpm=500, tpm=300_000),
+    "gpt-4.1-mini-2025-04-14": RateLimit(rpm=500, tpm=1_000_000),
+    "gpt-4o-mini-2024-07-18": RateLimit(rpm=500, tpm=1_000_000),
+    "text-embedding-3-small": RateLimit(rpm=3_000, tpm=1_000_000),
+}
+
+
+def estimate_prompt_tokens(params: Dict[str, Any]) -> int:
+    """Estimate the prompt tokens of a chat (``messages``) or embedding (``input``) request."""
+    if "messages" in params:
+        return sum(
+            MESSAGE_OVERHEAD_TOKENS + len(str(m.get("content", ""))) // CHARS_PER_TOKEN
+            for m in params["messages"]
+        )
+    texts = params.get("input", "")
+    if isinstance(texts, str):
+        texts = [texts]
+    return sum(len(str(t)) // CHARS_PER_TOKEN + 1 for t in texts)
+
+
+class _ModelBudget:
+    """Token buckets for requests and tokens of one model, refilled continuously."""
+
+    def __init__(self, limit: RateLimit) -> None:
+        self.limit = limit
+        self.requests = float(limit.rpm)
+        self.tokens = float(limit.tpm)
+        self.updated = time.monotonic()
+        # asyncio.Lock wakes up waiters in FIFO order -> requests are admitted in arrival order
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.requests = min(self.limit.rpm, self.requests + elapsed * self.limit.rpm / 60)
+        self.tokens = min(self.limit.tpm, self.tokens + elapsed * self.limit.tpm / 60)
+
+    async def acquire(self, tokens: int) -> None:
+        # a single prompt larger than the minute budget would otherwise never be admitted
+        tokens = min(tokens, self.limit.tpm)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.requests >= 1 and self.tokens >= tokens:
+                    self.requests -= 1
+                    self.tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.requests) * 60 / self.limit.rpm,
+                    (tokens - self.tokens) * 60 / self.limit.tpm,
+                )
+                await asyncio.sleep(wait)
+
+
+@dataclass
+class ModelStats:
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    busy_seconds: float = 0.0
+    first_start: Optional[float] = None
+    last_end: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        if self.first_start is None or self.last_end is None:
+            return 0.0
+        return self.last_end - self.first_start
+
+
+class RequestScheduler:
+    """Admit API requests under a concurrency cap and per-model RPM/TPM budgets."""
+
+    def __init__(
+        self,
+        max_in_flight: int = 32,
+        rate_limits: Optional[Dict[str, RateLimit]] = None,
+        default_rate_limit: RateLimit = DEFAULT_RATE_LIMIT,
+        cache: Optional[CompletionCache] = None,
+        metrics: Optional[Metrics] = None,
+    ) -> None:
+        self.max_in_flight = max_in_flight
+        self.cache = cache
+        self.metrics = metrics
+        self.rate_limits = dict(RATE_LIMITS if rate_limits is None else rate_limits)
+        self.default_rate_limit = default_rate_limit
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._budgets: Dict[str, _ModelBudget] = {}
+        self.stats: Dict[str, ModelStats] = {}
+
+    def _budget(self, model: str) -> _ModelBudget:
+        if model not in self._budgets:
+            self._budgets[model] = _ModelBudget(self.rate_limits.get(model, self.default_rate_limit))
+        return self._budgets[model]
+
+    async def submit(self, create: Callable[..., Awaitable[Any]], **params: Any) -> Any:
+        """Call ``create(**params)`` once the model's budget and an in-flight slot are free.
+
+        ``params`` are the keyword arguments of the API call and must include ``model``.
+        Cached responses are returned without touching the rate budget.
+        """
+        use_cache = self.cache is not None and self.cache.cacheable(params)
+        if use_cache:
+            cached = self.cache.get(params)
+            if cached is not None:
+                if self.metrics is not None:
+                    self.metrics.call("chat", params["model"], cached.usage, cached=True)
+                return cached
+        model = params["model"]
+        estimated_tokens = estimate_prompt_tokens(params)
+        await self._budget(model).acquire(estimated_tokens)
+        async with self._slots:
+            start = time.monotonic()
+            response = await create(**params)
+            end = time.monotonic()
+        self._record(model, estimated_tokens, response, start, end)
+        if use_cache:
+            self.cache.put(params, response)
+        return response
+
+    async def map(self, create: Callable[..., Awaitable[Any]], requests: List[Dict[str, Any]]) -> List[Any]:
+        """Submit all requests (lists of keyword arguments) and return the responses in order."""
+        return await asyncio.gather(*[self.submit(create, **params) for params in requests])
+
+    def _record(self, model: str, estimated_tokens: int, response: Any, start: float, end: float) -> None:
+        stats = self.stats.setdefault(model, ModelStats())
+        usage = getattr(response, "usage", None)
+        stats.requests += 1
+        stats.prompt_tokens += getattr(usage, "prompt_tokens", None) or estimated_tokens
+        stats.completion_tokens += getattr(usage, "completion_tokens", None) or 0
+        stats.busy_seconds += end - start
+        stats.first_start = start if stats.first_start is None else min(stats.first_start, start)
+        stats.last_end = end if stats.last_end is None else max(stats.last_end, end)
+
+    def report(self) -> str:
+        """Throughput per model since the scheduler was created."""
+        lines = []
+        for model, s in self.stats.items():
+            minutes = max(s.elapsed, 1e-9) / 60
+            mean_latency = s.busy_seconds / s.requests if s.requests else 0.0
+            lines.append(
+                f"{model}: {s.requests} requests in {s.elapsed:.1f}s "
+                f"({s.requests / minutes:.0f} RPM, {(s.prompt_tokens + s.completion_tokens) / minutes:.0f} TPM, "
+                f"mean latency {mean_latency:.2f}s)"
+            )
+        if self.cache is not None:
+            lines.append(self.cache.report())
+        return "\n".join(lines)
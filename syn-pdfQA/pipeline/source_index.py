@@ -0,0 +1,114 @@
+"""Per-document lookup structures of stage 02: metadata of generated QA items and source sampling.
+
+``post_process_answer`` used to join and split the text of the whole document
+for every answer (``file_length``, ``source_spread``) and scan the frame with
+``isin`` / boolean masks to find the cited rows. ``SourceIndex`` is built once
+per document and holds
+
+    rows               source_identifier -> row positions
+    word_prefix        prefix sums of the word counts of ``text_only``
+    max_source_number  number of the last source identifier
+
+so the metadata of an item costs O(#cited sources). Word counts follow the
+original definition, ``len(" ".join(texts).split(" "))``, which equals the
+sum of ``len(text.split(" "))`` over the joined texts.
+
+``SourceSampler`` holds row-position arrays per modality and per cluster, so
+the sources of a prompt are drawn without filtering the frame again.
+"""
+from __future__ import annotations
+
+from typing import Dict, List, Sequence
+
+import numpy as np
+import pandas as pd
+
+from pipeline.vector_index import source_number
+
+
+class SourceIndex:
+    def __init__(self, report_data: pd.DataFrame) -> None:
+        self.file_name = report_data.file_name.iloc[0]
+        self.source_identifiers = report_data.source_identifier.to_list()
+        self.types = report_data["type"].to_list()
+        self.contents = report_data.content.to_list()
+        self.rows: Dict[str, List[int]] = {}
+        for row, source_identifier in enumerate(self.source_identifiers):
+            self.rows.setdefault(source_identifier, []).append(row)
+        words = np.fromiter((len(t.split(" ")) for t in report_data.text_only.to_list()), dtype=np.int64, count=len(report_data))
+        self.word_prefix = np.concatenate([[0], np.cumsum(words)])
+        self.max_source_number = source_number(self.source_identifiers[-1])
+
+    @property
+    def file_length(self) -> int:
+        return int(self.word_prefix[-1])
+
+    def cited_rows(self, sources: Sequence[str]) -> List[int]:
+        """Rows of the cited sources in document order (unknown identifiers are skipped)."""
+        return sorted({row for s in dict.fromkeys(sources) for row in self.rows.get(s, ())})
+
+    def words_between(self, first: str, last: str) -> int:
+        """Words from the first row of ``first`` to the first row of ``last`` (inclusive).
+
+        Raises KeyError for identifiers that are not in the document.
+        """
+        start, end = self.rows[first][0], self.rows[last][0]
+        if end < start:
+            # empty range, "".split(" ") has one element
+            return 1
+        return int(self.word_prefix[end + 1] - self.word_prefix[start])
+
+
+class SourceSampler:
+    """Row-position arrays of one document for drawing source windows and clusters (stage 02).
+
+    Replaces filtering ``report_data`` by type or cluster for every prompt. Seeds are passed in
+    as uniform numbers in [0, 1), so all of a file's draws can be made up front from one
+    ``numpy.random.Generator``.
+    """
+
+    def __init__(self, report_data: pd.DataFrame) -> None:
+        self.source_identifiers = report_data.source_identifier.to_numpy(dtype=object)
+        self.types = report_data["type"].to_numpy(dtype=object)
+        self.contents = report_data.content.to_numpy(dtype=object)
+        self.all_rows = np.arange(len(report_data))
+        self.rows_by_type = {t: np.flatnonzero(self.types == t) for t in pd.unique(self.types)}
+        # clusters in order of appearance, like report_data.cluster.unique()
+        self.rows_by_cluster = {c: np.asarray(rows) for c, rows in report_data.groupby("cluster", sort=False).indices.items()}
+        self.clusters = list(self.rows_by_cluster)
+
+    def rows_of_type(self, modality: str) -> np.ndarray:
+        return self.rows_by_type.get(modality, self.all_rows[:0])
+
+    @staticmethod
+    def position(n: int, u: float) -> int:
+        # like random.randint(0, n - 1), which also fails for n == 0
+        if n == 0:
+            raise ValueError("no sources to sample from")
+        return int(u * n)
+
+    @staticmethod
+    def window(rows: np.ndarray, center: int, n_sources: int) -> np.ndarray:
+        """About n_sources rows around position ``center`` of ``rows`` (bounds as in the original sampler)."""
+        lower = int(np.ceil(center - (n_sources / 2))) if center - (n_sources / 2) > 0 else 0
+        upper = int(np.ceil(center + (n_sources / 2))) if center + (n_sources / 2) < len(rows) else len(rows) - 1
+        return rows[lower:upper]
+
+    def proximity(self, modality: str, n_sources: int, u: float) -> np.ndarray:
+        """Rows of a proximity question: a window of text rows, one table, or a window around a table."""
+        if modality == "text-only":
+            rows = self.rows_of_type("text")
+            return self.window(rows, self.position(len(rows), u), n_sources)
+        tables = self.rows_of_type("table")
+        if modality == "table-only":
+            return tables[[self.position(len(tables), u)]]
+        if modality == "mixed-modality":
+            # window over the whole document around a random table
+            return self.window(self.all_rows, int(tables[self.position(len(tables), u)]), n_sources)
+        raise ValueError(f"unknown modality {modality!r}")
+
+    def cluster(self, n_sources: int, u: float, rng: np.random.Generator) -> np.ndarray:
+        """Up to n_sources random rows of a random cluster, ordered by source identifier."""
+        rows = self.rows_by_cluster[self.clusters[int(u * len(self.clusters))]]
+        chosen = rng.choice(rows, size=min(n_sources, len(rows)), replace=False)
+        return chosen[np.argsort(self.source_identifiers[chosen], kind="stable")]
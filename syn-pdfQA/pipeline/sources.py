@@ -0,0 +1,53 @@
+"""Reading and writing the ``*_clustered.parquet`` source files.
+
+Embeddings are stored as a FixedSizeList<float32> column instead of Python
+lists of float64 in an object column. They are only decoded when asked for:
+``read_sources`` projects the text columns and ``read_embeddings`` returns the
+embedding column as one contiguous (n_sources, dim) float32 matrix without
+going through pandas. Files written before this change (list<double>) are
+read the same way.
+"""
+from __future__ import annotations
+
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+EMBEDDING_PREFIX = "embeddings_"
+
+
+def embedding_column(model: str) -> str:
+    return f"{EMBEDDING_PREFIX}{model}"
+
+
+def write_sources(df: pd.DataFrame, embeddings: np.ndarray, path: str, model: str) -> None:
+    """Write the sources of a document with their embeddings as a fixed-size float32 column."""
+    column = embedding_column(model)
+    embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+    table = pa.Table.from_pandas(df.drop(columns=[column], errors="ignore"))
+    values = pa.FixedSizeListArray.from_arrays(pa.array(embeddings.ravel()), embeddings.shape[1])
+    table = table.append_column(column, values)
+    pq.write_table(table, path)
+
+
+def read_sources(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+    """Read the sources of a document; embedding columns are skipped unless listed in ``columns``."""
+    if columns is None:
+        schema = pq.read_schema(path)
+        columns = [name for name in schema.names if not name.startswith(EMBEDDING_PREFIX)]
+        # the pandas index is restored from the metadata, it must not be projected explicitly
+        columns = [name for name in columns if not name.startswith("__index_level_")]
+    return pd.read_parquet(path, columns=columns)
+
+
+def read_embeddings(path: str, column: str) -> np.ndarray:
+    """Read one embedding column as a (n_sources, dim) float32 matrix."""
+    array = pq.read_table(path, columns=[column]).column(column).combine_chunks()
+    n = len(array)
+    if n == 0:
+        return np.zeros((0, 0), dtype=np.float32)
+    values = array.flatten().to_numpy(zero_copy_only=False)
+    return values.astype(np.float32, copy=False).reshape(n, -1)
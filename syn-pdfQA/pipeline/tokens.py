@@ -0,0 +1,73 @@
+"""Local token counting with tiktoken, and the context windows of the models.
+
+tiktoken downloads the BPE file of an encoding on first use. Without network
+access (and without the file in ``TIKTOKEN_CACHE_DIR``) tokens are estimated
+from the length of the text instead, like the request scheduler does.
+"""
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Dict, List, Sequence, Union
+
+import tiktoken
+
+from pipeline.scheduler import CHARS_PER_TOKEN
+
+# encoding of recent OpenAI models, used for models tiktoken does not know yet
+FALLBACK_ENCODING = "o200k_base"
+
+# fallback for models without an entry in CONTEXT_WINDOWS
+DEFAULT_CONTEXT_WINDOW = 128_000
+
+# input + output tokens of one request
+CONTEXT_WINDOWS: Dict[str, int] = {
+    "gpt-4.1-2025-04-14": 1_047_576,
+    "gpt-4.1-mini-2025-04-14": 1_047_576,
+    "gpt-4o-2024-08-06": 128_000,
+    "gpt-4o-2024-11-20": 128_000,
+    "gpt-4o-mini-2024-07-18": 128_000,
+}
+
+
+class ApproximateEncoding:
+    """Stand-in for a tiktoken encoding: every CHARS_PER_TOKEN characters are one token."""
+
+    name = "approximate"
+
+    def encode(self, text: str, disallowed_special: Sequence[str] = ()) -> List[str]:
+        return [text[i:i + CHARS_PER_TOKEN] for i in range(0, len(text), CHARS_PER_TOKEN)]
+
+    def decode(self, tokens: Sequence[str]) -> str:
+        return "".join(tokens)
+
+
+@lru_cache(maxsize=None)
+def encoding_for(model: str) -> Union[tiktoken.Encoding, ApproximateEncoding]:
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding(FALLBACK_ENCODING)
+    except Exception as e:
+        # the BPE file could not be downloaded (offline) or read
+        print(f"WARNING: no tiktoken encoding for {model} ({type(e).__name__}), estimating {CHARS_PER_TOKEN} characters per token")
+        return ApproximateEncoding()
+
+
+def encode(text: str, model: str) -> Sequence[Union[int, str]]:
+    return encoding_for(model).encode(text, disallowed_special=())
+
+
+def count_tokens(text: str, model: str) -> int:
+    return len(encode(text, model))
+
+
+def truncate(text: str, max_tokens: int, model: str) -> str:
+    tokens = encode(text, model)
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding_for(model).decode(tokens[:max_tokens])
+
+
+def context_window(model: str) -> int:
+    return CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
@@ -0,0 +1,90 @@
+"""Per-document vector index for top-k source retrieval.
+
+The embeddings of a document are loaded once into a normalized, contiguous
+float32 matrix together with a source_identifier -> row map. Retrieval for all
+questions of a file is a single matrix multiply followed by ``argpartition``,
+with the sources a question already cites masked out.
+
+Usage:
+    index = DocumentIndex.from_parquet(path, "embeddings_text-embedding-3-small")
+    top_k = index.top_k(question_embeddings, k=5, exclude=[d["sources"] for d in data])
+    rows = index.with_neighbours(top_k[0] + data[0]["sources"])
+"""
+from __future__ import annotations
+
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+import pandas as pd
+
+from pipeline.sources import read_embeddings, read_sources
+
+
+def normalize_rows(matrix: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def source_number(source_identifier: str) -> int:
+    # "Source_12" -> 12
+    return int(source_identifier.split("_")[1])
+
+
+class DocumentIndex:
+    def __init__(self, embeddings: np.ndarray, source_identifiers: Sequence[str], contents: Optional[Sequence[str]] = None) -> None:
+        self.matrix = np.ascontiguousarray(normalize_rows(np.asarray(embeddings, dtype=np.float32)))
+        self.source_identifiers = np.asarray(source_identifiers, dtype=object)
+        self.contents = None if contents is None else np.asarray(contents, dtype=object)
+        self.rows: Dict[str, int] = {si: row for row, si in enumerate(self.source_identifiers)}
+
+    @classmethod
+    def from_frame(cls, df: pd.DataFrame, column_name: str = "embeddings_text-embedding-3-small") -> "DocumentIndex":
+        return cls(
+            np.vstack(df[column_name].to_numpy()),
+            df["source_identifier"].tolist(),
+            df["content"].tolist() if "content" in df.columns else None,
+        )
+
+    @classmethod
+    def from_parquet(cls, path: str, column_name: str = "embeddings_text-embedding-3-small") -> "DocumentIndex":
+        """Build the index straight from a ``*_clustered.parquet`` file, reading only the needed columns."""
+        df = read_sources(path, columns=["source_identifier", "content"])
+        return cls(read_embeddings(path, column_name), df["source_identifier"].tolist(), df["content"].tolist())
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def top_k(self, queries: Sequence[Sequence[float]], k: int = 5, exclude: Optional[Sequence[Iterable[str]]] = None) -> List[List[str]]:
+        """Source identifiers of the k most similar sources per query, most similar first.
+
+        ``exclude`` holds, per query, source identifiers that must not be returned.
+        """
+        queries = normalize_rows(np.asarray(queries, dtype=np.float32).reshape(len(queries), -1))
+        similarities = queries @ self.matrix.T
+        if exclude is not None:
+            for q, identifiers in enumerate(exclude):
+                masked = [self.rows[si] for si in identifiers if si in self.rows]
+                similarities[q, masked] = -np.inf
+
+        k = min(k, len(self))
+        if k == 0:
+            return [[] for _ in range(len(queries))]
+        candidates = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+        results = []
+        for q, rows in enumerate(candidates):
+            rows = rows[np.argsort(-similarities[q, rows], kind="stable")]
+            rows = rows[np.isfinite(similarities[q, rows])]
+            results.append(self.source_identifiers[rows].tolist())
+        return results
+
+    def with_neighbours(self, source_identifiers: Iterable[str]) -> np.ndarray:
+        """Rows of the given sources and their Source_{n-1}/Source_{n+1} neighbours, in document order."""
+        rows = set()
+        for si in source_identifiers:
+            number = source_number(si)
+            for candidate in (si, f"Source_{number + 1}", f"Source_{number - 1}"):
+                row = self.rows.get(candidate)
+                if row is not None:
+                    rows.add(row)
+        return np.array(sorted(rows), dtype=np.int64)
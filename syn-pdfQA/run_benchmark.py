@@ -0,0 +1,32 @@
+import asyncio
+import sys
+from pipeline.benchmark import BenchmarkHarness, LocalJudge, lexical_system
+
+# windows or not?
+if sys.platform.startswith("win"):
+    asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+
+async def main():
+    # questions to answer: "../syn-pdfQA.parquet" or "../real-pdfQA.parquet"
+    qa_file = "../syn-pdfQA.parquet"
+    # parsed sources of the documents, looked up by file_type/file_name
+    sources_root = "02_Parsed_Input_Files_to_Sources"
+    # the system under test: async (question row, sources of the document) -> answer
+    SYSTEM = lexical_system
+    # grader with the chat.completions.create interface; LocalJudge runs offline,
+    # e.g. AsyncOpenAI(api_key=...) with "gpt-4.1-mini-2025-04-14" grades like stage 04
+    GRADER = LocalJudge()
+    MODEL_eval_answer = "local-judge"
+    # questions answered at the same time
+    concurrency = 16
+    # number of questions to answer, None answers every question
+    limit = None
+
+    harness = BenchmarkHarness(qa_file, sources_root, GRADER, MODEL_eval_answer, concurrency=concurrency, limit=limit)
+    report = await harness.run(SYSTEM, output_path="07_Benchmark/results.jsonl")
+    print(report.summary())
+
+# run
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,503 @@
+from __future__ import annotations
+
+import argparse
+import fnmatch
+import hashlib
+import http.client
+import json
+import os
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+CHUNK_SIZE = 1 << 20
+MANIFEST_NAME = ".pdfqa_download.json"
+# HTTP status codes worth another attempt
+RETRYABLE_STATUS = (408, 429, 500, 502, 503, 504)
+
+
+@dataclass
+class RemoteFile:
+    path: str
+    size: int
+    sha256: Optional[str] = None  # LFS files
+    blob_id: Optional[str] = None  # git blob sha1 of regular files
+
+
+class VerificationError(RuntimeError):
+    """Raised when a downloaded file does not have the listed size or hash."""
+
+
+def allow_patterns(paths: List[str]) -> List[str]:
+    """Folders get '/**', files and globs are kept (as in download_folders.py)."""
+    allow: List[str] = []
+    for rp in paths:
+        rp = rp.strip().lstrip("/")
+        if not rp:
+            continue
+        if not any(ch in rp for ch in ["*", "?", "["]) and Path(rp).suffix == "":
+            rp = f"{rp}/**"
+        if rp not in allow:
+            allow.append(rp)
+    return allow or ["*"]
+
+
+def matches(path: str, patterns: List[str]) -> bool:
+    # fnmatch like snapshot_download: '*' also matches '/'
+    return any(fnmatch.fnmatch(path, p + "*" if p.endswith("/") else p) for p in patterns)
+
+
+class HubSource:
+    """Files of a Hugging Face dataset repo, pinned to the commit they were listed at."""
+
+    def __init__(self, repo_id: str, revision: Optional[str] = None, endpoint: Optional[str] = None) -> None:
+        from huggingface_hub import HfApi
+
+        self.repo_id = repo_id
+        # the branch, tag or commit asked for (None: main); revision is the commit it resolves to
+        self.requested_revision = revision
+        self.revision = revision
+        self.api = HfApi(endpoint=endpoint)
+        self.name = f"hf://datasets/{repo_id}"
+
+    def list_files(self, patterns: List[str]) -> List[RemoteFile]:
+        # one listing of the whole tree with sizes and hashes; the revision is pinned so the
+        # files still match the listing when a sync is resumed after the repo changed
+        self.revision = self.api.dataset_info(self.repo_id, revision=self.revision).sha
+        files = []
+        for entry in self.api.list_repo_tree(self.repo_id, recursive=True, repo_type="dataset", revision=self.revision):
+            if not hasattr(entry, "size") or not matches(entry.path, patterns):
+                continue
+            sha256 = entry.lfs.sha256 if entry.lfs is not None else None
+            files.append(RemoteFile(entry.path, entry.size, sha256, None if sha256 else entry.blob_id))
+        return files
+
+    def url(self, path: str) -> str:
+        from huggingface_hub import hf_hub_url
+
+        return hf_hub_url(self.repo_id, path, repo_type="dataset", revision=self.revision, endpoint=self.api.endpoint)
+
+    def headers(self) -> Dict[str, str]:
+        from huggingface_hub.utils import build_hf_headers
+
+        return build_hf_headers()
+
+
+class MirrorSource:
+    """Files served by hub_mirror.py (or any server with the same index.json)."""
+
+    def __init__(self, base_url: str) -> None:
+        self.base_url = base_url.rstrip("/")
+        self.requested_revision: Optional[str] = None
+        self.revision: Optional[str] = None
+        self.name = self.base_url
+
+    def list_files(self, patterns: List[str]) -> List[RemoteFile]:
+        with urllib.request.urlopen(f"{self.base_url}/index.json", timeout=60) as response:
+            index = json.load(response)
+        self.revision = index.get("revision")
+        return [RemoteFile(**f) for f in index["files"] if matches(f["path"], patterns)]
+
+    def url(self, path: str) -> str:
+        return f"{self.base_url}/{urllib.parse.quote(path)}"
+
+    def headers(self) -> Dict[str, str]:
+        return {}
+
+
+class DownloadManifest:
+    """
+    Local record of a sync, kept next to the files in MANIFEST_NAME.
+
+    It holds the resolved file list (so a failed or interrupted sync is resumed
+    without listing the repo again) and the size, hash and mtime of every file
+    that was verified (so it is not hashed again on the next run).
+    """
+
+    def __init__(self, path: str, save_seconds: float = 5.0) -> None:
+        self.path = path
+        self.save_seconds = save_seconds
+        self._saved = 0.0
+        self._lock = threading.Lock()
+        self.data: Dict[str, Any] = {}
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+        self.data.setdefault("verified", {})
+
+    def listing(self, source: str, requested_revision: Optional[str], patterns: List[str]) -> Optional[List[RemoteFile]]:
+        if (self.data.get("source") != source or self.data.get("requested_revision") != requested_revision
+                or self.data.get("patterns") != patterns):
+            return None
+        return [RemoteFile(**f) for f in self.data.get("files", [])]
+
+    def set_listing(self, source: str, requested_revision: Optional[str], revision: Optional[str], patterns: List[str],
+                    files: List[RemoteFile]) -> None:
+        with self._lock:
+            self.data.update(source=source, requested_revision=requested_revision, revision=revision, patterns=patterns,
+                             files=[asdict(f) for f in files])
+            self._save()
+
+    def is_verified(self, file: RemoteFile, dest: str) -> bool:
+        entry = self.data["verified"].get(file.path)
+        if entry is None or not os.path.exists(dest):
+            return False
+        stat = os.stat(dest)
+        return (entry["size"] == file.size == stat.st_size and entry["mtime"] == stat.st_mtime
+                and entry.get("sha256") == file.sha256 and entry.get("blob_id") == file.blob_id)
+
+    def verified(self, file: RemoteFile, dest: str, digest: str) -> None:
+        with self._lock:
+            self.data["verified"][file.path] = {
+                "size": file.size, "sha256": file.sha256, "blob_id": file.blob_id,
+                "digest": digest, "mtime": os.stat(dest).st_mtime,
+            }
+            # written every few seconds, not for each of thousands of files; save() at the end
+            if time.monotonic() - self._saved > self.save_seconds:
+                self._save()
+
+    def save(self) -> None:
+        with self._lock:
+            self._save()
+
+    def _save(self) -> None:
+        self._saved = time.monotonic()
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f, indent=1)
+        os.replace(tmp, self.path)
+
+
+class Hasher:
+    """sha256 for LFS files, the git blob sha1 for regular files."""
+
+    def __init__(self, file: RemoteFile) -> None:
+        self.file = file
+        if file.sha256:
+            self.h = hashlib.sha256()
+        else:
+            self.h = hashlib.sha1()
+            self.h.update(f"blob {file.size}\0".encode())
+
+    def update(self, data: bytes) -> None:
+        self.h.update(data)
+
+    def check(self, size: int) -> str:
+        expected = self.file.sha256 or self.file.blob_id
+        digest = self.h.hexdigest()
+        if size != self.file.size:
+            raise VerificationError(f"{self.file.path}: {size} bytes, expected {self.file.size}")
+        if expected and digest != expected:
+            raise VerificationError(f"{self.file.path}: hash {digest}, expected {expected}")
+        return digest
+
+
+class Throughput:
+    """Bytes received; optional cap in bytes per second shared by all workers."""
+
+    def __init__(self, max_bytes_per_second: Optional[float] = None) -> None:
+        self.max_bytes_per_second = max_bytes_per_second
+        self.total = 0
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+        self._window = (time.monotonic(), 0)
+
+    def add(self, n: int) -> None:
+        with self._lock:
+            self.total += n
+            if self.max_bytes_per_second:
+                # sleep until the average since the start is back under the cap
+                ahead = self.total / self.max_bytes_per_second - (time.monotonic() - self.start)
+            else:
+                ahead = 0.0
+        if ahead > 0:
+            time.sleep(ahead)
+
+    def window_rate(self) -> float:
+        """Bytes per second since the last call."""
+        with self._lock:
+            now, total = time.monotonic(), self.total
+            since, before = self._window
+            self._window = (now, total)
+        return (total - before) / max(now - since, 1e-9)
+
+
+class AdaptiveLimit:
+    """
+    Number of downloads allowed to run at the same time, tuned by throughput.
+
+    Starts at ``start`` and probes upwards while another parallel download
+    still raises the total throughput by more than ``gain``; steps back when
+    throughput drops (the link or the server is saturated).
+    """
+
+    def __init__(self, start: int, maximum: int, gain: float = 0.1) -> None:
+        self.limit = max(1, min(start, maximum))
+        self.maximum = maximum
+        self.peak = self.limit
+        self.gain = gain
+        self.active = 0
+        self._best = 0.0
+        self._cond = threading.Condition()
+
+    def __enter__(self) -> "AdaptiveLimit":
+        with self._cond:
+            while self.active >= self.limit:
+                self._cond.wait()
+            self.active += 1
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        with self._cond:
+            self.active -= 1
+            self._cond.notify()
+
+    def observe(self, rate: float) -> None:
+        with self._cond:
+            if self.active < self.limit:
+                # not enough work left to fill the slots, nothing to learn
+                return
+            if rate > self._best * (1 + self.gain):
+                # the last step paid off: try one more
+                self._best = rate
+                if self.limit < self.maximum:
+                    self.limit += 1
+                    self._cond.notify()
+            elif rate < self._best * (1 - self.gain):
+                self._best = rate
+                self.limit = max(1, self.limit - 1)
+            self.peak = max(self.peak, self.limit)
+
+
+class DownloadEngine:
+    """
+    Download a resolved file list with a pool of workers and verify every file.
+
+    Files are written to ``<name>.incomplete`` while hashing on the fly, resumed
+    with a Range request after a dropped connection, checked against the listed
+    size and hash (sha256 for LFS files, git blob sha1 otherwise) and only then
+    moved into place. Transient errors (timeouts, 429, 5xx, hash mismatch) are
+    retried with jittered backoff; a failed file does not stop the others.
+    """
+
+    def __init__(self, source: Any, local_dir: str, workers: int = 8, start_workers: int = 2,
+                 max_bytes_per_second: Optional[float] = None, attempts: int = 5, probe_seconds: float = 2.0,
+                 timeout: float = 60.0) -> None:
+        self.source = source
+        self.local_dir = local_dir
+        self.workers = workers
+        self.attempts = attempts
+        self.probe_seconds = probe_seconds
+        self.timeout = timeout
+        self.throughput = Throughput(max_bytes_per_second)
+        self.limit = AdaptiveLimit(start_workers, workers)
+        os.makedirs(local_dir, exist_ok=True)
+        self.manifest = DownloadManifest(os.path.join(local_dir, MANIFEST_NAME))
+
+    def resolve(self, patterns: List[str], refresh: bool = False) -> List[RemoteFile]:
+        # only a sync of the default branch is resumed from its listing; an explicit --revision is listed
+        # again (a branch or tag may have moved), the files verified before are not downloaded again
+        requested = self.source.requested_revision
+        files = None if refresh or requested is not None else self.manifest.listing(self.source.name, requested, patterns)
+        if files is None:
+            files = self.source.list_files(patterns)
+            self.manifest.set_listing(self.source.name, requested, self.source.revision, patterns, files)
+        else:
+            # resumed sync: download from the listed revision
+            self.source.revision = self.manifest.data.get("revision")
+        return files
+
+    def destination(self, file: RemoteFile) -> str:
+        dest = os.path.abspath(os.path.join(self.local_dir, file.path))
+        if not dest.startswith(os.path.abspath(self.local_dir) + os.sep):
+            raise ValueError(f"path outside of the local dir: {file.path}")
+        return dest
+
+    def _hash_existing(self, file: RemoteFile, path: str) -> Hasher:
+        hasher = Hasher(file)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        return hasher
+
+    def _finish(self, file: RemoteFile, part: str, dest: str, hasher: Hasher, size: int) -> str:
+        try:
+            digest = hasher.check(size)
+        except VerificationError:
+            os.remove(part)
+            raise
+        os.replace(part, dest)
+        return digest
+
+    def _fetch(self, file: RemoteFile, dest: str) -> str:
+        part = dest + ".incomplete"
+        offset = os.path.getsize(part) if os.path.exists(part) else 0
+        if offset > file.size:
+            os.remove(part)
+            offset = 0
+        hasher = self._hash_existing(file, part) if offset else Hasher(file)
+        if offset and offset == file.size:
+            # complete, the last run stopped before the check and rename; a range request would get a 416
+            return self._finish(file, part, dest, hasher, offset)
+        headers = dict(self.source.headers())
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+        request = urllib.request.Request(self.source.url(file.path), headers=headers)
+        try:
+            response = urllib.request.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 416 or not offset:
+                raise
+            # range not satisfiable (the part does not match the remote file): start over
+            os.remove(part)
+            return self._fetch(file, dest)
+        with response:
+            if offset and response.status != 206:
+                # the server ignored the range: start over
+                offset, hasher = 0, Hasher(file)
+            with open(part, "ab" if offset else "wb") as f:
+                size = offset
+                # read1 returns what has arrived, so a dropped connection keeps its bytes for the resume
+                for chunk in iter(lambda: response.read1(CHUNK_SIZE), b""):
+                    f.write(chunk)
+                    hasher.update(chunk)
+                    size += len(chunk)
+                    self.throughput.add(len(chunk))
+        if size < file.size:
+            raise ConnectionError(f"{file.path}: connection closed after {size} of {file.size} bytes")
+        return self._finish(file, part, dest, hasher, size)
+
+    def download(self, file: RemoteFile) -> str:
+        """'skipped' for verified files, else 'downloaded'; raises after the last attempt."""
+        dest = self.destination(file)
+        if self.manifest.is_verified(file, dest):
+            return "skipped"
+        if os.path.exists(dest) and os.path.getsize(dest) == file.size:
+            # e.g. fetched by snapshot_download: verify instead of downloading again
+            try:
+                self.manifest.verified(file, dest, self._hash_existing(file, dest).check(file.size))
+                return "skipped"
+            except VerificationError:
+                pass
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        for attempt in range(self.attempts):
+            try:
+                with self.limit:
+                    digest = self._fetch(file, dest)
+                self.manifest.verified(file, dest, digest)
+                return "downloaded"
+            except Exception as e:
+                retryable = isinstance(e, (VerificationError, urllib.error.URLError, http.client.HTTPException, TimeoutError, ConnectionError))
+                if isinstance(e, urllib.error.HTTPError):
+                    retryable = e.code in RETRYABLE_STATUS
+                if not retryable or attempt == self.attempts - 1:
+                    raise
+                time.sleep(random.uniform(0, min(30.0, 2 ** attempt)))
+        raise AssertionError("unreachable")
+
+    def run(self, files: List[RemoteFile]) -> Dict[str, Any]:
+        """Download the files; prints one line per file and returns the totals."""
+        # largest first, so the last file does not keep one worker busy while the others idle
+        files = sorted(files, key=lambda f: f.size, reverse=True)
+        counts = {"downloaded": 0, "skipped": 0, "failed": 0}
+        failed: Dict[str, str] = {}
+        start = time.monotonic()
+        done = threading.Event()
+
+        def monitor() -> None:
+            while not done.wait(self.probe_seconds):
+                self.limit.observe(self.throughput.window_rate())
+
+        threading.Thread(target=monitor, daemon=True).start()
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                futures = {pool.submit(self.download, f): f for f in files}
+                for n, future in enumerate(as_completed(futures), 1):
+                    file = futures[future]
+                    try:
+                        status = future.result()
+                    except Exception as e:
+                        status = "failed"
+                        failed[file.path] = repr(e)
+                    counts[status] += 1
+                    rate = self.throughput.total / max(time.monotonic() - start, 1e-9)
+                    print(f"[{n:>{len(str(len(files)))}}/{len(files)}] {status:<10} {file.size / 1e6:9.1f} MB "
+                          f"{rate / 1e6:7.1f} MB/s  x{self.limit.limit}  {file.path}")
+        finally:
+            done.set()
+            self.manifest.save()
+        seconds = time.monotonic() - start
+        return {
+            "files": len(files), **counts, "failed_files": failed, "bytes": self.throughput.total,
+            "seconds": seconds, "bytes_per_second": self.throughput.total / max(seconds, 1e-9),
+            "peak_workers": self.limit.peak,
+        }
+
+
+def main() -> None:
+    """
+    Download files of the dataset repo with a pool of workers, verifying sizes and hashes.
+
+    The file list is resolved once (and kept in the manifest of the local dir, so an
+    interrupted sync continues without listing the repo again), files run in parallel
+    (the number of concurrent downloads adapts to the measured throughput, up to
+    --workers), and every file is checked against the listed size and hash.
+
+    Usage:
+      python download_engine.py syn-pdfQA/01.2_Input_Files_PDF/books syn-pdfQA.parquet
+      python download_engine.py --paths-file paths.txt --workers 16 --max-mbps 50
+      python download_engine.py --mirror http://127.0.0.1:8000 syn-pdfQA   # see hub_mirror.py
+    """
+    ap = argparse.ArgumentParser(description="Parallel, verified download of files of a HF dataset repo.")
+    ap.add_argument("--repo-id", default=os.environ.get("REPO_ID", "pdfqa/pdfQA-Benchmark"))
+    ap.add_argument("--revision", default=None, help="Branch, tag or commit (default: main).")
+    ap.add_argument("--local-dir", default=os.environ.get("LOCAL_DIR", "downloads_subset"))
+    ap.add_argument("--mirror", default=os.environ.get("MIRROR_URL"), help="Base URL of a hub_mirror.py server instead of the Hub.")
+    ap.add_argument("--paths-file", help="Text file with repo-relative paths, one per line. Lines starting with # are ignored.")
+    ap.add_argument("--workers", type=int, default=8, help="Maximum number of parallel downloads.")
+    ap.add_argument("--start-workers", type=int, default=2, help="Parallel downloads to start with.")
+    ap.add_argument("--max-mbps", type=float, default=None, help="Cap on the total download rate in MB/s.")
+    ap.add_argument("--attempts", type=int, default=5, help="Attempts per file.")
+    ap.add_argument("--refresh", action="store_true", help="List the repo again instead of reusing the manifest.")
+    ap.add_argument("paths", nargs="*", help="Repo-relative folders, files or globs (default: everything).")
+    args = ap.parse_args()
+
+    paths = list(args.paths)
+    if args.paths_file:
+        lines = Path(args.paths_file).read_text(encoding="utf-8", errors="replace").splitlines()
+        paths.extend(line.strip() for line in lines if line.strip() and not line.strip().startswith("#"))
+    patterns = allow_patterns(paths)
+
+    source = MirrorSource(args.mirror) if args.mirror else HubSource(args.repo_id, args.revision)
+    engine = DownloadEngine(source, args.local_dir, workers=args.workers, start_workers=args.start_workers,
+                            max_bytes_per_second=args.max_mbps * 1e6 if args.max_mbps else None,
+                            attempts=args.attempts)
+
+    print(f"==> Source:    {source.name}")
+    print(f"==> Local dir: {args.local_dir}")
+    print(f"==> Patterns:  {', '.join(patterns)}")
+    files = engine.resolve(patterns, refresh=args.refresh)
+    print(f"==> Revision:  {source.revision}")
+    print(f"==> {len(files)} files, {sum(f.size for f in files) / 1e6:.1f} MB")
+
+    report = engine.run(files)
+    print(f"\n==> {report['downloaded']} downloaded, {report['skipped']} already verified, {report['failed']} failed: "
+          f"{report['bytes'] / 1e6:.1f} MB in {report['seconds']:.1f}s ({report['bytes_per_second'] / 1e6:.1f} MB/s, "
+          f"up to {report['peak_workers']} parallel)")
+    for path, error in report["failed_files"].items():
+        print(f"    ✗ {path}: {error}")
+    if report["failed"]:
+        sys.exit(1)
+    print(f"\n✅ Done: {args.local_dir}/")
+
+
+if __name__ == "__main__":
+    main()
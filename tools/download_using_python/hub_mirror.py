@@ -0,0 +1,190 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+CHUNK_SIZE = 1 << 16
+
+
+def build_index(root: str) -> List[Dict[str, Any]]:
+    """Path, size and sha256 of every file below root, like the listing of the Hub."""
+    files = []
+    for folder, _, names in os.walk(root):
+        for name in sorted(names):
+            path = os.path.join(folder, name)
+            h = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1 << 20), b""):
+                    h.update(chunk)
+            rel = os.path.relpath(path, root).replace(os.sep, "/")
+            files.append({"path": rel, "size": os.path.getsize(path), "sha256": h.hexdigest()})
+    return sorted(files, key=lambda f: f["path"])
+
+
+class HubMirror:
+    """
+    Local HTTP server that stands in for the Hub when testing download_engine.py.
+
+    Serves ``/index.json`` (the file list with sizes and sha256) and every file
+    below ``root`` with Range support. For testing retries and resumption it can
+    fail a share of requests with a 503 (``error_rate``), cut a share of responses
+    off halfway (``drop_rate``) and cap the rate of each connection
+    (``bytes_per_second``), so more parallel downloads give more throughput.
+    """
+
+    def __init__(self, root: str, host: str = "127.0.0.1", port: int = 0, error_rate: float = 0.0,
+                 drop_rate: float = 0.0, bytes_per_second: Optional[float] = None, seed: int = 0) -> None:
+        self.root = os.path.abspath(root)
+        self.error_rate = error_rate
+        self.drop_rate = drop_rate
+        self.bytes_per_second = bytes_per_second
+        self.index = {"revision": "mirror", "files": build_index(self.root)}
+        self.stats = {"requests": 0, "errors": 0, "dropped": 0, "ranges": 0, "bytes": 0}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        mirror = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self) -> None:
+                try:
+                    mirror.handle(self)
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client gave up on the request
+                    pass
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def _count(self, name: str, n: int = 1) -> None:
+        with self._lock:
+            self.stats[name] += n
+
+    def _range(self, header: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+        if not header or not header.startswith("bytes="):
+            return None
+        first, _, last = header[len("bytes="):].partition("-")
+        return int(first), int(last) if last else size - 1
+
+    def handle(self, request: BaseHTTPRequestHandler) -> None:
+        with self._lock:
+            self.stats["requests"] += 1
+            draw = self._rng.random()
+        path = urllib.parse.unquote(urllib.parse.urlsplit(request.path).path).lstrip("/")
+        if path == "index.json":
+            self._send(request, 200, json.dumps(self.index).encode(), "application/json")
+            return
+        full = os.path.abspath(os.path.join(self.root, path))
+        if not full.startswith(self.root + os.sep) or not os.path.isfile(full):
+            self._send(request, 404, b"not found")
+            return
+        if draw < self.error_rate:
+            self._count("errors")
+            self._send(request, 503, b"unavailable (mirror)")
+            return
+
+        size = os.path.getsize(full)
+        byte_range = self._range(request.headers.get("Range"), size)
+        start, end = byte_range or (0, size - 1)
+        if byte_range and start >= size:
+            request.send_response(416)
+            request.send_header("Content-Range", f"bytes */{size}")
+            request.send_header("Content-Length", "0")
+            request.end_headers()
+            return
+        request.send_response(206 if byte_range else 200)
+        if byte_range:
+            self._count("ranges")
+            request.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        request.send_header("Content-Type", "application/octet-stream")
+        request.send_header("Content-Length", str(end - start + 1))
+        request.send_header("Accept-Ranges", "bytes")
+        request.end_headers()
+
+        # a dropped response stops halfway, the client sees a short read
+        stop = start + (end - start + 1) // 2 if draw < self.error_rate + self.drop_rate else end + 1
+        began = time.monotonic()
+        sent = 0
+        with open(full, "rb") as f:
+            f.seek(start)
+            while start + sent < stop:
+                chunk = f.read(min(CHUNK_SIZE, stop - start - sent))
+                request.wfile.write(chunk)
+                sent += len(chunk)
+                if self.bytes_per_second:
+                    ahead = sent / self.bytes_per_second - (time.monotonic() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        self._count("bytes", sent)
+        if stop <= end:
+            self._count("dropped")
+            request.close_connection = True
+
+    def _send(self, request: BaseHTTPRequestHandler, status: int, body: bytes, content_type: str = "text/plain") -> None:
+        request.send_response(status)
+        request.send_header("Content-Type", content_type)
+        request.send_header("Content-Length", str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def start(self) -> str:
+        """Serve in a background thread; returns the base URL for --mirror."""
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self.base_url
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def report(self) -> str:
+        return "mirror: " + ", ".join(f"{value} {name}" for name, value in self.stats.items())
+
+
+def main() -> None:
+    """
+    Serve a local copy of (part of) the dataset repo like the Hub, for download_engine.py.
+
+    Usage:
+      python hub_mirror.py pdfQA_syn-pdfQA --port 8000 --kbps-per-connection 2000 --error-rate 0.05
+      python download_engine.py --mirror http://127.0.0.1:8000 --local-dir mirror_copy syn-pdfQA
+    """
+    ap = argparse.ArgumentParser(description="Local HTTP mirror of a dataset folder, standing in for the Hub.")
+    ap.add_argument("root", help="Folder to serve (repo-relative paths below it).")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--error-rate", type=float, default=0.0, help="Share of file requests answered with a 503.")
+    ap.add_argument("--drop-rate", type=float, default=0.0, help="Share of responses cut off halfway.")
+    ap.add_argument("--kbps-per-connection", type=float, default=None, help="Rate cap of each connection in kB/s.")
+    ap.add_argument("--seed", type=int, default=0)
+    args = ap.parse_args()
+
+    rate = args.kbps_per_connection * 1e3 if args.kbps_per_connection else None
+    mirror = HubMirror(args.root, args.host, args.port, args.error_rate, args.drop_rate, rate, args.seed)
+    print(f"==> Serving {len(mirror.index['files'])} files of {mirror.root} on {mirror.base_url}")
+    try:
+        mirror.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(mirror.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+from __future__ import annotations
+
+import argparse
+import os
+import time
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+
+FILES = {
+    "syn-pdfQA": "syn-pdfQA.parquet",
+    "real-pdfQA": "real-pdfQA.parquet",
+}
+
+# filter names that map to a differently named column
+COLUMN_ALIASES = {
+    "syn-pdfQA": {"difficulty": "question_difficulty"},
+    "real-pdfQA": {"file_type": "dataset"},
+}
+
+
+class PdfQADataset:
+    """
+    Lazy view over real-pdfQA.parquet or syn-pdfQA.parquet.
+
+    Opening reads only the parquet footer. select() and filter() return new views;
+    nothing is read until the view is iterated. Only the selected columns are read
+    and filters are pushed down to the parquet scan, so row groups whose statistics
+    exclude the filter are skipped.
+
+    Example:
+      questions = (PdfQADataset.open("syn-pdfQA")
+                   .select("file_name", "question", "answer")
+                   .filter(file_type="books", answer_type=["word-answer", "value-question"]))
+      for batch in questions.batches(batch_size=256):
+          ...
+    """
+
+    def __init__(self, path: str, name: Optional[str] = None, columns: Optional[Sequence[str]] = None,
+                 expression: Optional[ds.Expression] = None) -> None:
+        self.path = path
+        self.name = name or os.path.basename(path).replace(".parquet", "")
+        self.dataset = ds.dataset(path, format="parquet")
+        self.columns = list(columns) if columns is not None else [
+            c for c in self.dataset.schema.names if not c.startswith("__index_level_")
+        ]
+        self.expression = expression
+
+    @classmethod
+    def open(cls, name: str, root: str = ".") -> "PdfQADataset":
+        return cls(os.path.join(root, FILES[name]), name=name)
+
+    def _view(self, columns: Sequence[str], expression: Optional[ds.Expression]) -> "PdfQADataset":
+        view = object.__new__(PdfQADataset)
+        view.path, view.name, view.dataset = self.path, self.name, self.dataset
+        view.columns, view.expression = list(columns), expression
+        return view
+
+    def _column(self, name: str) -> str:
+        column = COLUMN_ALIASES.get(self.name, {}).get(name, name)
+        if column not in self.dataset.schema.names:
+            raise KeyError(f"{self.name} has no column {name!r} (columns: {self.dataset.schema.names})")
+        return column
+
+    @property
+    def schema(self) -> pa.Schema:
+        return pa.schema([self.dataset.schema.field(c) for c in self.columns])
+
+    def select(self, *columns: str) -> "PdfQADataset":
+        return self._view([self._column(c) for c in columns], self.expression)
+
+    def filter(self, **predicates: Any) -> "PdfQADataset":
+        """Keep rows whose column equals the value (or is one of the values of a list/tuple/set)."""
+        expression = self.expression
+        for name, value in predicates.items():
+            field = ds.field(self._column(name))
+            condition = field.isin(list(value)) if isinstance(value, (list, tuple, set)) else field == value
+            expression = condition if expression is None else expression & condition
+        return self._view(self.columns, expression)
+
+    def batches(self, batch_size: int = 1024) -> Iterator[pa.RecordBatch]:
+        """Record batches of the selected columns and rows, read with constant memory."""
+        scanner = self.dataset.scanner(columns=self.columns, filter=self.expression, batch_size=batch_size)
+        for batch in scanner.to_batches():
+            if batch.num_rows:
+                yield batch
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for batch in self.batches():
+            yield from batch.to_pylist()
+
+    def row_groups(self) -> List[ds.ParquetFileFragment]:
+        """Row groups that can contain matching rows (pruned with their statistics)."""
+        groups = []
+        for fragment in self.dataset.get_fragments(filter=self.expression):
+            groups.extend(fragment.split_by_row_group(filter=self.expression))
+        return groups
+
+    def read_row_group(self, i: int) -> pa.Table:
+        return self.row_groups()[i].to_table(columns=self.columns, filter=self.expression)
+
+    def count(self) -> int:
+        return self.dataset.count_rows(filter=self.expression)
+
+    def to_table(self) -> pa.Table:
+        return self.dataset.to_table(columns=self.columns, filter=self.expression)
+
+    def to_pandas(self):
+        return self.to_table().to_pandas()
+
+
+def main() -> None:
+    """
+    Print a slice of real-pdfQA or syn-pdfQA without loading the whole file.
+
+    Examples:
+      python pdfqa_dataset.py --category syn-pdfQA --columns file_name question answer --where file_type=books
+      python pdfqa_dataset.py --category syn-pdfQA --where answer_type=word-answer,value-question --count
+      python pdfqa_dataset.py --category real-pdfQA --columns question answer --where file_type=FinQA --limit 3
+
+    Optional env overrides:
+      LOCAL_ROOT=downloads python pdfqa_dataset.py --category real-pdfQA --count
+    """
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--category", required=True, choices=sorted(FILES))
+    ap.add_argument("--columns", nargs="*", help="Columns to read (default: all).")
+    ap.add_argument("--where", nargs="*", default=[], help="Filters column=value[,value...], e.g. difficulty=complex.")
+    ap.add_argument("--limit", type=int, default=5, help="Rows to print.")
+    ap.add_argument("--count", action="store_true", help="Only count the matching rows.")
+    args = ap.parse_args()
+
+    start = time.perf_counter()
+    data = PdfQADataset.open(args.category, root=os.environ.get("LOCAL_ROOT", "."))
+    if args.columns:
+        data = data.select(*args.columns)
+    predicates = {}
+    for condition in args.where:
+        column, _, values = condition.partition("=")
+        values = values.split(",")
+        predicates[column] = values if len(values) > 1 else values[0]
+    data = data.filter(**predicates)
+
+    if args.count:
+        print(f"{data.count()} rows")
+    else:
+        shown = 0
+        for batch in data.batches(batch_size=max(1, args.limit)):
+            for row in batch.to_pylist()[: args.limit - shown]:
+                print(row)
+                shown += 1
+            if shown >= args.limit:
+                break
+    print(f"==> {time.perf_counter() - start:.2f}s")
+
+
+if __name__ == "__main__":
+    main()